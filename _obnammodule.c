@@ -28,6 +28,9 @@
  * POSIX_FADV_DONTNEED flags, to make sure the kernel knows that it will
  * read files sequentially and that the data does not need to be cached.
  * This makes Obnam not trash the disk buffer cache, which is nice.
+ *
+ * It also provides the rolling checksum used to find chunk boundaries
+ * in file data, since doing that in Python would be far too slow.
  */
 
 
@@ -47,6 +50,7 @@
 #include <sys/stat.h>
 #include <unistd.h>
 #include <stdlib.h>
+#include <stdint.h>
 
 #if defined(__FreeBSD__)
     #include <sys/extattr.h>
@@ -305,6 +309,98 @@ lsetxattr_wrapper(PyObject *self, PyObject *args)
 }
 
 
+/*
+ * Content-defined chunking. We compute a "buzhash" rolling checksum
+ * over a sliding window of the data, and end a chunk where the low
+ * bits of the checksum are all ones. Since the checksum only depends
+ * on the bytes in the window, chunk boundaries move along with the
+ * data when bytes are inserted or deleted, and the chunks after the
+ * change stay the same, so they can be de-duplicated.
+ *
+ * The table of random values is generated from a fixed seed. It must
+ * never change, or the boundaries, and so de-duplication against old
+ * backups, would change too.
+ */
+
+#define BUZHASH_WINDOW 48
+#define ROTL32(x, n) \
+    (((x) << ((n) % 32)) | ((x) >> ((32 - ((n) % 32)) % 32)))
+
+static uint32_t buzhash_table[256];
+
+
+static void
+buzhash_init(void)
+{
+    uint32_t x = 0x9e3779b9;
+    int i;
+
+    for (i = 0; i < 256; ++i) {
+        x ^= x << 13;
+        x ^= x >> 17;
+        x ^= x << 5;
+        buzhash_table[i] = x;
+    }
+}
+
+
+static PyObject *
+find_chunk_boundary(PyObject *self, PyObject *args)
+{
+    const unsigned char *buf;
+    int buflen;
+    unsigned long offset;
+    unsigned long min_size, avg_size, max_size;
+    unsigned long len, limit, i;
+    unsigned long boundary;
+    uint32_t hash;
+    uint32_t mask;
+
+    if (!PyArg_ParseTuple(args, "s#kkkk", &buf, &buflen, &offset,
+                          &min_size, &avg_size, &max_size))
+        return NULL;
+
+    if (offset > (unsigned long) buflen) {
+        PyErr_SetString(PyExc_ValueError, "offset is beyond end of data");
+        return NULL;
+    }
+    buf += offset;
+    len = buflen - offset;
+    limit = len < max_size ? len : max_size;
+    if (limit <= min_size)
+        return Py_BuildValue("k", limit);
+
+    /* The expected chunk size is min_size plus the mask plus one, so
+       pick the largest power of two that keeps it at or below avg_size. */
+    mask = 1;
+    while (avg_size > min_size && mask * 2 <= avg_size - min_size &&
+           mask < 0x80000000)
+        mask *= 2;
+    mask -= 1;
+
+    boundary = limit;
+
+    Py_BEGIN_ALLOW_THREADS
+    hash = 0;
+    i = min_size > BUZHASH_WINDOW ? min_size - BUZHASH_WINDOW : 0;
+    for (; i < min_size; ++i)
+        hash = ROTL32(hash, 1) ^ buzhash_table[buf[i]];
+    for (i = min_size; i < limit; ++i) {
+        hash = ROTL32(hash, 1) ^ buzhash_table[buf[i]];
+        if (i >= BUZHASH_WINDOW)
+            hash ^= ROTL32(buzhash_table[buf[i - BUZHASH_WINDOW]],
+                           BUZHASH_WINDOW);
+        if ((hash & mask) == mask) {
+            boundary = i + 1;
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("k", boundary);
+}
+
+
 static PyMethodDef methods[] = {
     {"fadvise_dontneed",  fadvise_dontneed, METH_VARARGS,
      "Call posix_fadvise(2) with POSIX_FADV_DONTNEED argument."},
@@ -318,6 +414,9 @@ static PyMethodDef methods[] = {
      "lgetxattr(2) wrapper; arg is filename, returns tuple."},
     {"lsetxattr", lsetxattr_wrapper, METH_VARARGS,
      "lsetxattr(2) wrapper; arg is filename, returns errno."},
+    {"find_chunk_boundary", find_chunk_boundary, METH_VARARGS,
+     "Return length of next content-defined chunk; args are data, "
+     "offset, minimum, average, and maximum chunk size."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -325,5 +424,6 @@ static PyMethodDef methods[] = {
 PyMODINIT_FUNC
 init_obnam(void)
 {
+    buzhash_init();
     (void) Py_InitModule("_obnam", methods);
 }
@@ -46,9 +46,27 @@ class ObnamError(StructuredError):
 
 DEFAULT_NODE_SIZE = 256 * 1024 # benchmarked on 2011-09-01
 DEFAULT_CHUNK_SIZE = 1024 * 1024 # benchmarked on 2011-09-01
+DEFAULT_CHUNK_MIN_SIZE = 256 * 1024
+DEFAULT_CHUNK_MAX_SIZE = 4 * 1024 * 1024
 DEFAULT_UPLOAD_QUEUE_SIZE = 128
 DEFAULT_LRU_SIZE = 256
+DEFAULT_FILE_KEY_CACHE_SIZE = 1024
 DEFAULT_CHUNKIDS_PER_GROUP = 1024
+DEFAULT_BACKUP_WORKERS = 2
+DEFAULT_BACKUP_QUEUE_SIZE = 16
+DEFAULT_UPLOAD_BATCH_SIZE = 8
+DEFAULT_UPLOAD_BUFFER_SIZE = 0
+DEFAULT_SCAN_THREADS = 0
+DEFAULT_READ_AHEAD = 16
+DEFAULT_READ_WORKERS = 0
+DEFAULT_FILTER_WORKERS = 4
+DEFAULT_CHUNK_PACK_SIZE = 0
+DEFAULT_REPACK_THRESHOLD = 50
+DEFAULT_FORGET_GRACE_PERIOD = 24 * 60 * 60
+DEFAULT_SFTP_CONNECTIONS = 1
+DEFAULT_REPOSITORY_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_COMPRESS_THRESHOLD = 100
+DEFAULT_COMPRESS_PROBE_SIZE = 6 * 1024
 DEFAULT_NAGIOS_WARN_AGE = '27h'
 DEFAULT_NAGIOS_CRIT_AGE = '8d'
 
@@ -76,6 +94,9 @@ from sizeparse import SizeSyntaxError, UnitNameError, ByteSizeParser
 from encryption import (generate_symmetric_key,
                         encrypt_symmetric,
                         decrypt_symmetric,
+                        aead_is_available,
+                        encrypt_symmetric_aead,
+                        decrypt_symmetric_aead,
                         get_public_key,
                         get_public_key_user_ids,
                         Keyring,
@@ -83,7 +104,9 @@ from encryption import (generate_symmetric_key,
                         encrypt_with_keyring,
                         decrypt_with_secret_keys,
                         SymmetricKeyCache,
-                        EncryptionError)
+                        EncryptionError,
+                        AeadModuleNotFoundError,
+                        AeadDecryptionError)
 
 from hooks import (
     Hook, MissingFilterError, NoFilterTagError, FilterHook, HookManager)
@@ -97,12 +120,25 @@ from vfs import (
     NEW_FILE_MODE)
 from vfs_local import LocalFS
 from fsck_work_item import WorkItem
-from repo_fs import RepositoryFS
+from repo_fs import RepositoryFS, UploadError
+from caching_fs import CachingFS
+from chunk_pack_store import (
+    ChunkPackIndexError,
+    ChunkPackIndex,
+    ChunkPackStore)
 from lockmgr import LockManager
 from forget_policy import ForgetPolicy
 from app import App, ObnamIOError, ObnamSystemError
 from humanise import humanise_duration, humanise_size, humanise_speed
 from chunkid_token_map import ChunkIdTokenMap
+from bloom_filter import BloomFilterError, BloomFilter
+from chunk_id_set import Uint64Array, ChunkIdSet
+from chunk_refs import ChunkRefsError, ChunkRefs
+from chunk_removals import ChunkRemovalsError, ChunkRemovals
+from pipeline import OrderedPipeline
+from chunker import FixedSizeChunker, ContentDefinedChunker
+from local_metadata_cache import LocalMetadataCache
+from tree_scanner import TreeScanner
 from pathname_excluder import PathnameExcluder
 
 from repo_factory import (
@@ -156,7 +192,8 @@ from repo_interface import (
     REPO_FILE_DEV,
     REPO_FILE_INO,
     REPO_FILE_MD5,
-    REPO_FILE_INTEGER_KEYS)
+    REPO_FILE_INTEGER_KEYS,
+    REPO_FILE_METADATA_FIELDS)
 
 #
 # Repository format dummy specific modules.
@@ -106,10 +106,77 @@ class App(cliapp.Application):
 
         self.settings.bytesize(
             ['chunk-size'],
-            'size of chunks of file data backed up',
+            'size of chunks of file data backed up; with '
+            '--chunking=rolling, this is the average size',
             default=obnamlib.DEFAULT_CHUNK_SIZE,
             group=perf_group)
 
+        self.settings.choice(
+            ['chunking'],
+            ['fixed', 'rolling'],
+            'how to split file data into chunks: at fixed '
+            'intervals (the default), or at places chosen by a '
+            'rolling checksum of the data, which lets data be '
+            'de-duplicated even when other data has been inserted '
+            'or removed before it',
+            metavar='METHOD',
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['chunk-min-size'],
+            'minimum size of chunks with --chunking=rolling',
+            default=obnamlib.DEFAULT_CHUNK_MIN_SIZE,
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['chunk-max-size'],
+            'maximum size of chunks with --chunking=rolling',
+            default=obnamlib.DEFAULT_CHUNK_MAX_SIZE,
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['chunk-pack-size'],
+            'store new chunks in pack files of about SIZE bytes, '
+            'instead of one file per chunk (repository format 6 only; '
+            '0 means do not use pack files)',
+            default=obnamlib.DEFAULT_CHUNK_PACK_SIZE,
+            group=perf_group)
+
+        self.settings.integer(
+            ['filter-workers'],
+            'compress and encrypt batches of data for the repository '
+            'in NUM threads in parallel (0 means do it all in the '
+            'main thread)',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_FILTER_WORKERS,
+            group=perf_group)
+
+        self.settings.integer(
+            ['read-ahead'],
+            'when restoring, verifying, or reading files via FUSE, '
+            'fetch up to NUM chunks from the repository ahead of when '
+            'they are needed',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_READ_AHEAD,
+            group=perf_group)
+
+        self.settings.integer(
+            ['read-workers'],
+            'fetch, decrypt, and decompress chunks in NUM threads '
+            'in parallel (0 means do it all in the main thread)',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_READ_WORKERS,
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['upload-buffer-size'],
+            'write new chunks to the repository in the background, '
+            'while backing up goes on, keeping up to SIZE bytes of '
+            'them in memory (repository format 6 only; 0 means write '
+            'each chunk before going on)',
+            default=obnamlib.DEFAULT_UPLOAD_BUFFER_SIZE,
+            group=perf_group)
+
         self.settings.bytesize(
             ['upload-queue-size'],
             'length of upload queue for B-tree nodes',
@@ -122,6 +189,26 @@ class App(cliapp.Application):
             default=obnamlib.DEFAULT_LRU_SIZE,
             group=perf_group)
 
+        self.settings.integer(
+            ['file-key-cache-size'],
+            'number of files whose metadata is cached in memory',
+            default=obnamlib.DEFAULT_FILE_KEY_CACHE_SIZE,
+            group=perf_group)
+
+        self.settings.string(
+            ['repository-cache'],
+            'keep copies of B-tree nodes in DIR on local disk, so '
+            'that they need not be read from the repository again '
+            '(repository format 6 only)',
+            metavar='DIR',
+            group=perf_group)
+
+        self.settings.bytesize(
+            ['repository-cache-size'],
+            'maximum size of the local repository cache',
+            default=obnamlib.DEFAULT_REPOSITORY_CACHE_SIZE,
+            group=perf_group)
+
         self.settings.integer(
             ['idpath-depth'],
             'depth of chunk id mapping',
@@ -250,6 +337,12 @@ class App(cliapp.Application):
             'idpath_depth': self.settings['idpath-depth'],
             'idpath_bits': self.settings['idpath-bits'],
             'idpath_skip': self.settings['idpath-skip'],
+            'chunk_pack_size': self.settings['chunk-pack-size'],
+            'filter_workers': self.settings['filter-workers'],
+            'upload_buffer_size': self.settings['upload-buffer-size'],
+            'file_key_cache_size': self.settings['file-key-cache-size'],
+            'cache_dir': self.settings['repository-cache'],
+            'cache_size': self.settings['repository-cache-size'],
             'hooks': self.hooks,
             'current_time': self.time,
             }
@@ -0,0 +1,105 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import math
+import struct
+
+import obnamlib
+
+
+class BloomFilterError(obnamlib.ObnamError):
+
+    msg = 'Bloom filter data is corrupt'
+
+
+class BloomFilter(object):
+
+    '''A set of strings that can have false positives, but not negatives.
+
+    If a string has been added, the filter always says it is in the
+    set. If it hasn't, the filter usually says it isn't, but will
+    wrongly say it is with a probability of about error_rate, as long
+    as no more than capacity strings have been added. Strings can't
+    be removed.
+
+    The filter uses much less memory than a real set: about ten bits
+    per string for a one percent error rate.
+
+    '''
+
+    magic = 'obnam-bloom-filter 1'
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.capacity = capacity
+        self.num_bytes = max(1, (num_bits + 7) / 8)
+        self.num_hashes = max(1, int(round(
+            float(self.num_bytes * 8) / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray(self.num_bytes)
+
+    def is_full(self):
+        '''Have more than capacity strings been added?'''
+        return self.count > self.capacity
+
+    def _positions(self, key):
+        # Double hashing: the i'th bit is h1 + i*h2, which is as good
+        # as using num_hashes independent hash functions.
+        h1, h2 = struct.unpack('!QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        num_bits = self.num_bytes * 8
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self._bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def serialise(self):
+        header = '%s %d %d %d %d\n' % (
+            self.magic, self.capacity, self.num_bytes, self.num_hashes,
+            self.count)
+        return header + str(self._bits)
+
+    @classmethod
+    def unserialise(cls, encoded):
+        header, sep, bits = encoded.partition('\n')
+        words = header.rsplit(' ', 4)
+        if len(words) != 5 or words[0] != cls.magic:
+            raise BloomFilterError()
+        try:
+            capacity, num_bytes, num_hashes, count = [int(x) for x in words[1:]]
+        except ValueError:
+            raise BloomFilterError()
+        if len(bits) != num_bytes or num_hashes < 1:
+            raise BloomFilterError()
+
+        bf = cls(capacity)
+        bf.num_bytes = num_bytes
+        bf.num_hashes = num_hashes
+        bf.count = count
+        bf._bits = bytearray(bits)
+        return bf
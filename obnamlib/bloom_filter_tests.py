@@ -0,0 +1,63 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bf = obnamlib.BloomFilter(1000)
+
+    def test_is_empty_initially(self):
+        self.assertFalse('foo' in self.bf)
+        self.assertEqual(self.bf.count, 0)
+
+    def test_contains_added_keys(self):
+        keys = ['key %d' % i for i in range(1000)]
+        for key in keys:
+            self.bf.add(key)
+        for key in keys:
+            self.assertTrue(key in self.bf)
+
+    def test_has_few_false_positives(self):
+        for i in range(1000):
+            self.bf.add('key %d' % i)
+        false_positives = [
+            i for i in range(10000) if 'other %d' % i in self.bf]
+        self.assertTrue(len(false_positives) < 300)
+
+    def test_is_full_after_capacity_is_exceeded(self):
+        for i in range(1000):
+            self.bf.add('key %d' % i)
+        self.assertFalse(self.bf.is_full())
+        self.bf.add('one more')
+        self.assertTrue(self.bf.is_full())
+
+    def test_round_trips(self):
+        self.bf.add('foo')
+        bf2 = obnamlib.BloomFilter.unserialise(self.bf.serialise())
+        self.assertTrue('foo' in bf2)
+        self.assertFalse('bar' in bf2)
+        self.assertEqual(bf2.count, 1)
+        self.assertEqual(bf2.capacity, 1000)
+
+    def test_unserialise_raises_error_for_garbage(self):
+        self.assertRaises(
+            obnamlib.BloomFilterError,
+            obnamlib.BloomFilter.unserialise, 'this is garbage')
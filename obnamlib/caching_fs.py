@@ -0,0 +1,184 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class CachingFS(object):
+
+    '''A wrapper around a VFS object, caching B-tree nodes on local disk.
+
+    B-tree node files read from, or written to, the wrapped VFS are
+    kept in a local directory, so that later reads, in the same run or
+    a later one, need not fetch them again. This is meant for when the
+    repository is on a remote server. The files are cached as they are
+    in the repository, so if it is encrypted, so is the cache.
+
+    Only node files are cached: files in a directory called nodes.
+    A changed B-tree node gets a new node id, so a node file is not
+    rewritten, only removed, and a cached copy can't get out of date
+    the way one of a B-tree's metadata file or a lock file can. Before
+    a cached node is used, the file in the wrapped VFS is checked with
+    lstat, to see that it still exists and has the same size. A cached
+    copy is found by the repository URL, the pathname, and the size.
+    Checking costs a round trip, but that is much less than reading
+    the file.
+
+    Files are evicted, least recently used first, when the cache
+    grows larger than its maximum size.
+
+    Other than cat, write_file, write_files, and overwrite_file, all
+    methods are those of the wrapped VFS.
+
+    '''
+
+    def __init__(self, fs, dirname, max_size):
+        self.fs = fs
+        self._dirname = dirname
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        # Map key to (time of last use, size), for files in the cache.
+        # The time comes from the file's mtime, which is updated
+        # whenever the file is used.
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._scan()
+
+    def __getattr__(self, name):
+        return getattr(self.fs, name)
+
+    def _scan(self):
+        if not os.path.exists(self._dirname):
+            os.makedirs(self._dirname)
+        for dirname, subdirs, basenames in os.walk(self._dirname):
+            for basename in basenames:
+                if basename.startswith('tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirname, basename))
+                except OSError: # pragma: no cover
+                    continue
+                self._entries[basename] = (st.st_mtime, st.st_size)
+                self.size += st.st_size
+
+    def _is_cached(self, pathname):
+        return 'nodes' in pathname.split(os.sep)[:-1]
+
+    def _key(self, pathname, size):
+        parts = [self.fs.baseurl, pathname, str(size)]
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def _local_pathname(self, key):
+        return os.path.join(self._dirname, key[:2], key)
+
+    def _get(self, key):
+        pathname = self._local_pathname(key)
+        try:
+            with open(pathname, 'rb') as f:
+                data = f.read()
+            os.utime(pathname, None)
+        except (IOError, OSError):
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (os.path.getmtime(pathname), len(data))
+        return data
+
+    def _put(self, key, data):
+        if len(data) > self._max_size:
+            return
+        pathname = self._local_pathname(key)
+        dirname = os.path.dirname(pathname)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        except OSError as e:
+            # Another thread or process may have created it.
+            if e.errno != errno.EEXIST: # pragma: no cover
+                raise
+
+        # Write a temporary file and rename it, so that other Obnam
+        # processes sharing the cache never see a partial file.
+        fd, tempname = tempfile.mkstemp(dir=dirname, prefix='tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tempname, pathname)
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries[key][1]
+            self._entries[key] = (os.path.getmtime(pathname), len(data))
+            self.size += len(data)
+            if self.size > self._max_size:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to somewhat below the maximum size, so that the
+        # entries don't need to be sorted for every new file.
+        wanted = self._max_size * 9 / 10
+        by_age = sorted(self._entries.items(), key=lambda item: item[1][0])
+        for key, (used, size) in by_age:
+            if self.size <= wanted:
+                break
+            try:
+                os.remove(self._local_pathname(key))
+            except OSError: # pragma: no cover
+                pass
+            del self._entries[key]
+            self.size -= size
+
+    def cat(self, pathname):
+        if not self._is_cached(pathname):
+            return self.fs.cat(pathname)
+        size = self.fs.lstat(pathname).st_size
+        key = self._key(pathname, size)
+        data = self._get(key)
+        if data is not None and len(data) == size:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = self.fs.cat(pathname)
+        if len(data) == size:
+            self._put(key, data)
+        return data
+
+    def _remember(self, pathname, data):
+        if self._is_cached(pathname):
+            self._put(self._key(pathname, len(data)), data)
+
+    def write_file(self, pathname, contents):
+        self.fs.write_file(pathname, contents)
+        self._remember(pathname, contents)
+
+    def write_files(self, pathnames_and_contents):
+        pairs = list(pathnames_and_contents)
+        existing = self.fs.write_files(pairs)
+        not_written = set(existing)
+        for pathname, contents in pairs:
+            if pathname not in not_written:
+                self._remember(pathname, contents)
+        return existing
+
+    def overwrite_file(self, pathname, contents):
+        self.fs.overwrite_file(pathname, contents)
+        self._remember(pathname, contents)
@@ -0,0 +1,113 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class CachingFSTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repodir = os.path.join(self.tempdir, 'repo')
+        os.mkdir(self.repodir)
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.realfs = obnamlib.LocalFS(self.repodir)
+        self.fs = self.new_fs()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_fs(self, max_size=1024):
+        return obnamlib.CachingFS(self.realfs, self.cachedir, max_size)
+
+    def break_real_fs(self):
+        def raiser(pathname):
+            raise OSError('should have come from the cache')
+        self.realfs.cat = raiser
+
+    def test_passes_through_other_methods(self):
+        self.fs.mkdir('foo')
+        self.assertTrue(self.realfs.isdir('foo'))
+
+    def test_reads_file(self):
+        self.realfs.write_file('tree/nodes/foo', 'data')
+        self.assertEqual(self.fs.cat('tree/nodes/foo'), 'data')
+        self.assertEqual(self.fs.misses, 1)
+
+    def test_reads_file_from_cache_the_second_time(self):
+        self.realfs.write_file('tree/nodes/foo', 'data')
+        self.fs.cat('tree/nodes/foo')
+        self.break_real_fs()
+        self.assertEqual(self.fs.cat('tree/nodes/foo'), 'data')
+        self.assertEqual(self.fs.hits, 1)
+
+    def test_caches_written_files(self):
+        self.fs.write_file('tree/nodes/foo', 'foo data')
+        self.fs.overwrite_file('tree/nodes/bar', 'bar data')
+        self.fs.write_files([('tree/nodes/foobar', 'foobar data')])
+        self.break_real_fs()
+        self.assertEqual(self.fs.cat('tree/nodes/foo'), 'foo data')
+        self.assertEqual(self.fs.cat('tree/nodes/bar'), 'bar data')
+        self.assertEqual(self.fs.cat('tree/nodes/foobar'), 'foobar data')
+
+    def test_does_not_check_written_files(self):
+        def raiser(pathname):
+            raise OSError('should not have been called')
+        self.realfs.lstat = raiser
+        self.fs.write_file('tree/nodes/foo', 'data')
+        self.assertEqual(self.fs.size, 4)
+
+    def test_rereads_changed_file(self):
+        self.realfs.write_file('tree/nodes/foo', 'data')
+        self.fs.cat('tree/nodes/foo')
+        self.realfs.overwrite_file('tree/nodes/foo', 'changed data')
+        self.assertEqual(self.fs.cat('tree/nodes/foo'), 'changed data')
+
+    def test_does_not_cache_files_other_than_nodes(self):
+        self.fs.write_file('tree/metadata', 'data')
+        self.fs.write_file('chunks/nodes', 'data')
+        self.fs.cat('tree/metadata')
+        self.fs.cat('chunks/nodes')
+        self.assertEqual(self.fs.size, 0)
+
+    def test_keeps_cache_between_runs(self):
+        self.fs.write_file('tree/nodes/foo', 'data')
+        fs = self.new_fs()
+        self.assertEqual(fs.size, 4)
+        self.break_real_fs()
+        self.assertEqual(fs.cat('tree/nodes/foo'), 'data')
+
+    def test_evicts_least_recently_used_files(self):
+        fs = self.new_fs(max_size=25)
+        fs.write_file('tree/nodes/foo', 'x' * 10)
+        fs.write_file('tree/nodes/bar', 'y' * 10)
+        # Make foo be used after bar.
+        for pathname in ['tree/nodes/foo', 'tree/nodes/bar']:
+            key = fs._key(pathname, 10)
+            os.utime(fs._local_pathname(key), (0, 0))
+            fs._entries[key] = (0, 10)
+        fs.cat('tree/nodes/foo')
+        fs.write_file('tree/nodes/foobar', 'z' * 10)
+        self.assertEqual(fs.size, 20)
+        self.break_real_fs()
+        self.assertEqual(fs.cat('tree/nodes/foo'), 'x' * 10)
+        self.assertEqual(fs.cat('tree/nodes/foobar'), 'z' * 10)
+        self.assertRaises(OSError, fs.cat, 'tree/nodes/bar')
@@ -0,0 +1,244 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import array
+import bisect
+import struct
+import sys
+
+import obnamlib
+
+
+# The array typecode for unsigned 64-bit integers, or None if the
+# platform doesn't have one, in which case a list is used instead.
+def _find_typecode():
+    for typecode in 'LQ':
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+_typecode = _find_typecode()
+
+
+class Uint64Array(object):
+
+    '''A growable array of unsigned 64-bit integers, 8 bytes each.
+
+    The integers are kept in an array.array, so that they can be
+    searched with the bisect module without calling back into Python
+    for every probe. As a string, the integers are big-endian, so the
+    string is the same on all platforms, and can be written to a file
+    as is.
+
+    '''
+
+    _format = '!Q'
+    _size = struct.calcsize(_format)
+
+    def __init__(self, data=''):
+        count = len(data) / self._size
+        if _typecode is None:
+            self._array = list(struct.unpack('!%dQ' % count, str(data)))
+        else:
+            self._array = array.array(_typecode)
+            self._array.fromstring(str(data))
+            if sys.byteorder == 'little':
+                self._array.byteswap()
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, i):
+        return self._array[i]
+
+    def __setitem__(self, i, value):
+        self._array[i] = value
+
+    def __iter__(self):
+        return iter(self._array)
+
+    def append(self, value):
+        self._array.append(value)
+
+    def bisect_left(self, value):
+        '''Return the index where value would be inserted.'''
+        return bisect.bisect_left(self._array, value)
+
+    def copy(self):
+        result = Uint64Array()
+        result._array = self._array[:]
+        return result
+
+    def tostring(self):
+        if _typecode is None:
+            return struct.pack('!%dQ' % len(self._array), *self._array)
+        if sys.byteorder == 'little':
+            swapped = self._array[:]
+            swapped.byteswap()
+            return swapped.tostring()
+        return self._array.tostring()
+
+    def edit(self, edits):
+        '''Return a copy with some parts replaced.
+
+        edits is a list of (index, count, values) triples, sorted by
+        index, that don't overlap. In the copy, the count integers
+        starting at index are replaced with the list values. The parts
+        in between are copied as slices, so this is fast even if the
+        array is large, as long as there are few edits.
+
+        '''
+
+        data = self._array[:0]
+        pos = 0
+        for index, count, values in edits:
+            data += self._array[pos:index]
+            data.extend(values)
+            pos = index + count
+        data += self._array[pos:]
+
+        result = Uint64Array()
+        result._array = data
+        return result
+
+
+class ChunkIdSet(object):
+
+    '''A set of chunk ids that uses little memory.
+
+    Chunk ids are 64-bit integers, and a Python set of them takes
+    70 bytes or more per id. This keeps them sorted in a Uint64Array
+    instead, at 8 bytes per id, and finds them with a binary search.
+    New ids are collected in a small set, and merged into the array
+    when there are enough of them, so that adding ids one by one
+    doesn't copy the whole array every time.
+
+    Chunk ids that are not 64-bit integers, such as the ones for
+    in-tree data in repository format 6, are kept in an ordinary set.
+
+    '''
+
+    _min_pending = 64 * 1024
+
+    def __init__(self, chunk_ids=()):
+        self._ids = Uint64Array()
+        self._pending = set()
+        self._others = set()
+        self.update(chunk_ids)
+
+    def _is_int_id(self, chunk_id):
+        return (type(chunk_id) in (int, long) and
+                0 <= chunk_id <= obnamlib.MAX_ID)
+
+    def _find(self, chunk_id):
+        # Return index of chunk_id in the array, or None.
+        i = self._ids.bisect_left(chunk_id)
+        if i < len(self._ids) and self._ids[i] == chunk_id:
+            return i
+        return None
+
+    def __contains__(self, chunk_id):
+        if not self._is_int_id(chunk_id):
+            return chunk_id in self._others
+        return chunk_id in self._pending or self._find(chunk_id) is not None
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending) + len(self._others)
+
+    def __iter__(self):
+        self._merge_pending()
+        for chunk_id in self._ids:
+            yield chunk_id
+        for chunk_id in self._others:
+            yield chunk_id
+
+    def add(self, chunk_id):
+        if not self._is_int_id(chunk_id):
+            self._others.add(chunk_id)
+            return
+        if not self._pending and (not self._ids or self._ids[-1] < chunk_id):
+            # Ids added in increasing order, such as from B-tree keys,
+            # go straight to the end of the array. They can't be in
+            # the set already, so there's no need to look for them.
+            self._ids.append(chunk_id)
+            return
+        if chunk_id in self._pending or self._find(chunk_id) is not None:
+            return
+        self._pending.add(chunk_id)
+        if len(self._pending) >= max(self._min_pending, len(self._ids) / 16):
+            self._merge_pending()
+
+    def update(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            self.add(chunk_id)
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        edits = []
+        for chunk_id in sorted(self._pending):
+            i = self._ids.bisect_left(chunk_id)
+            if edits and edits[-1][0] == i:
+                edits[-1][2].append(chunk_id)
+            else:
+                edits.append((i, 0, [chunk_id]))
+        self._ids = self._ids.edit(edits)
+        self._pending = set()
+
+    def difference_update(self, chunk_ids):
+        self._merge_pending()
+        positions = set()
+        for chunk_id in chunk_ids:
+            if self._is_int_id(chunk_id):
+                i = self._find(chunk_id)
+                if i is not None:
+                    positions.add(i)
+            else:
+                self._others.discard(chunk_id)
+        if positions:
+            self._ids = self._ids.edit([(i, 1, []) for i in sorted(positions)])
+
+    def copy(self):
+        result = ChunkIdSet()
+        result._ids = self._ids.copy()
+        result._pending = set(self._pending)
+        result._others = set(self._others)
+        return result
+
+    def union(self, other):
+        if not isinstance(other, ChunkIdSet):
+            other = ChunkIdSet(other)
+        if len(self) < len(other):
+            result = other.copy()
+            result.update(self)
+        else:
+            result = self.copy()
+            result.update(other)
+        return result
+
+    def difference(self, other):
+        if not isinstance(other, ChunkIdSet):
+            other = ChunkIdSet(other)
+        if len(other) < len(self):
+            result = self.copy()
+            result.difference_update(other)
+        else:
+            result = ChunkIdSet(
+                chunk_id for chunk_id in self if chunk_id not in other)
+        return result
@@ -0,0 +1,100 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import unittest
+
+import obnamlib
+
+
+class Uint64ArrayTests(unittest.TestCase):
+
+    def test_is_empty_initially(self):
+        self.assertEqual(len(obnamlib.Uint64Array()), 0)
+
+    def test_appends_and_indexes(self):
+        a = obnamlib.Uint64Array()
+        for value in [0, 1, obnamlib.MAX_ID]:
+            a.append(value)
+        self.assertEqual(list(a), [0, 1, obnamlib.MAX_ID])
+        self.assertEqual(a[-1], obnamlib.MAX_ID)
+        self.assertRaises(IndexError, lambda: a[3])
+        a[0] = 42
+        self.assertEqual(a[0], 42)
+
+    def test_can_be_searched_with_bisect(self):
+        a = obnamlib.Uint64Array()
+        for value in [10, 20, 30]:
+            a.append(value)
+        self.assertEqual(bisect.bisect_left(a, 20), 1)
+        self.assertEqual(bisect.bisect_left(a, 25), 2)
+        self.assertEqual(a.bisect_left(20), 1)
+        self.assertEqual(a.bisect_left(25), 2)
+        self.assertEqual(a.bisect_left(35), 3)
+
+    def test_edits_copy(self):
+        a = obnamlib.Uint64Array()
+        for value in [1, 2, 3, 4]:
+            a.append(value)
+        b = a.edit([(0, 0, [0]), (1, 2, [5]), (4, 0, [6, 7])])
+        self.assertEqual(list(b), [0, 1, 5, 4, 6, 7])
+        self.assertEqual(list(a), [1, 2, 3, 4])
+
+    def test_round_trips_via_string(self):
+        a = obnamlib.Uint64Array()
+        a.append(12765)
+        self.assertEqual(list(obnamlib.Uint64Array(a.tostring())), [12765])
+
+    def test_string_is_big_endian(self):
+        a = obnamlib.Uint64Array()
+        a.append(1)
+        a.append(obnamlib.MAX_ID)
+        self.assertEqual(a.tostring(), '\0' * 7 + '\1' + '\xff' * 8)
+
+
+class ChunkIdSetTests(unittest.TestCase):
+
+    def test_is_empty_initially(self):
+        s = obnamlib.ChunkIdSet()
+        self.assertEqual(len(s), 0)
+        self.assertFalse(1 in s)
+
+    def test_contains_added_ids_in_order(self):
+        s = obnamlib.ChunkIdSet()
+        s._min_pending = 10
+        ids = [(i * 7919) % 1000 for i in range(1000)] + ['in-tree']
+        s.update(ids)
+        s.update(ids)
+        self.assertEqual(len(s), 1001)
+        for chunk_id in ids:
+            self.assertTrue(chunk_id in s)
+        self.assertFalse(1000 in s)
+        self.assertEqual(list(s), range(1000) + ['in-tree'])
+
+    def test_computes_union(self):
+        a = obnamlib.ChunkIdSet([1, 2, 3])
+        b = obnamlib.ChunkIdSet([3, 4])
+        self.assertEqual(list(a.union(b)), [1, 2, 3, 4])
+        self.assertEqual(list(b.union(a)), [1, 2, 3, 4])
+        self.assertEqual(list(a), [1, 2, 3])
+
+    def test_computes_difference(self):
+        a = obnamlib.ChunkIdSet([1, 2, 3, 'x'])
+        b = obnamlib.ChunkIdSet([2, 'x'])
+        self.assertEqual(list(a.difference(b)), [1, 3])
+        self.assertEqual(list(b.difference(a)), [])
+        self.assertEqual(list(a.difference([1, 2, 3, 4, 5, 'x'])), [])
+        self.assertEqual(len(a), 4)
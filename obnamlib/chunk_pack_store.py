@@ -0,0 +1,438 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import os
+import random
+import threading
+
+import tracing
+
+import obnamlib
+
+
+class ChunkPackIndexError(obnamlib.ObnamError):
+
+    msg = 'Chunk pack index {filename} is corrupt'
+
+
+class ChunkPackIndex(object):
+
+    '''The index of a chunk pack.
+
+    The index maps a slot number to the offset and length of the
+    chunk in the pack's data file. It also knows the name of the data
+    file, which changes when the pack is repacked.
+
+    '''
+
+    magic = 'obnam-chunk-pack-index 1'
+
+    def __init__(self, data_name=''):
+        self.data_name = data_name
+        self.entries = {}
+
+    def live_bytes(self):
+        return sum(length for offset, length in self.entries.itervalues())
+
+    def serialise(self):
+        lines = [self.magic, self.data_name]
+        for slot in sorted(self.entries):
+            offset, length = self.entries[slot]
+            lines.append('%d %d %d' % (slot, offset, length))
+        return ''.join('%s\n' % line for line in lines)
+
+    @classmethod
+    def unserialise(cls, encoded, filename):
+        lines = encoded.splitlines()
+        if len(lines) < 2 or lines[0] != cls.magic:
+            raise ChunkPackIndexError(filename=filename)
+        index = cls(data_name=lines[1])
+        try:
+            for line in lines[2:]:
+                slot, offset, length = [int(x) for x in line.split()]
+                index.entries[slot] = (offset, length)
+        except ValueError:
+            raise ChunkPackIndexError(filename=filename)
+        return index
+
+
+class ChunkPackStore(object):
+
+    '''Store chunks by appending them into large pack files.
+
+    Storing each chunk in its own file is costly when there are many
+    small chunks: lots of inodes, a slow directory scan to find all
+    chunks, and a separate file creation per chunk, which is slow over
+    SFTP. This class instead collects chunks in memory until there's
+    pack_size bytes of them, and then writes them all into one data
+    file, plus an index file that maps each chunk to its offset and
+    length in the data file. Chunks are read by offset.
+
+    Each chunk is filtered (compressed, encrypted) on its own, using
+    the repository-data filters of the RepositoryFS, so that it can
+    be read without reading the rest of the pack. The index file is
+    filtered as a whole.
+
+    A chunk id is the pack number, shifted left by slot_bits, plus the
+    chunk's slot in the pack. Pack numbers are random, and a pack's
+    number is reserved by creating its index file before any chunk id
+    in it is given out.
+
+    Any chunk id can be split into a pack number and a slot, including
+    the random ids of chunks stored in files of their own. To avoid
+    looking for the index of a pack that doesn't exist for each such
+    chunk, the directory where the index would be is listed once, and
+    the pack numbers in it are remembered. A pack made by another
+    process after that is only found when the lookup is refreshed:
+    callers pass refresh=True once they have failed to find the chunk
+    in its own file.
+
+    Data files are never modified. Removing a chunk only removes it
+    from the index. The repack method later rewrites data files with
+    a lot of removed chunks into a new data file, keeping chunk ids.
+
+    Chunks that have not been written yet can be read back, but are
+    lost unless flush is called. Index changes from removing chunks
+    are also only written by flush.
+
+    '''
+
+    slot_bits = 16
+
+    # Largest pack number that keeps chunk ids within 64 bits.
+    max_pack_no = 2**(64 - 16) - 1
+
+    # Number of indexes of other packs to keep cached in memory.
+    max_cached_indexes = 1024
+
+    def __init__(self, fs, dirname, pack_size):
+        self._fs = fs
+        self._dirname = dirname
+        self._pack_size = pack_size
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        self._pack_dirs = {}
+        self._dirty = set()
+        self._start_new_pack()
+
+    def _start_new_pack(self):
+        self._pack_no = None
+        self._blobs = []
+        self._contents = {}
+        self._size = 0
+
+    def _make_chunk_id(self, pack_no, slot):
+        return (pack_no << self.slot_bits) | slot
+
+    def _split_chunk_id(self, chunk_id):
+        if type(chunk_id) not in (int, long) or chunk_id < 0:
+            return None, None
+        return chunk_id >> self.slot_bits, chunk_id & (2**self.slot_bits - 1)
+
+    def _index_filename(self, pack_no):
+        return os.path.join(
+            self._dirname, '%03x' % (pack_no & 0xfff), '%012x.index' % pack_no)
+
+    def _data_filename(self, pack_no, data_name):
+        return os.path.join(self._dirname, '%03x' % (pack_no & 0xfff), data_name)
+
+    def _data_name(self, pack_no, version):
+        return '%012x.%d.pack' % (pack_no, version)
+
+    def _data_version(self, data_name):
+        return int(data_name.split('.')[1])
+
+    def _reserve_pack_no(self):
+        while True:
+            pack_no = random.randint(0, self.max_pack_no)
+            filename = self._index_filename(pack_no)
+            try:
+                self._fs.write_file(filename, ChunkPackIndex().serialise())
+            except OSError, e: # pragma: no cover
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            tracing.trace('reserved chunk pack %x', pack_no)
+            self._remember_pack_no(pack_no, True)
+            return pack_no
+
+    def put_chunk_content(self, data):
+        if self._pack_no is None:
+            self._pack_no = self._reserve_pack_no()
+            self._indexes[self._pack_no] = ChunkPackIndex(
+                data_name=self._data_name(self._pack_no, 0))
+
+        pack_no = self._pack_no
+        index = self._indexes[pack_no]
+        slot = len(self._blobs)
+        blob = self._fs.filter_for_write(self._index_filename(pack_no), data)
+        index.entries[slot] = (self._size, len(blob))
+        self._blobs.append(blob)
+        self._contents[slot] = data
+        self._size += len(blob)
+
+        if (self._size >= self._pack_size or
+            len(self._blobs) >= 2**self.slot_bits):
+            self._write_pending_pack()
+
+        return self._make_chunk_id(pack_no, slot)
+
+    def _write_pending_pack(self):
+        if self._pack_no is None:
+            return
+        pack_no = self._pack_no
+        index = self._indexes[pack_no]
+        tracing.trace(
+            'writing chunk pack %x, %d chunks, %d bytes',
+            pack_no, len(self._blobs), self._size)
+        self._fs.write_file(
+            self._data_filename(pack_no, index.data_name),
+            ''.join(self._blobs),
+            runfilters=False)
+        self._write_index(pack_no, index)
+        self._start_new_pack()
+
+    def _write_index(self, pack_no, index):
+        filename = self._index_filename(pack_no)
+        if index.entries:
+            self._fs.overwrite_file(filename, index.serialise())
+        else:
+            data_filename = self._data_filename(pack_no, index.data_name)
+            if self._fs.exists(data_filename):
+                self._fs.remove(data_filename)
+            self._fs.remove(filename)
+            self._indexes[pack_no] = None
+            self._remember_pack_no(pack_no, False)
+        self._dirty.discard(pack_no)
+
+    def flush(self):
+        '''Write pending chunks and index changes to the repository.'''
+        self._write_pending_pack()
+        for pack_no in list(self._dirty):
+            self._write_index(pack_no, self._indexes[pack_no])
+
+    def discard(self):
+        '''Drop pending chunks and index changes.
+
+        The index file that reserves the pack number of the pending
+        chunks is removed.
+
+        '''
+
+        if self._pack_no is not None:
+            tracing.trace('discarding chunk pack %x', self._pack_no)
+            self._fs.remove(self._index_filename(self._pack_no))
+            self._remember_pack_no(self._pack_no, False)
+            with self._indexes_lock:
+                del self._indexes[self._pack_no]
+            self._start_new_pack()
+        with self._indexes_lock:
+            for pack_no in self._dirty:
+                self._indexes.pop(pack_no, None)
+        self._dirty.clear()
+
+    def _pack_dir(self, pack_no):
+        return os.path.dirname(self._index_filename(pack_no))
+
+    def _list_pack_nos(self, dirname):
+        try:
+            basenames = self._fs.listdir(dirname)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            return set()
+        return set(
+            int(basename[:-len('.index')], 16)
+            for basename in basenames
+            if basename.endswith('.index'))
+
+    def _pack_exists(self, pack_no, refresh):
+        if pack_no == self._pack_no:
+            return True
+        dirname = self._pack_dir(pack_no)
+        with self._indexes_lock:
+            pack_nos = self._pack_dirs.get(dirname)
+        if pack_nos is None or refresh:
+            pack_nos = self._list_pack_nos(dirname)
+            with self._indexes_lock:
+                self._pack_dirs[dirname] = pack_nos
+        return pack_no in pack_nos
+
+    def _remember_pack_no(self, pack_no, exists):
+        with self._indexes_lock:
+            pack_nos = self._pack_dirs.get(self._pack_dir(pack_no))
+            if pack_nos is not None:
+                if exists:
+                    pack_nos.add(pack_no)
+                else:
+                    pack_nos.discard(pack_no)
+
+    def _get_index(self, pack_no, reload=False):
+        # Chunks may be read by several threads at once, so the cache
+        # of indexes is only touched with the lock held. The index file
+        # is read without it, and the index is returned from a local
+        # variable, since another thread may drop it from the cache.
+        #
+        # An index with removals that haven't been flushed yet is never
+        # reloaded, since that would lose the removals.
+        with self._indexes_lock:
+            if pack_no == self._pack_no or pack_no in self._dirty:
+                return self._indexes[pack_no]
+            if not reload and pack_no in self._indexes:
+                return self._indexes[pack_no]
+
+        filename = self._index_filename(pack_no)
+        try:
+            encoded = self._fs.cat(filename)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            index = None
+        else:
+            index = ChunkPackIndex.unserialise(encoded, filename)
+
+        with self._indexes_lock:
+            if len(self._indexes) >= self.max_cached_indexes:
+                self._forget_clean_indexes()
+            self._indexes[pack_no] = index
+        return index
+
+    def _forget_clean_indexes(self):
+        for pack_no in self._indexes.keys():
+            if pack_no != self._pack_no and pack_no not in self._dirty:
+                del self._indexes[pack_no]
+
+    def _lookup(self, chunk_id, refresh):
+        pack_no, slot = self._split_chunk_id(chunk_id)
+        if pack_no is None or not self._pack_exists(pack_no, refresh):
+            return None, None, None
+        index = self._get_index(pack_no, reload=refresh)
+        if index is None or slot not in index.entries:
+            return None, None, None
+        return pack_no, slot, index
+
+    def has_chunk(self, chunk_id, refresh=False):
+        pack_no, slot, index = self._lookup(chunk_id, refresh)
+        return index is not None
+
+    def get_chunk_content(self, chunk_id, refresh=False):
+        '''Return chunk content, or None if the chunk is not in a pack.'''
+
+        pack_no, slot, index = self._lookup(chunk_id, refresh)
+        if index is None:
+            return None
+        if pack_no == self._pack_no:
+            return self._contents[slot]
+
+        try:
+            return self._read_chunk(pack_no, slot, index)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The pack may have been repacked since we read its index.
+            index = self._get_index(pack_no, reload=True)
+            if index is None or slot not in index.entries:
+                return None
+            return self._read_chunk(pack_no, slot, index)
+
+    def _read_chunk(self, pack_no, slot, index):
+        offset, length = index.entries[slot]
+        return self._fs.cat_range(
+            self._data_filename(pack_no, index.data_name), offset, length)
+
+    def remove_chunk(self, chunk_id, refresh=False):
+        '''Remove a chunk; return False if it is not in a pack.'''
+
+        pack_no, slot, index = self._lookup(chunk_id, refresh)
+        if index is None:
+            return False
+        del index.entries[slot]
+        if pack_no == self._pack_no:
+            del self._contents[slot]
+        else:
+            self._dirty.add(pack_no)
+        return True
+
+    def _find_pack_nos(self):
+        if self._fs.exists(self._dirname):
+            for pathname in self._fs.scan_files(self._dirname):
+                basename = os.path.basename(pathname)
+                if basename.endswith('.index'):
+                    yield int(basename[:-len('.index')], 16)
+
+    def get_chunk_ids(self):
+        for pack_no in self._find_pack_nos():
+            if pack_no != self._pack_no:
+                index = self._get_index(pack_no)
+                if index is not None:
+                    for slot in index.entries:
+                        yield self._make_chunk_id(pack_no, slot)
+        if self._pack_no is not None:
+            for slot in self._indexes[self._pack_no].entries:
+                yield self._make_chunk_id(self._pack_no, slot)
+
+    def repack(self, min_live_ratio):
+        '''Rewrite packs where much of the data is in removed chunks.
+
+        A pack is rewritten if the chunks still in it use less than
+        min_live_ratio of its data file. Return the number of packs
+        that were rewritten.
+
+        '''
+
+        self.flush()
+        count = 0
+        for pack_no in list(self._find_pack_nos()):
+            index = self._get_index(pack_no, reload=True)
+            if index is None or not index.data_name:
+                continue
+            data_filename = self._data_filename(pack_no, index.data_name)
+            if not self._fs.exists(data_filename):
+                continue
+            total = self._fs.lstat(data_filename).st_size
+            if index.live_bytes() >= min_live_ratio * total:
+                continue
+            self._repack_one(pack_no, index)
+            count += 1
+        return count
+
+    def _repack_one(self, pack_no, index):
+        tracing.trace('repacking chunk pack %x', pack_no)
+        old_filename = self._data_filename(pack_no, index.data_name)
+        new_index = ChunkPackIndex(
+            data_name=self._data_name(
+                pack_no, self._data_version(index.data_name) + 1))
+
+        blobs = []
+        size = 0
+        for slot in sorted(index.entries):
+            offset, length = index.entries[slot]
+            blob = self._fs.cat_range(
+                old_filename, offset, length, runfilters=False)
+            blobs.append(blob)
+            new_index.entries[slot] = (size, length)
+            size += length
+
+        if new_index.entries:
+            self._fs.write_file(
+                self._data_filename(pack_no, new_index.data_name),
+                ''.join(blobs),
+                runfilters=False)
+        self._indexes[pack_no] = new_index
+        self._write_index(pack_no, new_index)
+        if self._fs.exists(old_filename):
+            self._fs.remove(old_filename)
@@ -0,0 +1,165 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import obnamlib
+
+
+class DeflateFilter(object):
+
+    tag = 'deflate'
+
+    def filter_read(self, data, repo, toplevel):
+        return zlib.decompress(data)
+
+    def filter_write(self, data, repo, toplevel):
+        return zlib.compress(data)
+
+
+class ChunkPackIndexTests(unittest.TestCase):
+
+    def test_round_trips(self):
+        index = obnamlib.ChunkPackIndex(data_name='foo.0.pack')
+        index.entries = {0: (0, 10), 1: (10, 20)}
+        copy = obnamlib.ChunkPackIndex.unserialise(index.serialise(), 'x')
+        self.assertEqual(copy.data_name, 'foo.0.pack')
+        self.assertEqual(copy.entries, index.entries)
+        self.assertEqual(copy.live_bytes(), 30)
+
+    def test_raises_error_for_garbage(self):
+        self.assertRaises(
+            obnamlib.ChunkPackIndexError,
+            obnamlib.ChunkPackIndex.unserialise, 'garbage', 'x')
+
+
+class ChunkPackStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.hooks = obnamlib.HookManager()
+        self.hooks.new_filter('repository-data')
+        self.hooks.add_callback('repository-data', DeflateFilter())
+        self.fs = obnamlib.RepositoryFS(
+            None, obnamlib.LocalFS(self.tempdir), self.hooks)
+        self.store = self.new_store()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_store(self):
+        return obnamlib.ChunkPackStore(self.fs, 'chunks/packs', 100)
+
+    def put_chunks(self, count):
+        return [
+            self.store.put_chunk_content('chunk %d' % i * 10)
+            for i in range(count)]
+
+    def test_reads_back_pending_chunk(self):
+        chunk_id = self.store.put_chunk_content('foo')
+        self.assertEqual(self.store.get_chunk_content(chunk_id), 'foo')
+
+    def test_reads_back_chunks_after_flush(self):
+        chunk_ids = self.put_chunks(10)
+        self.store.flush()
+        store = self.new_store()
+        for i, chunk_id in enumerate(chunk_ids):
+            self.assertEqual(
+                store.get_chunk_content(chunk_id), 'chunk %d' % i * 10)
+
+    def test_forgets_unflushed_chunks(self):
+        chunk_id = self.store.put_chunk_content('foo')
+        self.assertEqual(self.new_store().get_chunk_content(chunk_id), None)
+
+    def test_lists_all_chunk_ids(self):
+        chunk_ids = self.put_chunks(10)
+        self.assertEqual(set(self.store.get_chunk_ids()), set(chunk_ids))
+
+    def test_removes_chunk(self):
+        chunk_ids = self.put_chunks(10)
+        self.store.flush()
+        self.assertTrue(self.store.remove_chunk(chunk_ids[0]))
+        self.store.flush()
+        store = self.new_store()
+        self.assertFalse(store.has_chunk(chunk_ids[0]))
+        self.assertFalse(store.remove_chunk(chunk_ids[0]))
+        self.assertEqual(set(store.get_chunk_ids()), set(chunk_ids[1:]))
+
+    def test_repack_keeps_chunk_ids(self):
+        chunk_ids = self.put_chunks(10)
+        self.store.flush()
+        for chunk_id in chunk_ids[::2]:
+            self.store.remove_chunk(chunk_id)
+        self.assertTrue(self.store.repack(0.9) > 0)
+        store = self.new_store()
+        self.assertEqual(set(store.get_chunk_ids()), set(chunk_ids[1::2]))
+        for i in range(1, 10, 2):
+            self.assertEqual(
+                store.get_chunk_content(chunk_ids[i]), 'chunk %d' % i * 10)
+
+    def test_repack_leaves_full_packs_alone(self):
+        self.put_chunks(10)
+        self.assertEqual(self.store.repack(0.5), 0)
+
+    def test_lists_pack_directory_once_for_chunks_not_in_packs(self):
+        self.put_chunks(1)
+        self.store.flush()
+        store = self.new_store()
+        calls = []
+
+        def cat(filename, **kwargs):
+            calls.append(('cat', filename))
+
+        def listdir(dirname):
+            calls.append(('listdir', dirname))
+            return []
+        self.fs.cat = cat
+        self.fs.listdir = listdir
+
+        for pack_no in range(10):
+            chunk_id = store._make_chunk_id(pack_no << 12, 0)
+            self.assertEqual(store.get_chunk_content(chunk_id), None)
+        self.assertEqual(calls, [('listdir', 'chunks/packs/000')])
+
+    def test_finds_new_pack_when_refreshed(self):
+        chunk_ids = self.put_chunks(1)
+        self.store.flush()
+        store = self.new_store()
+        pack_no, slot = store._split_chunk_id(chunk_ids[0])
+        store._pack_dirs[store._pack_dir(pack_no)] = set()
+        self.assertFalse(store.has_chunk(chunk_ids[0]))
+        self.assertTrue(store.has_chunk(chunk_ids[0], refresh=True))
+
+    def test_refreshing_keeps_unflushed_removals(self):
+        chunk_ids = self.put_chunks(10)
+        self.store.flush()
+        store = self.new_store()
+        store.remove_chunk(chunk_ids[0])
+        store.remove_chunk(chunk_ids[1])
+        self.assertFalse(store.remove_chunk(chunk_ids[1], refresh=True))
+        store.flush()
+        store = self.new_store()
+        self.assertFalse(store.has_chunk(chunk_ids[0]))
+        self.assertFalse(store.has_chunk(chunk_ids[1]))
+
+    def test_discard_forgets_pending_chunks(self):
+        chunk_ids = self.put_chunks(1)
+        self.store.discard()
+        self.assertFalse(self.store.has_chunk(chunk_ids[0]))
+        self.assertEqual(list(self.new_store().get_chunk_ids()), [])
@@ -0,0 +1,211 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+
+import obnamlib
+
+
+class ChunkRefsError(obnamlib.ObnamError):
+
+    msg = 'Chunk reference data is corrupt'
+
+
+class ChunkRefs(object):
+
+    '''Remember which generations of a client use which chunks.
+
+    For each chunk, this keeps the ranges of generation numbers in
+    which the chunk is used: from the generation that started using
+    it, to the last one that used it. A range is open if the chunk is
+    still used by the latest generation.
+
+    A new generation starts as a copy of the latest one, so a chunk
+    is used by every generation within its ranges. Adding a generation
+    only requires knowing which chunks it started or stopped using.
+    When a generation is removed, the caller tells which of its chunks
+    might now be unused, and this tells which of them really are.
+    Neither needs the chunks of all generations.
+
+    The generations are also remembered, so that the caller can tell
+    if the references are out of date.
+
+    The ranges are kept in three Uint64Arrays, one row per range,
+    sorted by chunk id: 24 bytes per range. Changed chunks are kept in
+    a dict until there are enough of them to rebuild the arrays.
+
+    '''
+
+    magic = 'obnam-chunk-refs 2'
+
+    # The last generation of an open range.
+    _open = obnamlib.MAX_ID
+
+    _min_changes = 64 * 1024
+
+    def __init__(self):
+        self.generations = []
+        self._ids = obnamlib.Uint64Array()
+        self._firsts = obnamlib.Uint64Array()
+        self._lasts = obnamlib.Uint64Array()
+
+        # Map chunk id to a tuple of its ranges, flattened into first
+        # and last generation of each range, for chunks that changed
+        # since the arrays were rebuilt.
+        self._changes = {}
+
+    def _find_rows(self, chunk_id):
+        i = self._ids.bisect_left(chunk_id)
+        j = i
+        while j < len(self._ids) and self._ids[j] == chunk_id:
+            j += 1
+        return i, j
+
+    def _get_ranges(self, chunk_id):
+        if chunk_id in self._changes:
+            return self._changes[chunk_id]
+        i, j = self._find_rows(chunk_id)
+        ranges = ()
+        for k in xrange(i, j):
+            ranges += (self._firsts[k], self._lasts[k])
+        return ranges
+
+    def _set_ranges(self, chunk_id, ranges):
+        self._changes[chunk_id] = ranges
+        if len(self._changes) >= max(self._min_changes, len(self._ids) / 16):
+            self._rebuild()
+
+    def _rebuild(self):
+        id_edits = []
+        first_edits = []
+        last_edits = []
+        for chunk_id in sorted(self._changes):
+            ranges = self._changes[chunk_id]
+            i, j = self._find_rows(chunk_id)
+            id_edits.append((i, j - i, [chunk_id] * (len(ranges) / 2)))
+            first_edits.append((i, j - i, list(ranges[0::2])))
+            last_edits.append((i, j - i, list(ranges[1::2])))
+        self._ids = self._ids.edit(id_edits)
+        self._firsts = self._firsts.edit(first_edits)
+        self._lasts = self._lasts.edit(last_edits)
+        self._changes = {}
+
+    def add_generation(self, gen_number, started, stopped):
+        '''Add a new latest generation.
+
+        started is the chunks it uses that the previous latest
+        generation didn't use, and stopped is the chunks that the
+        previous latest generation used, but this one doesn't.
+
+        '''
+
+        if self.generations:
+            previous = self.generations[-1]
+            for chunk_id in stopped:
+                ranges = self._get_ranges(chunk_id)
+                if ranges and ranges[-1] == self._open:
+                    self._set_ranges(chunk_id, ranges[:-1] + (previous,))
+        for chunk_id in started:
+            self._set_ranges(
+                chunk_id,
+                self._get_ranges(chunk_id) + (gen_number, self._open))
+        self.generations.append(gen_number)
+
+    def get_chunks_used_by_latest(self):
+        '''Return the chunks used by the latest generation.'''
+        self._rebuild()
+        result = obnamlib.ChunkIdSet()
+        for i, last in enumerate(self._lasts):
+            if last == self._open:
+                result.add(self._ids[i])
+        return result
+
+    def is_used(self, chunk_id):
+        '''Is a chunk used by any generation?'''
+        ranges = self._get_ranges(chunk_id)
+        for first, last in zip(ranges[0::2], ranges[1::2]):
+            i = bisect.bisect_left(self.generations, first)
+            if i < len(self.generations) and self.generations[i] <= last:
+                return True
+        return False
+
+    def remove_generation(self, gen_number, chunk_ids, started=(),
+                          stopped=()):
+        '''Remove a generation.
+
+        chunk_ids is the chunks the generation uses that might not be
+        used by any other generation. If the generation is the latest
+        one, started must be the chunks the next latest generation uses
+        that the removed one didn't, and stopped the chunks the removed
+        one used that the next latest one doesn't.
+
+        Return the chunks in chunk_ids that no generation uses any
+        more. They're forgotten.
+
+        '''
+
+        was_latest = self.generations[-1] == gen_number
+        self.generations.remove(gen_number)
+
+        if was_latest:
+            for chunk_id in stopped:
+                ranges = self._get_ranges(chunk_id)
+                if ranges and ranges[-1] == self._open:
+                    self._set_ranges(chunk_id, ranges[:-2])
+            if self.generations:
+                latest = self.generations[-1]
+                for chunk_id in started:
+                    ranges = self._get_ranges(chunk_id)
+                    if ranges and ranges[-1] == latest:
+                        self._set_ranges(
+                            chunk_id, ranges[:-1] + (self._open,))
+
+        unused = []
+        for chunk_id in chunk_ids:
+            if not self.is_used(chunk_id):
+                self._set_ranges(chunk_id, ())
+                unused.append(chunk_id)
+        return unused
+
+    def serialise(self):
+        self._rebuild()
+        header = '%s\n%s\n' % (
+            self.magic, ' '.join(str(n) for n in self.generations))
+        return ''.join([
+            header,
+            self._ids.tostring(),
+            self._firsts.tostring(),
+            self._lasts.tostring(),
+        ])
+
+    @classmethod
+    def unserialise(cls, encoded):
+        magic, sep, rest = encoded.partition('\n')
+        generations, sep, rows = rest.partition('\n')
+        if magic != cls.magic or not sep or len(rows) % 24 != 0:
+            raise ChunkRefsError()
+        try:
+            gen_numbers = [int(x) for x in generations.split()]
+        except ValueError:
+            raise ChunkRefsError()
+
+        size = len(rows) / 3
+        refs = cls()
+        refs.generations = gen_numbers
+        refs._ids = obnamlib.Uint64Array(rows[:size])
+        refs._firsts = obnamlib.Uint64Array(rows[size:2*size])
+        refs._lasts = obnamlib.Uint64Array(rows[2*size:])
+        return refs
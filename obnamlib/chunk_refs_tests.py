@@ -0,0 +1,77 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class ChunkRefsTests(unittest.TestCase):
+
+    def setUp(self):
+        # Generation 1 uses chunks 1 and 2, generation 2 uses 2 and 3,
+        # generation 3 uses 1 and 3.
+        self.refs = obnamlib.ChunkRefs()
+        self.refs.add_generation(1, [1, 2], [])
+        self.refs.add_generation(2, [3], [1])
+        self.refs.add_generation(3, [1], [2])
+
+    def test_is_empty_initially(self):
+        refs = obnamlib.ChunkRefs()
+        self.assertEqual(refs.generations, [])
+        self.assertFalse(refs.is_used(1))
+
+    def test_knows_chunks_used_by_latest_generation(self):
+        self.assertEqual(self.refs.generations, [1, 2, 3])
+        self.assertEqual(list(self.refs.get_chunks_used_by_latest()), [1, 3])
+
+    def test_removing_generation_returns_chunks_nothing_else_uses(self):
+        self.assertEqual(self.refs.remove_generation(2, [2, 3]), [])
+        self.assertEqual(self.refs.remove_generation(1, [1, 2]), [2])
+        self.assertFalse(self.refs.is_used(2))
+        self.assertTrue(self.refs.is_used(1))
+        self.assertTrue(self.refs.is_used(3))
+
+    def test_removing_latest_generation_reopens_previous_one(self):
+        self.assertEqual(self.refs.remove_generation(3, [1, 3], [2], [1]), [])
+        self.assertEqual(list(self.refs.get_chunks_used_by_latest()), [2, 3])
+        self.refs.add_generation(4, [4], [2, 3])
+        self.assertEqual(self.refs.remove_generation(2, [2, 3]), [3])
+        self.assertEqual(self.refs.remove_generation(1, [1, 2]), [1, 2])
+        self.assertEqual(self.refs.remove_generation(4, [4]), [4])
+        self.assertEqual(list(self.refs.get_chunks_used_by_latest()), [])
+
+    def test_remembers_many_chunks(self):
+        refs = obnamlib.ChunkRefs()
+        refs._min_changes = 10
+        refs.add_generation(1, range(100), [])
+        refs.add_generation(2, range(100, 200), range(50))
+        self.assertEqual(
+            list(refs.get_chunks_used_by_latest()), range(50, 200))
+        self.assertEqual(refs.remove_generation(1, range(50)), range(50))
+        self.assertTrue(refs.is_used(50))
+
+    def test_round_trips(self):
+        refs = obnamlib.ChunkRefs.unserialise(self.refs.serialise())
+        self.assertEqual(refs.generations, [1, 2, 3])
+        self.assertEqual(list(refs.get_chunks_used_by_latest()), [1, 3])
+        self.assertEqual(refs.remove_generation(1, [1, 2]), [])
+        self.assertEqual(refs.remove_generation(2, [2, 3]), [2])
+
+    def test_unserialise_raises_error_for_garbage(self):
+        self.assertRaises(
+            obnamlib.ChunkRefsError,
+            obnamlib.ChunkRefs.unserialise, 'this is garbage')
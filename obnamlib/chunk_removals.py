@@ -0,0 +1,126 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import obnamlib
+
+
+class ChunkRemovalsError(obnamlib.ObnamError):
+
+    msg = 'Pending chunk removal data is corrupt'
+
+
+class ChunkRemovals(object):
+
+    '''Remember chunks that are to be removed later.
+
+    When removing generations leaves chunks unused, they aren't
+    removed right away, since a backup running at the same time may
+    have found them in the chunk indexes and be about to use them.
+    Instead, they're marked for removal, with the time they were
+    marked. A backup that puts a marked chunk into the chunk indexes
+    revives it. Chunks that were marked long enough ago, and haven't
+    been revived, can then be removed.
+
+    Chunks marked at the same time are kept together, in a ChunkIdSet.
+    Revived chunks are collected in a set, and taken out of the marked
+    ones only when needed, so that reviving is cheap.
+
+    '''
+
+    magic = 'obnam-chunk-removals 1'
+
+    def __init__(self):
+        # List of (timestamp, ChunkIdSet) pairs, oldest first.
+        self._batches = []
+        self._revived = set()
+
+    def __len__(self):
+        self._apply_revived()
+        return sum(len(chunk_ids) for timestamp, chunk_ids in self._batches)
+
+    def __contains__(self, chunk_id):
+        if chunk_id in self._revived:
+            return False
+        for timestamp, chunk_ids in self._batches:
+            if chunk_id in chunk_ids:
+                return True
+        return False
+
+    def _apply_revived(self):
+        if self._revived:
+            for timestamp, chunk_ids in self._batches:
+                chunk_ids.difference_update(self._revived)
+            self._batches = [
+                (timestamp, chunk_ids)
+                for timestamp, chunk_ids in self._batches
+                if len(chunk_ids) > 0]
+            self._revived = set()
+
+    def mark(self, chunk_ids, timestamp):
+        '''Mark chunks for removal at a given time.'''
+        self._apply_revived()
+        chunk_ids = obnamlib.ChunkIdSet(
+            chunk_id for chunk_id in chunk_ids
+            if type(chunk_id) in (int, long))
+        if len(chunk_ids) > 0:
+            self._batches.append((timestamp, chunk_ids))
+            self._batches.sort(key=lambda batch: batch[0])
+
+    def revive(self, chunk_id):
+        '''Don't remove a chunk after all.'''
+        if chunk_id in self:
+            self._revived.add(chunk_id)
+
+    def take_expired(self, timestamp):
+        '''Return and forget chunks marked at or before timestamp.'''
+        self._apply_revived()
+        expired = obnamlib.ChunkIdSet()
+        while self._batches and self._batches[0][0] <= timestamp:
+            batch_timestamp, chunk_ids = self._batches.pop(0)
+            expired = expired.union(chunk_ids)
+        return expired
+
+    def serialise(self):
+        self._apply_revived()
+        parts = [self.magic + '\n']
+        for timestamp, chunk_ids in self._batches:
+            ids = obnamlib.Uint64Array()
+            for chunk_id in chunk_ids:
+                ids.append(chunk_id)
+            parts.append('%d %d\n' % (timestamp, len(ids)))
+            parts.append(ids.tostring())
+        return ''.join(parts)
+
+    @classmethod
+    def unserialise(cls, encoded):
+        magic, sep, rest = encoded.partition('\n')
+        if magic != cls.magic or not sep:
+            raise ChunkRemovalsError()
+
+        removals = cls()
+        while rest:
+            line, sep, rest = rest.partition('\n')
+            try:
+                timestamp, count = [int(x) for x in line.split()]
+            except ValueError:
+                raise ChunkRemovalsError()
+            size = count * 8
+            if not sep or len(rest) < size:
+                raise ChunkRemovalsError()
+            ids = obnamlib.Uint64Array(rest[:size])
+            removals._batches.append((timestamp, obnamlib.ChunkIdSet(ids)))
+            rest = rest[size:]
+        return removals
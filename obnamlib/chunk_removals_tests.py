@@ -0,0 +1,79 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class ChunkRemovalsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.removals = obnamlib.ChunkRemovals()
+        self.removals.mark([1, 2], 100)
+        self.removals.mark([3], 200)
+
+    def test_is_empty_initially(self):
+        removals = obnamlib.ChunkRemovals()
+        self.assertEqual(len(removals), 0)
+        self.assertEqual(list(removals.take_expired(1000)), [])
+
+    def test_remembers_marked_chunks(self):
+        self.assertEqual(len(self.removals), 3)
+        self.assertTrue(2 in self.removals)
+        self.assertFalse(4 in self.removals)
+
+    def test_ignores_in_tree_chunk_ids(self):
+        self.removals.mark(['in-tree'], 300)
+        self.assertEqual(len(self.removals), 3)
+
+    def test_takes_only_expired_chunks(self):
+        self.assertEqual(list(self.removals.take_expired(99)), [])
+        self.assertEqual(list(self.removals.take_expired(150)), [1, 2])
+        self.assertEqual(list(self.removals.take_expired(150)), [])
+        self.assertEqual(list(self.removals.take_expired(200)), [3])
+        self.assertEqual(len(self.removals), 0)
+
+    def test_does_not_take_revived_chunks(self):
+        self.removals.revive(1)
+        self.removals.revive(4)
+        self.assertFalse(1 in self.removals)
+        self.assertEqual(list(self.removals.take_expired(1000)), [2, 3])
+
+    def test_marks_revived_chunk_again(self):
+        self.removals.revive(1)
+        self.removals.mark([1], 300)
+        self.assertEqual(list(self.removals.take_expired(200)), [2, 3])
+        self.assertEqual(list(self.removals.take_expired(300)), [1])
+
+    def test_round_trips(self):
+        self.removals.revive(2)
+        removals = obnamlib.ChunkRemovals.unserialise(
+            self.removals.serialise())
+        self.assertEqual(len(removals), 2)
+        self.assertEqual(list(removals.take_expired(100)), [1])
+        self.assertEqual(list(removals.take_expired(200)), [3])
+
+    def test_unserialise_raises_error_for_garbage(self):
+        self.assertRaises(
+            obnamlib.ChunkRemovalsError,
+            obnamlib.ChunkRemovals.unserialise, 'this is garbage')
+
+    def test_unserialise_raises_error_for_truncated_data(self):
+        encoded = self.removals.serialise()
+        self.assertRaises(
+            obnamlib.ChunkRemovalsError,
+            obnamlib.ChunkRemovals.unserialise, encoded[:-1])
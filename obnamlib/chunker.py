@@ -0,0 +1,85 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import obnamlib
+
+
+class FixedSizeChunker(object):
+
+    '''Split the data in a file into chunks of a fixed size.
+
+    The last chunk may be shorter.
+
+    '''
+
+    def __init__(self, f, chunk_size):
+        self._f = f
+        self._chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            data = self._f.read(self._chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class ContentDefinedChunker(object):
+
+    '''Split the data in a file into chunks at content-defined places.
+
+    Chunk boundaries are found using a rolling checksum, computed by
+    the _obnam extension. This means that inserting or removing data
+    in the middle of a file only changes the chunks near the change,
+    and the rest of the chunks can be de-duplicated against an older
+    version of the file.
+
+    Chunks are at least min_size and at most max_size bytes long,
+    except the last one, which may be shorter. On average, they are
+    somewhat shorter than avg_size.
+
+    '''
+
+    def __init__(self, f, min_size, avg_size, max_size):
+        self._f = f
+        self._min_size = min_size
+        self._avg_size = avg_size
+        self._max_size = max(max_size, min_size, 1)
+
+    def __iter__(self):
+        buf = ''
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < self._max_size:
+                buf, pos, eof = self._fill(buf[pos:])
+            if pos >= len(buf):
+                break
+            n = obnamlib._obnam.find_chunk_boundary(
+                buf, pos, self._min_size, self._avg_size, self._max_size)
+            yield buf[pos:pos+n]
+            pos += n
+
+    def _fill(self, remaining):
+        parts = [remaining]
+        size = len(remaining)
+        while size < self._max_size:
+            data = self._f.read(self._max_size)
+            if not data:
+                return ''.join(parts), 0, True
+            parts.append(data)
+            size += len(data)
+        return ''.join(parts), 0, False
@@ -0,0 +1,92 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import StringIO
+import unittest
+
+import obnamlib
+
+
+class FixedSizeChunkerTests(unittest.TestCase):
+
+    def chunks(self, data, chunk_size):
+        f = StringIO.StringIO(data)
+        return list(obnamlib.FixedSizeChunker(f, chunk_size))
+
+    def test_returns_nothing_for_empty_file(self):
+        self.assertEqual(self.chunks('', 3), [])
+
+    def test_returns_chunks_of_given_size(self):
+        self.assertEqual(self.chunks('abcdefgh', 3), ['abc', 'def', 'gh'])
+
+
+class ContentDefinedChunkerTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.data = ''.join(chr(rng.randint(0, 255)) for i in range(64*1024))
+
+    def chunks(self, data, min_size=256, avg_size=1024, max_size=4096):
+        f = StringIO.StringIO(data)
+        return list(obnamlib.ContentDefinedChunker(
+            f, min_size, avg_size, max_size))
+
+    def test_returns_nothing_for_empty_file(self):
+        self.assertEqual(self.chunks(''), [])
+
+    def test_returns_all_the_data(self):
+        self.assertEqual(''.join(self.chunks(self.data)), self.data)
+
+    def test_returns_short_file_as_single_chunk(self):
+        self.assertEqual(self.chunks('foo'), ['foo'])
+
+    def test_respects_minimum_and_maximum_sizes(self):
+        chunks = self.chunks(self.data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(256 <= len(chunk) <= 4096)
+
+    def test_cuts_uniform_data_at_maximum_size(self):
+        chunks = self.chunks('x' * 10000)
+        self.assertEqual([len(c) for c in chunks], [4096, 4096, 1808])
+
+    def test_is_deterministic(self):
+        self.assertEqual(self.chunks(self.data), self.chunks(self.data))
+
+    def test_finds_same_chunks_after_insertion(self):
+        old = self.chunks(self.data)
+        new = self.chunks('inserted' + self.data)
+        self.assertNotEqual(old[0], new[0])
+        self.assertEqual(old[2:], new[2:])
+
+    def boundaries(self, chunks):
+        offsets = []
+        offset = 0
+        for chunk in chunks:
+            offset += len(chunk)
+            offsets.append(offset)
+        return offsets
+
+    def test_keeps_later_boundaries_after_insertion_near_start(self):
+        inserted = 'some inserted bytes'
+        old = self.chunks(self.data)
+        new = self.chunks(self.data[:100] + inserted + self.data[100:])
+        old_boundaries = set(self.boundaries(old))
+        shifted = set(x - len(inserted) for x in self.boundaries(new))
+        later = set(x for x in old_boundaries if x > 8192)
+        self.assertTrue(later)
+        self.assertTrue(later.issubset(shifted))
+        self.assertEqual(old[-len(later):], new[-len(later):])
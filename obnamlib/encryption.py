@@ -14,12 +14,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import fcntl
+import hashlib
+import hmac
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
 import tracing
 
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError: # pragma: no cover
+    AESGCM = None
+
 import obnamlib
 
 
@@ -33,6 +43,17 @@ class GpgError(EncryptionError):
     msg = 'gpg failed with exit code {returncode}:\n{stderr}'
 
 
+class AeadModuleNotFoundError(EncryptionError):
+
+    msg = ('Failed to load module "cryptography", which is needed for '
+           'in-process encryption; try installing python-cryptography')
+
+
+class AeadDecryptionError(EncryptionError):
+
+    msg = 'Decryption failed: data is corrupt, or the key is wrong'
+
+
 def generate_symmetric_key(numbits, filename='/dev/random'):
     '''Generate a random key of at least numbits for symmetric encryption.'''
 
@@ -67,6 +88,55 @@ class SymmetricKeyCache(object):
         self.repos = {}
 
 
+# Starting gpg is serialised with this lock, so that several threads
+# can run gpg at the same time. Without it, a gpg started in one thread
+# may inherit the pipes of a gpg started in another thread, and then
+# the other gpg never sees the end of its input until ours finishes.
+_start_gpg_lock = threading.Lock()
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def _start_gpg(argv, env=None, passphrase=None):
+    '''Start gpg, and return the Popen object and passphrase fd.
+
+    If passphrase is not None, it is given to gpg via a pipe, and the
+    --passphrase-fd option is added to argv. The caller must close
+    the returned file descriptor once gpg has finished.
+
+    '''
+
+    with _start_gpg_lock:
+        keyfd = None
+        if passphrase is not None:
+            # Open pipe for passphrase, and write it there. If
+            # passphrase is very long (more than 4 KiB by default),
+            # this might block. A better implementation would be to
+            # have a loop around select(2) to do pipe I/O when it can
+            # be done without blocking. Patches most welcome.
+            keyfd, writefd = os.pipe()
+            os.write(writefd, passphrase + '\n')
+            os.close(writefd)
+            argv = argv[:1] + ['--passphrase-fd', str(keyfd)] + argv[1:]
+
+        tracing.trace('argv=%s', repr(argv))
+        p = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=env)
+
+        # Our gpg has its copies now. Make sure no gpg started later
+        # gets them.
+        for f in [p.stdin, p.stdout, p.stderr]:
+            _set_cloexec(f.fileno())
+        if keyfd is not None:
+            _set_cloexec(keyfd)
+
+    return p, keyfd
+
+
 def _gpg_pipe(args, data, passphrase):
     '''Pipe things through gpg.
 
@@ -76,30 +146,17 @@ def _gpg_pipe(args, data, passphrase):
     For safety, we give the passphrase to gpg via a file descriptor.
     The argument list is modified to include the relevant options for that.
 
-    The data is fed to gpg via a temporary file, readable only by
-    the owner, to avoid congested pipes.
+    This may be called from several threads at once, to run several
+    gpg processes in parallel.
 
     '''
 
-    # Open pipe for passphrase, and write it there. If passphrase is
-    # very long (more than 4 KiB by default), this might block. A better
-    # implementation would be to have a loop around select(2) to do pipe
-    # I/O when it can be done without blocking. Patches most welcome.
-
-    keypipe = os.pipe()
-    os.write(keypipe[1], passphrase + '\n')
-    os.close(keypipe[1])
-
-    # Actually run gpg.
-
-    argv = ['gpg', '--passphrase-fd', str(keypipe[0]), '-q', '--batch',
-            '--no-textmode'] + args
-    tracing.trace('argv=%s', repr(argv))
-    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    out, err = p.communicate(data)
-
-    os.close(keypipe[0])
+    argv = ['gpg', '-q', '--batch', '--no-textmode'] + args
+    p, keyfd = _start_gpg(argv, passphrase=passphrase)
+    try:
+        out, err = p.communicate(data)
+    finally:
+        os.close(keyfd)
 
     # Return output data, or deal with errors.
     if p.returncode: # pragma: no cover
@@ -118,6 +175,47 @@ def decrypt_symmetric(encrypted, key):
     return _gpg_pipe(['-d'], encrypted, key)
 
 
+# Nonce length for AES-GCM. Nonces are random, and 96 bits is the
+# size for which GCM is specified to work best.
+AEAD_NONCE_BYTES = 12
+
+
+def aead_is_available():
+    '''Can we do in-process encryption?'''
+    return AESGCM is not None
+
+
+def _aead_cipher(key):
+    # The symmetric keys are hex strings of any length, so we derive
+    # a 256-bit AES key from them.
+    if AESGCM is None: # pragma: no cover
+        raise AeadModuleNotFoundError()
+    aes_key = hmac.new(key, 'obnam aes-256-gcm', hashlib.sha256).digest()
+    return AESGCM(aes_key)
+
+
+def encrypt_symmetric_aead(cleartext, key):
+    '''Encrypt data with AES-GCM, in-process.
+
+    This is much faster than encrypt_symmetric, since it doesn't run
+    gpg. The result also protects against modification of the data.
+
+    '''
+
+    nonce = os.urandom(AEAD_NONCE_BYTES)
+    return nonce + _aead_cipher(key).encrypt(nonce, cleartext, None)
+
+
+def decrypt_symmetric_aead(encrypted, key):
+    '''Decrypt data encrypted by encrypt_symmetric_aead.'''
+    nonce = encrypted[:AEAD_NONCE_BYTES]
+    ciphertext = encrypted[AEAD_NONCE_BYTES:]
+    try:
+        return _aead_cipher(key).decrypt(nonce, ciphertext, None)
+    except (InvalidTag, ValueError):
+        raise AeadDecryptionError()
+
+
 def _gpg(args, stdin='', gpghome=None):
     '''Run gpg and return its output.'''
 
@@ -128,9 +226,7 @@ def _gpg(args, stdin='', gpghome=None):
         tracing.trace('gpghome=%s' % gpghome)
 
     argv = ['gpg', '-q', '--batch', '--no-textmode'] + args
-    tracing.trace('argv=%s', repr(argv))
-    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, env=env)
+    p, keyfd = _start_gpg(argv, env=env)
     out, err = p.communicate(stdin)
 
     # Return output data, or deal with errors.
@@ -60,6 +60,52 @@ class SymmetricEncryptionTests(unittest.TestCase):
         decrypted = obnamlib.decrypt_symmetric(encrypted, key)
         self.assertEqual(decrypted, cleartext)
 
+    def test_encrypts_in_parallel_threads(self):
+        key = 'sekr1t'
+        cleartexts = ['hello, world %d' % i for i in range(4)]
+        pipeline = obnamlib.OrderedPipeline(
+            lambda x: obnamlib.encrypt_symmetric(x, key), 4, 4)
+        encrypted = list(pipeline.run(cleartexts))
+        self.assertEqual(
+            [obnamlib.decrypt_symmetric(x, key) for x in encrypted],
+            cleartexts)
+
+
+class AeadEncryptionTests(unittest.TestCase):
+
+    def setUp(self):
+        if not obnamlib.aead_is_available(): # pragma: no cover
+            self.skipTest('cryptography module not installed')
+        self.key = 'sekr1t'
+
+    def test_encrypts_into_different_string_than_cleartext(self):
+        encrypted = obnamlib.encrypt_symmetric_aead('hello world', self.key)
+        self.assertFalse('hello world' in encrypted)
+
+    def test_encrypts_same_data_differently_each_time(self):
+        self.assertNotEqual(
+            obnamlib.encrypt_symmetric_aead('hello world', self.key),
+            obnamlib.encrypt_symmetric_aead('hello world', self.key))
+
+    def test_encrypt_decrypt_round_trip(self):
+        encrypted = obnamlib.encrypt_symmetric_aead('hello, world', self.key)
+        self.assertEqual(
+            obnamlib.decrypt_symmetric_aead(encrypted, self.key),
+            'hello, world')
+
+    def test_decrypting_modified_data_fails(self):
+        encrypted = obnamlib.encrypt_symmetric_aead('hello, world', self.key)
+        modified = encrypted[:-1] + chr(ord(encrypted[-1]) ^ 1)
+        self.assertRaises(
+            obnamlib.AeadDecryptionError,
+            obnamlib.decrypt_symmetric_aead, modified, self.key)
+
+    def test_decrypting_with_wrong_key_fails(self):
+        encrypted = obnamlib.encrypt_symmetric_aead('hello, world', self.key)
+        self.assertRaises(
+            obnamlib.AeadDecryptionError,
+            obnamlib.decrypt_symmetric_aead, encrypted, 'wrong')
+
 
 class SymmetricKeyCacheTests(unittest.TestCase):
 
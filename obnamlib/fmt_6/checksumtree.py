@@ -66,6 +66,54 @@ class ChecksumTree(obnamlib.RepositoryTree):
         else:
             return []
 
+    def checksums(self):
+        '''Generate every checksum in the tree, once each.
+
+        The tree is looked up in parts, by the first two bytes of the
+        checksum, so that only a small part of it is in memory at once.
+
+        '''
+
+        if self.init_forest() and self.forest.trees:
+            t = self.forest.trees[-1]
+            for minkey, maxkey in self._prefix_ranges(t, '', 2):
+                prev = None
+                for key, value in t.lookup_range(minkey, maxkey):
+                    checksum = self.unkey(key)[0]
+                    if checksum != prev:
+                        yield checksum
+                        prev = checksum
+
+    def _prefix_ranges(self, t, prefix, length):
+        # Generate the non-empty key ranges of keys that start with
+        # prefix plus length - len(prefix) more bytes, in order.
+        for i in xrange(256):
+            longer = prefix + chr(i)
+            padding = self.key_bytes - len(longer)
+            minkey = longer + '\0' * padding
+            maxkey = longer + '\xff' * padding
+            if t.range_is_empty(minkey, maxkey):
+                continue
+            if len(longer) < length:
+                for key_range in self._prefix_ranges(t, longer, length):
+                    yield key_range
+            else:
+                yield minkey, maxkey
+
+    def committed_root_id(self):
+        '''Return the root node id of the newest committed tree.
+
+        The id changes whenever the tree is committed, so it tells
+        whether the tree has changed. Return None if there is no tree.
+
+        '''
+
+        if self.init_forest():
+            trees = [t for t in self.forest.trees if t is not self.tree]
+            if trees:
+                return trees[-1].root.id
+        return None
+
     def remove(self, checksum, chunk_id, client_id):
         tracing.trace('checksum=%s', repr(checksum))
         tracing.trace('chunk_id=%s', chunk_id)
@@ -78,3 +78,20 @@ class ChecksumTreeTests(unittest.TestCase):
         self.tree.add(self.checksum, 0, 1)
         self.assertTrue(self.tree.chunk_is_used(self.checksum, 0))
 
+    def test_lists_checksums_once_each_in_order(self):
+        checksums = sorted(
+            hashlib.md5(str(i)).digest() for i in range(100))
+        for i, checksum in enumerate(checksums):
+            self.tree.add(checksum, i, 1)
+            self.tree.add(checksum, i, 2)
+        self.assertEqual(list(self.tree.checksums()), checksums)
+
+    def test_committed_root_id_changes_on_commit(self):
+        self.tree.add(self.checksum, 0, 1)
+        self.tree.commit()
+        root_id = self.tree.committed_root_id()
+        self.assertNotEqual(root_id, None)
+        self.tree.add(self.checksum, 1, 1)
+        self.assertEqual(self.tree.committed_root_id(), root_id)
+        self.tree.commit()
+        self.assertNotEqual(self.tree.committed_root_id(), root_id)
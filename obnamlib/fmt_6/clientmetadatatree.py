@@ -15,6 +15,7 @@
 
 
 import hashlib
+import larch
 import logging
 import os
 import random
@@ -455,6 +456,37 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
             basenames.append(value)
         return basenames
 
+    def listdir_metadata(self, genid, dirname):
+        '''Return (basename, encoded metadata) for each file in a directory.
+
+        This is like calling get_metadata for each file listdir returns,
+        but the file ids come from the directory contents, so there is
+        no need to look up each file's id by its name.
+
+        '''
+
+        tree = self.find_generation(genid)
+        try:
+            dir_id = self.get_file_id(tree, dirname)
+        except KeyError:
+            return []
+        minkey = self.fskey(dir_id, self.DIR_CONTENTS, 0)
+        maxkey = self.fskey(dir_id, self.DIR_CONTENTS, self.SUBKEY_MAX)
+        # Remember the file ids for get_file_id, but only for finished
+        # generations, where they can't change.
+        if tree is self.tree:
+            file_ids = {}
+        else:
+            file_ids = self.file_ids.setdefault(tree, {})
+        result = []
+        for key, basename in tree.lookup_range(minkey, maxkey):
+            parent_id, file_id = self.fs_unkey(key)
+            file_ids[os.path.join(dirname, basename)] = file_id
+            key = self.fskey(
+                file_id, self.FILE_METADATA, self.FILE_METADATA_ENCODED)
+            result.append((basename, tree.lookup(key)))
+        return result
+
     def get_file_chunks(self, genid, filename):
         tree = self.find_generation(genid)
         try:
@@ -528,13 +560,178 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         return not t.range_is_empty(minkey, maxkey)
 
     def list_chunks_in_generation(self, gen_id):
-        '''Return list of chunk ids used in a given generation.'''
+        '''Return a ChunkIdSet of chunk ids used in a given generation.'''
 
         minkey = self.chunk_key(0, 0)
         maxkey = self.chunk_key(obnamlib.MAX_ID, obnamlib.MAX_ID)
         t = self.find_generation(gen_id)
-        return list(set(self.chunk_unkey(key)[0]
-                        for key, value in t.lookup_range(minkey, maxkey)))
+
+        # The keys are sorted by chunk id, so the set can append them
+        # to its array as they come.
+        return obnamlib.ChunkIdSet(
+            self.chunk_unkey(key)[0]
+            for key, value in t.lookup_range(minkey, maxkey))
+
+    def _diff_trees(self, tree1, tree2):
+        '''Generate (key, value1, value2) for keys that differ in two trees.
+
+        value1 is None if the key is only in tree2, and value2 is None
+        if the key is only in tree1.
+
+        Both trees are walked in key order at the same time. Generations
+        are copy-on-write clones of each other, so a node that is in both
+        trees has the same node id in both, and its subtree can be skipped
+        without reading it. Only nodes that differ are read, which makes
+        this proportional to the amount of change between the trees,
+        rather than their size.
+
+        '''
+
+        # Each stack holds the not yet compared parts of a tree, with
+        # the smallest keys last. A part is a (key, node, value) triple:
+        # either a node, with a key no larger than any key in its
+        # subtree, or a single key/value pair, with node set to None.
+
+        def start(tree):
+            if tree.root is None: # pragma: no cover
+                return []
+            return [('', tree.root, None)]
+
+        def expand(tree, stack):
+            key, node, value = stack.pop()
+            if isinstance(node, larch.IndexNode):
+                parts = [(k, tree.node_store.get_node(child_id), None)
+                         for k, child_id in zip(node.keys(), node.values())]
+            else:
+                parts = [(k, None, v)
+                         for k, v in zip(node.keys(), node.values())]
+            stack.extend(reversed(parts))
+
+        stack1 = start(tree1)
+        stack2 = start(tree2)
+        while stack1 and stack2:
+            key1, node1, value1 = stack1[-1]
+            key2, node2, value2 = stack2[-1]
+            if node1 is not None and node2 is not None:
+                if node1.id == node2.id:
+                    stack1.pop()
+                    stack2.pop()
+                else:
+                    if key1 <= key2:
+                        expand(tree1, stack1)
+                    if key2 <= key1:
+                        expand(tree2, stack2)
+            elif node1 is not None:
+                if key1 <= key2:
+                    expand(tree1, stack1)
+                else:
+                    yield key2, None, value2
+                    stack2.pop()
+            elif node2 is not None:
+                if key2 <= key1:
+                    expand(tree2, stack2)
+                else:
+                    yield key1, value1, None
+                    stack1.pop()
+            elif key1 < key2:
+                yield key1, value1, None
+                stack1.pop()
+            elif key2 < key1:
+                yield key2, None, value2
+                stack2.pop()
+            else:
+                if value1 != value2:
+                    yield key1, value1, value2
+                stack1.pop()
+                stack2.pop()
+
+        for tree, stack, in_tree1 in [(tree1, stack1, True),
+                                      (tree2, stack2, False)]:
+            while stack:
+                key, node, value = stack[-1]
+                if node is not None:
+                    expand(tree, stack)
+                else:
+                    stack.pop()
+                    if in_tree1:
+                        yield key, value, None
+                    else:
+                        yield key, None, value
+
+    def diff_generations(self, genid1, genid2):
+        '''Return the files that differ between two generations.
+
+        Return a list of (pathname, change) pairs, sorted by pathname.
+        change is '+' for a file that is only in genid2, '-' for a file
+        that is only in genid1, and '*' for a file whose metadata, chunk
+        list, or data is stored differently in the two generations.
+
+        '''
+
+        tree1 = self.find_generation(genid1)
+        tree2 = self.find_generation(genid2)
+
+        names1 = {}
+        names2 = {}
+        changed = set()
+        for key, value1, value2 in self._diff_trees(tree1, tree2):
+            prefix, file_id, subtype, subkey = struct.unpack('!B8sB8s', key)
+            if prefix != self.PREFIX_FS_META:
+                continue
+            if subtype == self.FILE_NAME and subkey == file_id:
+                # The file's own name key only exists while the file
+                # does, so it tells us if the file was added or removed.
+                if value1 is not None:
+                    names1[file_id] = value1
+                if value2 is not None:
+                    names2[file_id] = value2
+            elif subtype in (self.FILE_CHUNKS, self.FILE_METADATA,
+                             self.FILE_DATA):
+                changed.add(file_id)
+
+        added = set(names2).difference(names1)
+        removed = set(names1).difference(names2)
+        result = [(names2[file_id], '+') for file_id in added]
+        result += [(names1[file_id], '-') for file_id in removed]
+        for file_id in changed.difference(added, removed):
+            key = self.fskey(file_id, self.FILE_NAME, file_id)
+            try:
+                pathname = tree2.lookup(key)
+            except KeyError: # pragma: no cover
+                continue
+            result.append((pathname, '*'))
+        return sorted(result)
+
+    def diff_generation_chunks(self, genid1, genid2):
+        '''Return the chunks used by only one of two generations.
+
+        Return a pair of lists: the chunk ids used by genid2 but not
+        genid1, and those used by genid1 but not genid2. Like
+        diff_generations, this only reads the parts of the B-trees
+        that differ.
+
+        '''
+
+        tree1 = self.find_generation(genid1)
+        tree2 = self.find_generation(genid2)
+
+        chunk_ids = set()
+        for key, value1, value2 in self._diff_trees(tree1, tree2):
+            if struct.unpack('!B', key[0])[0] == self.PREFIX_CHUNK_REF:
+                chunk_ids.add(self.chunk_unkey(key)[0])
+
+        # A chunk ref is for a chunk and a file, so a changed ref only
+        # means the chunk is used by a different set of files.
+        added = []
+        removed = []
+        for chunk_id in chunk_ids:
+            in_use1 = self.chunk_in_use(genid1, chunk_id)
+            in_use2 = self.chunk_in_use(genid2, chunk_id)
+            if in_use2 and not in_use1:
+                added.append(chunk_id)
+            elif in_use1 and not in_use2:
+                removed.append(chunk_id)
+        return added, removed
 
     def set_file_data(self, filename, contents): # pragma: no cover
         '''Store contents of file, if small, in B-tree instead of chunk.
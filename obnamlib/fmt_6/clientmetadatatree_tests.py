@@ -86,6 +86,41 @@ class ClientMetadataTreeTests(unittest.TestCase):
         self.assertFalse(self.client.get_is_checkpoint(genid2))
         self.assertEqual(self.client.list_generations(), [genid1, genid2])
 
+    def test_diffs_generations(self):
+        self.client.start_generation()
+        genid1 = self.client.get_generation_id(self.client.tree)
+        for filename in ['/same', '/changed', '/removed']:
+            self.client.create(filename, self.file_encoded)
+        self.client.commit()
+
+        self.client.start_generation()
+        genid2 = self.client.get_generation_id(self.client.tree)
+        changed = obnamlib.fmt_6.metadata_codec.encode_metadata(
+            obnamlib.Metadata(st_mode=stat.S_IFREG | 0666, st_size=456))
+        self.client.create('/changed', changed)
+        self.client.create('/added', self.file_encoded)
+        self.client.remove('/removed')
+
+        self.assertEqual(
+            self.client.diff_generations(genid1, genid2),
+            [('/added', '+'), ('/changed', '*'), ('/removed', '-')])
+        self.assertEqual(self.client.diff_generations(genid2, genid2), [])
+
+    def test_diffs_generation_chunks(self):
+        self.client.start_generation()
+        genid1 = self.client.get_generation_id(self.client.tree)
+        self.client.set_file_chunks('/foo', [1, 2])
+        self.client.commit()
+
+        self.client.start_generation()
+        genid2 = self.client.get_generation_id(self.client.tree)
+        self.client.set_file_chunks('/foo', [2, 3])
+        self.client.set_file_chunks('/bar', [4])
+
+        added, removed = self.client.diff_generation_chunks(genid1, genid2)
+        self.assertEqual(sorted(added), [3, 4])
+        self.assertEqual(removed, [1])
+
     def test_sets_is_checkpoint(self):
         self.client.start_generation()
         genid = self.client.get_generation_id(self.client.tree)
@@ -227,6 +262,18 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
             self.client.get_metadata(self.clientid, '/foo/bar/baz'),
             self.file_encoded)
 
+    def test_lists_directory_metadata(self):
+        self.client.create('/foo', self.dir_encoded)
+        self.client.create('/foo/foobar', self.file_encoded)
+        self.client.create('/foo/bar', self.dir_encoded)
+        self.assertEqual(
+            sorted(self.client.listdir_metadata(self.clientid, '/foo')),
+            [('bar', self.dir_encoded), ('foobar', self.file_encoded)])
+
+    def test_lists_no_metadata_for_nonexistent_directory(self):
+        self.assertEqual(
+            self.client.listdir_metadata(self.clientid, '/foo'), [])
+
     def test_removes_directory_and_files_and_subdirs(self):
         self.client.create('/foo', self.dir_encoded)
         self.client.create('/foo/foobar', self.file_encoded)
@@ -307,7 +354,8 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
 
     def test_lists_no_chunks_in_generation_initially(self):
         gen_id = self.client.get_generation_id(self.client.tree)
-        self.assertEqual(self.client.list_chunks_in_generation(gen_id), [])
+        self.assertEqual(
+            list(self.client.list_chunks_in_generation(gen_id)), [])
 
     def test_lists_used_chunks_in_generation(self):
         gen_id = self.client.get_generation_id(self.client.tree)
@@ -320,5 +368,6 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
         gen_id = self.client.get_generation_id(self.client.tree)
         self.client.set_file_chunks('/foo', [0])
         self.client.set_file_chunks('/bar', [0])
-        self.assertEqual(self.client.list_chunks_in_generation(gen_id), [0])
+        self.assertEqual(
+            list(self.client.list_chunks_in_generation(gen_id)), [0])
 
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import errno
 import hashlib
 import larch
@@ -21,7 +22,6 @@ import logging
 import os
 import random
 import re
-import stat
 import time
 import tracing
 
@@ -39,8 +39,11 @@ class _OpenClientInfo(object):
         self.locked = False
         self.client = client
         self.current_generation_number = None
+        self.parent_generation_number = None
         self.generations_removed = False
         self.cached_generation_ids = None
+        self.chunk_refs = None
+        self.removed_chunk_ids = obnamlib.ChunkIdSet()
 
 
 class RepositoryFormat6(obnamlib.RepositoryInterface):
@@ -55,6 +58,12 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
                  idpath_depth=obnamlib.IDPATH_DEPTH,
                  idpath_bits=obnamlib.IDPATH_BITS,
                  idpath_skip=obnamlib.IDPATH_SKIP,
+                 chunk_pack_size=0,
+                 filter_workers=0,
+                 upload_buffer_size=0,
+                 file_key_cache_size=obnamlib.DEFAULT_FILE_KEY_CACHE_SIZE,
+                 cache_dir=None,
+                 cache_size=obnamlib.DEFAULT_REPOSITORY_CACHE_SIZE,
                  hooks=None,
                  current_time=None):
 
@@ -66,6 +75,13 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._idpath_depth = idpath_depth
         self._idpath_bits = idpath_bits
         self._idpath_skip = idpath_skip
+        self._chunk_pack_size = chunk_pack_size
+        self._filter_workers = filter_workers
+        self._upload_buffer_size = upload_buffer_size
+        self._file_key_cache_size = max(1, file_key_cache_size)
+        self._cache_dir = cache_dir
+        self._cache_size = cache_size
+        self._cache_fs = None
         self._current_time = current_time or time.time
         self.hooks = hooks
 
@@ -83,23 +99,54 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
 
     def set_fs(self, fs):
         self._real_fs = fs
-        self._fs = obnamlib.RepositoryFS(self, fs, self.hooks)
+        if self._cache_dir:
+            self._cache_fs = obnamlib.CachingFS(
+                fs, self._cache_dir, self._cache_size)
+            fs = self._cache_fs
+        self._fs = obnamlib.RepositoryFS(
+            self, fs, self.hooks, filter_workers=self._filter_workers,
+            upload_buffer_size=self._upload_buffer_size)
         self._lockmgr = obnamlib.LockManager(self._fs, self._lock_timeout, '')
         self._setup_client_list()
         self._setup_client()
         self._setup_chunk_indexes()
+        self._setup_chunk_packs()
 
     def init_repo(self):
         # There is nothing else to be done.
         pass
 
     def close(self):
+        self.log_stats()
         if self._real_fs:
+            # Chunks that went into a pack after the last commit are
+            # not used by anything, so don't leave a pack of them.
+            self._chunk_packs.discard()
+            try:
+                self._fs.flush_queue()
+            except obnamlib.UploadError as e:
+                # Anything committed was written before the commit,
+                # so this is only about data that isn't used.
+                logging.error(str(e))
             self._real_fs.close()
 
+    def log_stats(self):
+        logging.info(
+            'File key cache: hits=%d misses=%d evictions=%d',
+            self._file_key_cache_hits, self._file_key_cache_misses,
+            self._file_key_cache_evictions)
+        if self._cache_fs is not None:
+            logging.info(
+                'Repository cache: hits=%d misses=%d size=%d',
+                self._cache_fs.hits, self._cache_fs.misses,
+                self._cache_fs.size)
+
     def get_shared_directories(self):
         return ['chunklist', 'chunks', 'chunksums', 'clientlist']
 
+    def get_chunk_directories(self):
+        return ['chunks']
+
     # Client list handling.
 
     def _setup_client_list(self):
@@ -329,56 +376,204 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._require_existing_client(client_name)
         self._require_client_lock(client_name)
 
+        # The generation may refer to chunks that are still being
+        # written in the background.
+        self._fs.flush_queue()
         self._flush_file_key_cache()
+        self._chunk_packs.flush()
 
         open_client_info = self._open_client_infos[client_name]
 
         if open_client_info.current_generation_number:
             open_client_info.client.set_generation_ended(self._current_time())
+            self._add_generation_to_chunk_refs(client_name)
+
+        if len(open_client_info.removed_chunk_ids) > 0:
+            self._remove_chunks_from_indexes(client_name)
 
         if (open_client_info.current_generation_number or
             open_client_info.generations_removed):
             open_client_info.client.commit()
+            self._write_chunk_refs(open_client_info)
 
         self._raw_unlock_client(client_name)
 
-    def _remove_chunks_from_removed_generations(
-        self, client_name, remove_gen_nos):
-
-        def find_chunkids_in_gens(gen_nos):
-            chunkids = set()
-            for gen_number in gen_nos:
-                gen_id = self._construct_gen_id(client_name, gen_number)
-                x = self.get_generation_chunk_ids(gen_id)
-                chunkids = chunkids.union(set(x))
-            return chunkids
-
-        def find_gens_to_keep():
-            keep = []
-            for gen_id in self.get_client_generation_ids(client_name):
-                a, gen_number = self._unpack_gen_id(gen_id)
-                if gen_number not in remove_gen_nos:
-                    keep.append(gen_number)
-            return keep
-
-        def remove_chunks(chunk_ids): # pragma: no cover
-            for chunk_id in chunk_ids:
-                try:
-                    checksum = self._chunklist.get_checksum(chunk_id)
-                except KeyError:
-                    # No checksum, therefore it can't be shared, therefore
-                    # we can remove it.
-                    self.remove_chunk(chunk_id)
-                else:
-                    self.remove_chunk_from_indexes(chunk_id, client_name)
-                    if not self._chunksums.chunk_is_used(checksum, chunk_id):
-                        self.remove_chunk(chunk_id)
+    # Each client has a ChunkRefs object that tells which of its
+    # generations use which chunks, so that removing a generation
+    # doesn't require listing the chunks of every other generation. It
+    # is updated when the client is committed, by comparing the new
+    # generation with the one it started as a copy of. Only the chunks
+    # that differ get looked at, since the B-trees of the generations
+    # share everything else. If the stored references don't match the
+    # committed generations, or are missing or corrupt, they're built
+    # again from the generations.
+
+    def _chunk_refs_filename(self, client):
+        return os.path.join(client.dirname, 'chunk-refs')
+
+    def _read_chunk_refs(self, client):
+        filename = self._chunk_refs_filename(client)
+        if not self._fs.exists(filename):
+            return None
+        try:
+            return obnamlib.ChunkRefs.unserialise(self._fs.cat(filename))
+        except obnamlib.ChunkRefsError:
+            logging.warning('Ignoring corrupt chunk references %s', filename)
+            return None
+
+    def _build_chunk_refs(self, client, gen_numbers):
+        tracing.trace('building chunk references for %s', client.dirname)
+        refs = obnamlib.ChunkRefs()
+        previous = obnamlib.ChunkIdSet()
+        for gen_number in gen_numbers:
+            chunk_ids = client.list_chunks_in_generation(gen_number)
+            refs.add_generation(
+                gen_number,
+                chunk_ids.difference(previous),
+                previous.difference(chunk_ids))
+            previous = chunk_ids
+        return refs
+
+    def _get_chunk_refs(self, client_name):
+        open_client_info = self._open_client_infos[client_name]
+        if open_client_info.chunk_refs is None:
+            client = open_client_info.client
+            committed = [
+                gen_number for gen_number in client.list_generations()
+                if gen_number != open_client_info.current_generation_number]
+            refs = self._read_chunk_refs(client)
+            if refs is None or refs.generations != committed:
+                refs = self._build_chunk_refs(client, committed)
+            open_client_info.chunk_refs = refs
+        return open_client_info.chunk_refs
+
+    def _write_chunk_refs(self, open_client_info):
+        refs = open_client_info.chunk_refs
+        if refs is not None:
+            self._fs.overwrite_file(
+                self._chunk_refs_filename(open_client_info.client),
+                refs.serialise())
+
+    def _add_generation_to_chunk_refs(self, client_name):
+        refs = self._get_chunk_refs(client_name)
+        open_client_info = self._open_client_infos[client_name]
+        client = open_client_info.client
+        gen_number = open_client_info.current_generation_number
+        parent = open_client_info.parent_generation_number
+
+        if refs.generations and refs.generations[-1] == parent:
+            started, stopped = client.diff_generation_chunks(
+                parent, gen_number)
+        else:
+            # The generation we started from has been removed, so
+            # compare with what the latest remaining one uses.
+            chunk_ids = client.list_chunks_in_generation(gen_number)
+            latest = refs.get_chunks_used_by_latest()
+            started = chunk_ids.difference(latest)
+            stopped = latest.difference(chunk_ids)
+        refs.add_generation(gen_number, started, stopped)
+
+    def _find_chunks_only_in_generation(self, client, gen_number):
+        # Return the chunks the generation uses that the generations
+        # next to it don't. Other generations can only use them if they
+        # stopped and started again, which ChunkRefs knows about. Diffing
+        # the trees is much cheaper than listing all chunks.
+        gen_numbers = client.list_generations()
+        i = gen_numbers.index(gen_number)
+        neighbours = gen_numbers[max(0, i-1):i] + gen_numbers[i+1:i+2]
+        if not neighbours:
+            return client.list_chunks_in_generation(gen_number)
+        candidates = None
+        for neighbour in neighbours:
+            only_in_gen, only_in_neighbour = client.diff_generation_chunks(
+                neighbour, gen_number)
+            only_in_gen = obnamlib.ChunkIdSet(only_in_gen)
+            if candidates is None:
+                candidates = only_in_gen
+            else:
+                candidates = obnamlib.ChunkIdSet(
+                    chunk_id for chunk_id in candidates
+                    if chunk_id in only_in_gen)
+        return candidates
 
-        keep_gen_nos = find_gens_to_keep()
-        keep_chunkids = find_chunkids_in_gens(keep_gen_nos)
-        maybe_remove_chunkids = find_chunkids_in_gens(remove_gen_nos)
-        remove_chunkids = maybe_remove_chunkids.difference(keep_chunkids)
-        remove_chunks(remove_chunkids)
+    def _remove_chunks_from_removed_generation(self, client_name, gen_number):
+        refs = self._get_chunk_refs(client_name)
+        open_client_info = self._open_client_infos[client_name]
+        client = open_client_info.client
+        current = open_client_info.current_generation_number
+        candidates = self._find_chunks_only_in_generation(client, gen_number)
+
+        if gen_number == current:
+            # The generation hasn't been committed, so it's not in the
+            # references.
+            remove_chunkids = [
+                chunk_id for chunk_id in candidates
+                if not refs.is_used(chunk_id)]
+        else:
+            started = stopped = []
+            gen_numbers = refs.generations
+            if len(gen_numbers) > 1 and gen_numbers[-1] == gen_number:
+                started, stopped = client.diff_generation_chunks(
+                    gen_number, gen_numbers[-2])
+            remove_chunkids = [
+                chunk_id
+                for chunk_id in refs.remove_generation(
+                    gen_number, candidates, started, stopped)
+                if current is None or
+                not client.chunk_in_use(current, chunk_id)]
+
+        # Removing the chunks from the chunk indexes needs the chunk
+        # indexes to be locked. That is done when the client is
+        # committed, so that the slow part of removing generations
+        # doesn't keep other clients from committing their backups.
+        open_client_info.removed_chunk_ids.update(remove_chunkids)
+
+    def _remove_chunks_from_indexes(self, client_name):
+        # The chunks are looked up in the chunklist tree in chunk id
+        # order, and in the chunksums tree in checksum order, so that
+        # consecutive changes mostly hit the same B-tree nodes.
+        open_client_info = self._open_client_infos[client_name]
+        unshared = []
+        indexed = []
+        for chunk_id in open_client_info.removed_chunk_ids:
+            try:
+                checksum = self._chunklist.get_checksum(chunk_id)
+            except KeyError:
+                # No checksum, therefore it can't be shared.
+                unshared.append(chunk_id)
+            else:
+                indexed.append((checksum, chunk_id))
+
+        if indexed:
+            self._require_chunk_indexes_lock()
+        client_id = self._get_client_id(client_name)
+        unused = []
+
+        if self._got_chunk_indexes_lock:
+            # Without a chunklist entry the chunk is not shared, but a
+            # backup running at the same time may still be about to
+            # put it into the indexes. Mark it for removal like the
+            # other unused chunks, instead of removing it right away.
+            unused.extend(
+                chunk_id for chunk_id in unshared
+                if not self._is_in_tree_chunk_id(chunk_id))
+        else:
+            # Marking chunks for removal needs the chunk indexes lock,
+            # which forget and backup always hold here. Without it,
+            # remove the chunks right away.
+            self.remove_chunks(unshared)
+
+        for checksum, chunk_id in sorted(indexed):
+            self._chunksums.remove(checksum, chunk_id, client_id)
+            if not self._chunksums.chunk_is_used(checksum, chunk_id):
+                unused.append(chunk_id)
+        for chunk_id in sorted(chunk_id for checksum, chunk_id in indexed):
+            self._chunklist.remove(chunk_id)
+
+        if unused:
+            self._get_chunk_removals().mark(unused, self._current_time())
+            self._chunk_removals_changed = True
+        open_client_info.removed_chunk_ids = obnamlib.ChunkIdSet()
 
     def get_allowed_client_keys(self):
         return []
@@ -434,6 +629,10 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             raise obnamlib.RepositoryClientGenerationUnfinished(
                 client_name=client_name)
 
+        # The new generation starts as a copy of the latest one.
+        gen_numbers = open_client_info.client.list_generations()
+        if gen_numbers:
+            open_client_info.parent_generation_number = gen_numbers[-1]
         open_client_info.client.start_generation()
         open_client_info.client.set_generation_started(self._current_time())
 
@@ -555,6 +754,8 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._require_client_lock(client_name)
         self._require_existing_generation(gen_id)
 
+        self._remove_chunks_from_removed_generation(client_name, gen_number)
+
         open_client_info = self._open_client_infos[client_name]
         if gen_number == open_client_info.current_generation_number:
             open_client_info.current_generation_number = None
@@ -562,7 +763,7 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._forget_open_client_info_cached_generation(
             open_client_info, gen_id)
 
-        self._remove_chunks_from_removed_generations(client_name, [gen_number])
+        self._forget_file_key_cache_generation(gen_id)
         open_client_info.client.start_changes(create_tree=False)
         open_client_info.client.remove_generation(gen_number)
 
@@ -583,16 +784,26 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
 
         client_name, gen_number = self._unpack_gen_id(generation_id)
         client = self._open_client(client_name)
-        return client.list_chunks_in_generation(gen_number)
+        return list(client.list_chunks_in_generation(gen_number))
 
     # Chunks and chunk indexes.
 
     def _setup_chunks(self):
         self._prev_chunk_id = None
+        self._chunk_dir_files = None
         self._chunk_idpath = larch.IdPath(
             'chunks', self._idpath_depth, self._idpath_bits,
             self._idpath_skip)
 
+    def _setup_chunk_packs(self):
+        # Chunk packs live inside the chunks directory, so that they
+        # share its locking and encryption setup. Packs can be read
+        # even if we don't write new chunks into packs ourselves.
+        self._chunk_packs = obnamlib.ChunkPackStore(
+            self._fs,
+            os.path.join(self._chunk_idpath.dirname, 'packs'),
+            self._chunk_pack_size)
+
     def _construct_in_tree_chunk_id(
         self, gen_id, filename): # pragma: no cover
         # This constructs a synthetic chunk id for in-tree data for a
@@ -615,26 +826,86 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         return random.randint(0, obnamlib.MAX_ID)
 
     def put_chunk_content(self, data):
+        if self._chunk_pack_size > 0:
+            return self._chunk_packs.put_chunk_content(data)
+
         if self._prev_chunk_id is None:
             self._prev_chunk_id = self._random_chunk_id()
 
+        # If a chunk file with the next id exists already, pick a new
+        # random starting point for chunk ids. A file that is written
+        # in the background can't be checked that way, since it is
+        # only written later, so it is checked for before it is queued.
         while True:
             chunk_id = (self._prev_chunk_id + 1) % obnamlib.MAX_ID
             filename = self._chunk_filename(chunk_id)
-            try:
-                self._fs.write_file(filename, data)
-            except OSError, e: # pragma: no cover
-                if e.errno == errno.EEXIST:
-                    self._prev_chunk_id = self._random_chunk_id()
-                    continue
-                raise
+            if self._upload_buffer_size > 0:
+                if not self._chunk_file_exists(filename):
+                    self._fs.queue_file(filename, data)
+                    break
             else:
-                tracing.trace('chunkid=%s', chunk_id)
-                break
+                try:
+                    self._fs.write_file(filename, data)
+                except OSError, e: # pragma: no cover
+                    if e.errno != errno.EEXIST:
+                        raise
+                else:
+                    break
+            self._prev_chunk_id = self._random_chunk_id()
 
+        tracing.trace('chunkid=%s', chunk_id)
         self._prev_chunk_id = chunk_id
         return chunk_id
 
+    def _chunk_file_exists(self, filename):
+        # Chunk ids are consecutive, so instead of checking each chunk
+        # file, which would cost a round trip per chunk, list each
+        # chunk directory once, and remember the files in it.
+        dirname, basename = os.path.split(filename)
+        if (self._chunk_dir_files is None or
+                self._chunk_dir_files[0] != dirname):
+            try:
+                basenames = set(self._fs.listdir(dirname))
+            except (IOError, OSError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+                basenames = set()
+            self._chunk_dir_files = (dirname, basenames)
+        basenames = self._chunk_dir_files[1]
+        if basename in basenames:
+            return True
+        basenames.add(basename)
+        return False
+
+    def put_chunk_contents(self, datas):
+        if self._chunk_pack_size > 0:
+            return [self._chunk_packs.put_chunk_content(x) for x in datas]
+        if self._upload_buffer_size > 0:
+            # The chunks are written in the background, in batches.
+            return [self.put_chunk_content(x) for x in datas]
+        if not datas:
+            return []
+
+        if self._prev_chunk_id is None:
+            self._prev_chunk_id = self._random_chunk_id()
+
+        # Chunk ids are consecutive, so a batch of chunks usually ends
+        # up in the same directory, and the directory is only created
+        # once. Any chunk whose file already exists is put individually,
+        # which picks a new random starting point for chunk ids.
+        chunk_ids = [
+            (self._prev_chunk_id + i) % obnamlib.MAX_ID
+            for i in range(1, len(datas) + 1)]
+        filenames = [self._chunk_filename(x) for x in chunk_ids]
+        existing = set(self._fs.write_files(zip(filenames, datas)))
+        self._prev_chunk_id = chunk_ids[-1]
+
+        for i, filename in enumerate(filenames):
+            if filename in existing: # pragma: no cover
+                chunk_ids[i] = self.put_chunk_content(datas[i])
+        tracing.trace('chunkids=%s', chunk_ids)
+        return chunk_ids
+
     def get_chunk_content(self, chunk_id):
         if self._is_in_tree_chunk_id(chunk_id): # pragma: no cover
             gen_id, filename = self._unpack_in_tree_chunk_id(chunk_id)
@@ -642,16 +913,42 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             client = self._open_client(client_name)
             return client.get_file_data(gen_number, filename)
 
+        data = self._chunk_packs.get_chunk_content(chunk_id)
+        if data is not None:
+            return data
+
         filename = self._chunk_filename(chunk_id)
         try:
             return self._fs.cat(filename)
         except IOError, e:
             if e.errno == errno.ENOENT:
+                # The chunk may be in a pack made after we last looked.
+                data = self._chunk_packs.get_chunk_content(
+                    chunk_id, refresh=True)
+                if data is not None:
+                    return data
                 raise obnamlib.RepositoryChunkDoesNotExist(
                     chunk_id=str(chunk_id),
                     filename=filename)
             raise # pragma: no cover
 
+    def get_chunk_contents(self, chunk_ids, read_ahead=1, num_workers=0):
+        # Chunk files are read and run through the filters in worker
+        # threads. In-tree data lives in the per-client B-trees, which
+        # must only be used from the caller's thread, so those are
+        # fetched here instead.
+
+        def fetch(chunk_id):
+            if self._is_in_tree_chunk_id(chunk_id): # pragma: no cover
+                return chunk_id, None
+            return chunk_id, self.get_chunk_content(chunk_id)
+
+        pipeline = obnamlib.OrderedPipeline(fetch, num_workers, read_ahead)
+        for chunk_id, data in pipeline.run(chunk_ids):
+            if data is None: # pragma: no cover
+                data = self.get_chunk_content(chunk_id)
+            yield data
+
     def has_chunk(self, chunk_id):
         if self._is_in_tree_chunk_id(chunk_id): # pragma: no cover
             gen_id, filename = self._unpack_in_tree_chunk_id(chunk_id)
@@ -660,7 +957,11 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             data = client.get_file_data(gen_number, filename)
             return data is not None
 
-        return self._fs.exists(self._chunk_filename(chunk_id))
+        if self._chunk_packs.has_chunk(chunk_id):
+            return True
+        if self._fs.exists(self._chunk_filename(chunk_id)):
+            return True
+        return self._chunk_packs.has_chunk(chunk_id, refresh=True)
 
     def remove_chunk(self, chunk_id):
         tracing.trace('chunk_id=%s', chunk_id)
@@ -671,26 +972,61 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         if self._is_in_tree_chunk_id(chunk_id): # pragma: no cover
             return
 
+        if self._chunk_packs.remove_chunk(chunk_id):
+            return
+
         filename = self._chunk_filename(chunk_id)
         try:
             self._fs.remove(filename)
         except OSError:
+            if self._chunk_packs.remove_chunk(chunk_id, refresh=True):
+                return
             raise obnamlib.RepositoryChunkDoesNotExist(
                 chunk_id=str(chunk_id),
                 filename=filename)
 
+    def remove_chunks(self, chunk_ids):
+        # Chunks in packs only need their pack index to be changed.
+        # The rest are files, which are removed in one batch, which
+        # the VFS may pipeline.
+        filenames = []
+        for chunk_id in chunk_ids:
+            if self._is_in_tree_chunk_id(chunk_id): # pragma: no cover
+                continue
+            if not self._chunk_packs.remove_chunk(chunk_id):
+                filenames.append((self._chunk_filename(chunk_id), chunk_id))
+        missing = set(self._fs.remove_files(
+            filename for filename, chunk_id in filenames))
+        return [
+            chunk_id for filename, chunk_id in filenames
+            if filename in missing and
+            not self._chunk_packs.remove_chunk(chunk_id, refresh=True)]
+
     def get_chunk_ids(self):
         # Note: This does not cover for in-tree chunk data. We cannot
         # realistically iterate over all per-client B-trees to find
         # such data.
         
+        self._fs.flush_queue()
+
+        def not_packs(pathname):
+            return os.path.basename(pathname) != 'packs'
+
         pat = re.compile(r'^.*/.*/[0-9a-fA-F]+$')
         if self._fs.exists('chunks'):
-            for pathname, st in self._fs.scan_tree('chunks'):
-                if stat.S_ISREG(st.st_mode) and pat.match(pathname):
+            for pathname in self._fs.scan_files('chunks', ok=not_packs):
+                if pat.match(pathname):
                     basename = os.path.basename(pathname)
                     yield int(basename, 16)
 
+        for chunk_id in self._chunk_packs.get_chunk_ids():
+            yield chunk_id
+
+    def repack_chunks(self, min_live_ratio):
+        self._require_chunk_indexes_lock()
+        count = self._chunk_packs.repack(min_live_ratio)
+        tracing.trace('repacked %d chunk packs', count)
+
     # Chunk indexes.
 
     def _checksum(self, data):
@@ -704,6 +1040,170 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._chunksums = obnamlib.ChecksumTree(
             self._fs, 'chunksums',  len(self._checksum('')), self._node_size,
             self._upload_queue_size, self._lru_size, self)
+        self._chunk_filter = None
+        self._chunk_filter_root = None
+        self._chunk_filter_added = []
+        self._chunksums_root = None
+        self._chunk_removals = None
+        self._chunk_removals_changed = False
+
+    # The chunk filter is a Bloom filter of all checksums in the
+    # chunksums tree. Most chunks in a backup are usually new, and the
+    # filter lets us know that without a B-tree lookup. Removed chunks
+    # stay in the filter, which is harmless: a false positive just means
+    # the B-tree gets looked up after all. The filter is updated when
+    # the chunk indexes are committed, and rebuilt from the B-tree when
+    # it gets too full, or if it is missing or corrupt.
+    #
+    # Next to the filter, a small file records the root node id of the
+    # chunksums tree the filter is for. The id changes whenever the
+    # tree is committed, including by older versions of Obnam that
+    # don't know about the filter, so a filter whose id doesn't match
+    # the tree is out of date, and is rebuilt. The id is rewritten at
+    # every commit, but the filter only when checksums were added.
+
+    _chunk_filter_min_capacity = 1024
+
+    def _chunk_filter_filename(self):
+        return os.path.join(self._chunksums.dirname, 'bloom-filter')
+
+    def _chunk_filter_root_filename(self):
+        return os.path.join(self._chunksums.dirname, 'bloom-filter-root')
+
+    def _read_chunk_filter(self):
+        filename = self._chunk_filter_filename()
+        if not self._fs.exists(filename):
+            return None
+        try:
+            return obnamlib.BloomFilter.unserialise(self._fs.cat(filename))
+        except obnamlib.BloomFilterError:
+            logging.warning('Ignoring corrupt chunk filter %s', filename)
+            return None
+
+    def _read_chunk_filter_root(self):
+        filename = self._chunk_filter_root_filename()
+        if not self._fs.exists(filename):
+            return None
+        return self._fs.cat(filename)
+
+    def _get_chunksums_root(self):
+        root_id = self._chunksums.committed_root_id()
+        if root_id is None:
+            return ''
+        return str(root_id)
+
+    def _build_chunk_filter(self, count=None):
+        # The checksums are read from the tree one part at a time. If
+        # the number of checksums isn't known, they are read twice,
+        # first to count them, so that the filter gets the right size.
+        tracing.trace('building chunk filter from chunksums tree')
+        if count is None:
+            count = sum(1 for checksum in self._chunksums.checksums())
+        bf = obnamlib.BloomFilter(
+            max(self._chunk_filter_min_capacity, 2 * count))
+        for checksum in self._chunksums.checksums():
+            bf.add(checksum)
+        return bf
+
+    def _get_chunk_filter(self):
+        if self._chunk_filter is None:
+            root = self._get_chunksums_root()
+            bf = None
+            if self._read_chunk_filter_root() == root:
+                bf = self._read_chunk_filter()
+            if bf is None:
+                bf = self._build_chunk_filter()
+            for checksum in self._chunk_filter_added:
+                bf.add(checksum)
+            self._chunk_filter = bf
+            self._chunk_filter_root = root
+        return self._chunk_filter
+
+    def _commit_chunk_filter(self):
+        # This is called after the chunksums tree has been committed,
+        # while we still hold the chunk indexes lock. A filter for the
+        # tree as it was when we locked it only lacks our own changes.
+        # Another client may have updated the stored filter after we
+        # read it, so unless ours is for that tree, we read it again.
+        if not self._fs.exists(self._chunksums.dirname):
+            return
+        stored_root = self._read_chunk_filter_root()
+        if (stored_root == self._chunksums_root and
+                not self._chunk_filter_added):
+            self._write_chunk_filter_root()
+            return
+
+        bf = None
+        if (self._chunk_filter is not None and
+                self._chunk_filter_root == self._chunksums_root):
+            bf = self._chunk_filter
+        elif stored_root == self._chunksums_root:
+            bf = self._read_chunk_filter()
+            if bf is not None:
+                for checksum in self._chunk_filter_added:
+                    bf.add(checksum)
+        if bf is None:
+            bf = self._build_chunk_filter()
+        elif bf.is_full():
+            bf = self._build_chunk_filter(count=bf.count)
+        self._fs.overwrite_file(self._chunk_filter_filename(), bf.serialise())
+        self._write_chunk_filter_root()
+
+    def _write_chunk_filter_root(self):
+        self._fs.overwrite_file(
+            self._chunk_filter_root_filename(), self._get_chunksums_root())
+
+    # Chunks that removing generations leaves unused by any client are
+    # not removed right away. A backup running at the same time may
+    # have found them in the chunk indexes, which it reads without a
+    # lock, and will put them back into the indexes when it commits.
+    # Instead, the chunks are marked for removal in a file next to the
+    # chunklist tree, and putting a chunk into the indexes revives it.
+    # A later forget removes the chunks that were marked long enough
+    # ago, and not revived. Thus forget doesn't need to lock other
+    # clients.
+
+    def _chunk_removals_filename(self):
+        return os.path.join(self._chunklist.dirname, 'pending-removals')
+
+    def _get_chunk_removals(self):
+        if self._chunk_removals is None:
+            filename = self._chunk_removals_filename()
+            removals = None
+            if self._fs.exists(filename):
+                try:
+                    removals = obnamlib.ChunkRemovals.unserialise(
+                        self._fs.cat(filename))
+                except obnamlib.ChunkRemovalsError:
+                    logging.warning(
+                        'Ignoring corrupt pending chunk removals %s',
+                        filename)
+            self._chunk_removals = removals or obnamlib.ChunkRemovals()
+        return self._chunk_removals
+
+    def _commit_chunk_removals(self):
+        # This is called after the chunk index trees have been
+        # committed, so that chunks are never marked for removal while
+        # the committed indexes still say somebody uses them.
+        if self._chunk_removals_changed:
+            self._fs.overwrite_file(
+                self._chunk_removals_filename(),
+                self._chunk_removals.serialise())
+
+    def remove_pending_chunks(self, grace_period):
+        self._require_chunk_indexes_lock()
+        removals = self._get_chunk_removals()
+        expired = removals.take_expired(self._current_time() - grace_period)
+        self._chunk_removals_changed = True
+        unused = []
+        for chunk_id in expired:
+            try:
+                self._chunklist.get_checksum(chunk_id)
+            except KeyError:
+                unused.append(chunk_id)
+        missing = self.remove_chunks(unused)
+        tracing.trace(
+            'removed %d pending chunks', len(unused) - len(missing))
 
     def _chunk_index_dirs_to_lock(self):
         return [
@@ -725,6 +1225,9 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         tracing.trace('starting changes in chunksums and chunklist')
         self._chunksums.start_changes()
         self._chunklist.start_changes()
+        self._chunksums_root = self._get_chunksums_root()
+        self._chunk_removals = None
+        self._chunk_removals_changed = False
 
         # Initialize the chunks directory for encryption, etc, if it just
         # got created.
@@ -761,8 +1264,12 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
     def commit_chunk_indexes(self):
         tracing.trace('committing chunk indexes')
         self._require_chunk_indexes_lock()
+        self._fs.flush_queue()
+        self._chunk_packs.flush()
         self._chunklist.commit()
         self._chunksums.commit()
+        self._commit_chunk_filter()
+        self._commit_chunk_removals()
         self._raw_unlock_chunk_indexes()
 
     def prepare_chunk_for_indexes(self, data):
@@ -779,6 +1286,13 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._require_chunk_indexes_lock()
         self._chunklist.add(chunk_id, token)
         self._chunksums.add(token, chunk_id, client_id)
+        removals = self._get_chunk_removals()
+        if chunk_id in removals:
+            removals.revive(chunk_id)
+            self._chunk_removals_changed = True
+        self._chunk_filter_added.append(token)
+        if self._chunk_filter is not None:
+            self._chunk_filter.add(token)
 
     def remove_chunk_from_indexes(self, chunk_id, client_name):
         tracing.trace('chunk_id=%s', chunk_id)
@@ -810,6 +1324,8 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
 
     def find_chunk_ids_by_content(self, data):
         checksum = self._checksum(data)
+        if checksum not in self._get_chunk_filter():
+            raise obnamlib.RepositoryChunkContentNotInIndexes()
         candidates = self._chunksums.find(checksum)
         if candidates:
             return candidates
@@ -867,6 +1383,9 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             
             }
 
+        self._file_key_cache_hits = 0
+        self._file_key_cache_misses = 0
+        self._file_key_cache_evictions = 0
         self._setup_file_key_cache()
 
     def _require_existing_file(self, generation_id, filename):
@@ -910,52 +1429,91 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         return self._file_keys.keys()
 
     def _setup_file_key_cache(self):
-        # A cache for file key lookups and changes. We operate on a
-        # very simple heuristic: the caller will be getting or setting
-        # file keys on one file at a time, so we cache until the
-        # filename (or generation) changes. We also flush the cache
-        # when any other changes to the repository are made, such as
-        # removing generations.
+        # A cache for file key lookups and changes. Callers often get
+        # or set file keys on one file at a time, but also alternate
+        # between the same file in two generations (for example, when
+        # comparing a file to its previous backup), so we keep the
+        # most recently used files, up to a limit. Changes are written
+        # to the B-tree when a file is dropped from the cache, or when
+        # the cache is flushed. We also flush the cache when any other
+        # changes to the repository are made, such as committing.
         #
-        # The dict is indexed by a (generation_id, filename) tuple,
-        # and should contain only one item. The value is a tuple of
-        # (dirty_flag, obnamlib.Metadata object).
+        # The OrderedDict is indexed by a (generation_id, filename)
+        # tuple, and the least recently used item comes first. The
+        # value is a tuple of (dirty_flag, obnamlib.Metadata object).
 
-        self._file_key_cache = {}
+        self._file_key_cache = collections.OrderedDict()
 
     def _get_file_key_cache_key(self, generation_id, filename):
         return (generation_id, filename)
 
-    def _flush_file_key_cache(self):
-        for cache_key, value in self._file_key_cache.items():
+    def _write_file_key_cache_items(self, items):
+        # Write dirty metadata in items to the B-trees. We only need
+        # to open each client once.
+        clients = {}
+        encode = obnamlib.fmt_6.metadata_codec.encode_metadata
+        for cache_key, value in items:
             generation_id, filename = cache_key
-            client_name, generation_number = self._unpack_gen_id(
-                generation_id)
             dirty, metadata = value
             if dirty:
-                encoded_metadata = \
-                    obnamlib.fmt_6.metadata_codec.encode_metadata(metadata)
-                client = self._open_client(client_name)
+                client_name, generation_number = self._unpack_gen_id(
+                    generation_id)
+                if client_name not in clients:
+                    clients[client_name] = self._open_client(client_name)
                 # FIXME: Only sets in unfinished generation
-                client.set_metadata(filename, encoded_metadata)
+                clients[client_name].set_metadata(
+                    filename, encode(metadata))
+
+    def _write_back_file_key_cache(self):
+        items = self._file_key_cache.items()
+        self._write_file_key_cache_items(items)
+        for cache_key, value in items:
+            dirty, metadata = value
+            self._file_key_cache[cache_key] = (False, metadata)
+
+    def _flush_file_key_cache(self):
+        self._write_file_key_cache_items(self._file_key_cache.items())
         self._setup_file_key_cache()
 
-    def _cache_file_keys_from_storage(self, generation_id, filename):
+    def _forget_file_key_cache_generation(self, generation_id):
+        for cache_key in self._file_key_cache.keys():
+            if cache_key[0] == generation_id:
+                del self._file_key_cache[cache_key]
+
+    def _load_file_metadata(self, generation_id, filename):
+        self._require_existing_generation(generation_id)
         client_name, gen_number = self._unpack_gen_id(generation_id)
         client = self._open_client(client_name)
-        encoded_metadata = client.get_metadata(gen_number, filename)
-        metadata = obnamlib.fmt_6.metadata_codec.decode_metadata(
+        try:
+            encoded_metadata = client.get_metadata(gen_number, filename)
+        except KeyError:
+            raise obnamlib.RepositoryFileDoesNotExistInGeneration(
+                client_name=client_name,
+                genspec=self.make_generation_spec(generation_id),
+                filename=filename)
+        return obnamlib.fmt_6.metadata_codec.decode_metadata(
             encoded_metadata)
+
+    def _get_cached_file_metadata(self, generation_id, filename):
         cache_key = self._get_file_key_cache_key(generation_id, filename)
-        self._file_key_cache[cache_key] = (False, metadata)
+        if cache_key in self._file_key_cache:
+            self._file_key_cache_hits += 1
+            # Move the item to the end, as the most recently used.
+            value = self._file_key_cache.pop(cache_key)
+        else:
+            self._file_key_cache_misses += 1
+            metadata = self._load_file_metadata(generation_id, filename)
+            value = (False, metadata)
+            while len(self._file_key_cache) >= self._file_key_cache_size:
+                self._file_key_cache_evictions += 1
+                self._write_file_key_cache_items(
+                    [self._file_key_cache.popitem(last=False)])
+        self._file_key_cache[cache_key] = value
+        return value
 
     def get_file_key(self, generation_id, filename, key):
-        cache_key = self._get_file_key_cache_key(generation_id, filename)
-        if cache_key not in self._file_key_cache:
-            self._flush_file_key_cache()
-            self._require_existing_file(generation_id, filename)
-            self._cache_file_keys_from_storage(generation_id, filename)
-        dirty, metadata = self._file_key_cache[cache_key]
+        dirty, metadata = self._get_cached_file_metadata(
+            generation_id, filename)
 
         if key in self._file_keys:
             value = getattr(metadata, self._file_keys[key])
@@ -974,15 +1532,12 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         client_name, gen_number = self._unpack_gen_id(generation_id)
         self._require_client_lock(client_name)
 
-        cache_key = self._get_file_key_cache_key(generation_id, filename)
-        if cache_key not in self._file_key_cache:
-            self._flush_file_key_cache()
-            self._require_existing_file(generation_id, filename)
-            self._cache_file_keys_from_storage(generation_id, filename)
-        dirty, metadata = self._file_key_cache[cache_key]
+        dirty, metadata = self._get_cached_file_metadata(
+            generation_id, filename)
 
         if key in self._file_keys:
             setattr(metadata, self._file_keys[key], value)
+            cache_key = self._get_file_key_cache_key(generation_id, filename)
             self._file_key_cache[cache_key] = (True, metadata)
         else:
             raise obnamlib.RepositoryFileKeyNotAllowed(
@@ -990,6 +1545,84 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
                 client_name=client_name,
                 key_name=obnamlib.repo_key_name(key))
 
+    def set_file_metadata(self, generation_id, filename, metadata):
+        self.set_files_metadata(generation_id, [(filename, metadata)])
+
+    def set_files_metadata(self, generation_id, filenames_and_metadata):
+        client_name, gen_number = self._unpack_gen_id(generation_id)
+        self._require_client_lock(client_name)
+        client = self._open_client(client_name)
+        encode = obnamlib.fmt_6.metadata_codec.encode_metadata
+        for filename, metadata in filenames_and_metadata:
+            # Any cached changes made with set_file_key are replaced
+            # by the new metadata, so they don't need to be written.
+            cache_key = self._get_file_key_cache_key(generation_id, filename)
+            self._file_key_cache.pop(cache_key, None)
+            client.create(filename, encode(metadata))
+
+    def _fill_in_metadata_defaults(self, metadata):
+        # Return a copy of metadata with fields for unset file keys
+        # set to what get_file_key would return for them. The copy
+        # means callers can't change the file key cache by accident.
+        result = obnamlib.Metadata()
+        for key, field in obnamlib.REPO_FILE_METADATA_FIELDS:
+            value = getattr(metadata, field)
+            if key in obnamlib.REPO_FILE_INTEGER_KEYS:
+                setattr(result, field, value or 0)
+            else:
+                setattr(result, field, value or '')
+        return result
+
+    def get_file_metadata(self, generation_id, filename):
+        dirty, metadata = self._get_cached_file_metadata(
+            generation_id, filename)
+        return self._fill_in_metadata_defaults(metadata)
+
+    def get_directory_metadata(self, generation_id, dirname):
+        self._require_existing_file(generation_id, dirname)
+        # Changes made with set_file_key need to be in the tree for us
+        # to see them.
+        self._write_back_file_key_cache()
+        client_name, gen_number = self._unpack_gen_id(generation_id)
+        client = self._open_client(client_name)
+        decode = obnamlib.fmt_6.metadata_codec.decode_metadata
+        return [
+            (os.path.join(dirname, basename),
+             self._fill_in_metadata_defaults(decode(encoded_metadata)))
+            for basename, encoded_metadata
+            in client.listdir_metadata(gen_number, dirname)]
+
+    def diff_generations(self, gen_id1, gen_id2):
+        client_name1, gen_number1 = self._unpack_gen_id(gen_id1)
+        client_name2, gen_number2 = self._unpack_gen_id(gen_id2)
+        if client_name1 != client_name2: # pragma: no cover
+            # Different clients' generations are in different B-trees,
+            # which share no nodes, so there's nothing to gain.
+            for pair in obnamlib.RepositoryInterface.diff_generations(
+                    self, gen_id1, gen_id2):
+                yield pair
+            return
+
+        self._require_existing_generation(gen_id1)
+        self._require_existing_generation(gen_id2)
+        self._write_back_file_key_cache()
+        client = self._open_client(client_name1)
+        for pathname, change in client.diff_generations(
+                gen_number1, gen_number2):
+            # The tree only tells us that the file's keys are stored
+            # differently, for example if the chunk list was appended
+            # to in a different number of steps. Check the values.
+            if change == '*':
+                contents1 = self._get_file_contents(
+                    gen_id1, pathname,
+                    self.get_file_metadata(gen_id1, pathname))
+                contents2 = self._get_file_contents(
+                    gen_id2, pathname,
+                    self.get_file_metadata(gen_id2, pathname))
+                if contents1 == contents2: # pragma: no cover
+                    continue
+            yield pathname, change
+
     def get_file_chunk_ids(self, generation_id, filename):
         self._require_existing_file(generation_id, filename)
         client_name, gen_number = self._unpack_gen_id(generation_id)
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import shutil
 import tempfile
 
@@ -33,3 +34,176 @@ class RepositoryFormat6Tests(obnamlib.RepositoryInterfaceTests):
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
+    def test_removing_generation_removes_chunks_only_it_uses(self):
+        gen_id1 = self.create_generation()
+        self.repo.add_file(gen_id1, '/foo')
+        shared = self.repo.put_chunk_content('shared')
+        own = self.repo.put_chunk_content('own')
+        for chunk_id in [shared, own]:
+            self.repo.append_file_chunk_id(gen_id1, '/foo', chunk_id)
+        self.repo.commit_client('fooclient')
+
+        self.repo.lock_client('fooclient')
+        gen_id2 = self.repo.create_generation('fooclient')
+        self.repo.clear_file_chunk_ids(gen_id2, '/foo')
+        self.repo.append_file_chunk_id(gen_id2, '/foo', shared)
+        self.repo.commit_client('fooclient')
+
+        self.repo.lock_client('fooclient')
+        self.repo.remove_generation(gen_id1)
+        self.repo.commit_client('fooclient')
+        self.assertTrue(self.repo.has_chunk(shared))
+        self.assertFalse(self.repo.has_chunk(own))
+
+    def test_finds_chunk_indexed_without_updating_chunk_filter(self):
+        self.setup_client()
+        self.repo.lock_chunk_indexes()
+        self.repo.commit_chunk_indexes()
+
+        # Older versions of Obnam don't update the chunk filter.
+        chunk_id = self.repo.put_chunk_content('data')
+        self.repo.lock_chunk_indexes()
+        token = self.repo.prepare_chunk_for_indexes('data')
+        self.repo.put_chunk_into_indexes(chunk_id, token, 'fooclient')
+        self.repo._commit_chunk_filter = lambda: None
+        self.repo.commit_chunk_indexes()
+        del self.repo._commit_chunk_filter
+
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('data'), [chunk_id])
+
+    def create_generation_with_indexed_chunk(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo')
+        chunk_id = self.repo.put_chunk_content('data')
+        self.repo.append_file_chunk_id(gen_id, '/foo', chunk_id)
+        self.repo.lock_chunk_indexes()
+        token = self.repo.prepare_chunk_for_indexes('data')
+        self.repo.put_chunk_into_indexes(chunk_id, token, 'fooclient')
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        return gen_id, chunk_id, token
+
+    def remove_pending_chunks(self, grace_period):
+        self.repo.lock_chunk_indexes()
+        self.repo.remove_pending_chunks(grace_period)
+        self.repo.commit_chunk_indexes()
+
+    def test_removes_indexed_chunks_only_after_grace_period(self):
+        self.now = 1000
+        self.repo._current_time = lambda: self.now
+        gen_id, chunk_id, token = self.create_generation_with_indexed_chunk()
+
+        self.repo.lock_client('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.lock_chunk_indexes()
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.remove_pending_chunks(100)
+        self.assertTrue(self.repo.has_chunk(chunk_id))
+
+        self.now += 100
+        self.remove_pending_chunks(100)
+        self.assertFalse(self.repo.has_chunk(chunk_id))
+
+    def test_marks_unindexed_chunks_for_removal_with_indexes_locked(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo')
+        chunk_id = self.repo.put_chunk_content('data')
+        self.repo.append_file_chunk_id(gen_id, '/foo', chunk_id)
+        self.repo.commit_client('fooclient')
+
+        self.repo.lock_client('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.lock_chunk_indexes()
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+        self.assertTrue(self.repo.has_chunk(chunk_id))
+
+        self.remove_pending_chunks(0)
+        self.assertFalse(self.repo.has_chunk(chunk_id))
+
+    def test_putting_chunk_into_indexes_keeps_it_from_removal(self):
+        gen_id, chunk_id, token = self.create_generation_with_indexed_chunk()
+
+        self.repo.lock_client('fooclient')
+        self.repo.remove_generation(gen_id)
+        self.repo.lock_chunk_indexes()
+        self.repo.commit_client('fooclient')
+        self.repo.commit_chunk_indexes()
+
+        self.repo.lock_chunk_indexes()
+        self.repo.put_chunk_into_indexes(chunk_id, token, 'fooclient')
+        self.repo.commit_chunk_indexes()
+        self.remove_pending_chunks(0)
+        self.assertTrue(self.repo.has_chunk(chunk_id))
+
+
+class RepositoryFormat6PackTests(RepositoryFormat6Tests):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        fs = obnamlib.LocalFS(self.tempdir)
+        self.hooks = obnamlib.HookManager()
+        obnamlib.RepositoryFormat6.setup_hooks(self.hooks)
+        self.repo = obnamlib.RepositoryFormat6(
+            hooks=self.hooks, chunk_pack_size=1024)
+        self.repo.set_fs(fs)
+
+
+class RepositoryFormat6LocalCacheTests(RepositoryFormat6Tests):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        fs = obnamlib.LocalFS(os.path.join(self.tempdir, 'repo'), create=True)
+        self.hooks = obnamlib.HookManager()
+        obnamlib.RepositoryFormat6.setup_hooks(self.hooks)
+        self.repo = obnamlib.RepositoryFormat6(
+            hooks=self.hooks, cache_dir=os.path.join(self.tempdir, 'cache'))
+        self.repo.set_fs(fs)
+
+
+class RepositoryFormat6UploadBufferTests(RepositoryFormat6Tests):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        fs = obnamlib.LocalFS(self.tempdir)
+        self.hooks = obnamlib.HookManager()
+        obnamlib.RepositoryFormat6.setup_hooks(self.hooks)
+        self.repo = obnamlib.RepositoryFormat6(
+            hooks=self.hooks, upload_buffer_size=1024)
+        self.repo.set_fs(fs)
+
+    def test_does_not_queue_chunk_with_id_of_existing_file(self):
+        self.repo._prev_chunk_id = 41
+        filename = self.repo._chunk_filename(42)
+        self.repo.get_fs().write_file(filename, 'old chunk')
+        chunk_id = self.repo.put_chunk_content('new chunk')
+        self.assertNotEqual(chunk_id, 42)
+        self.assertEqual(self.repo.get_chunk_content(chunk_id), 'new chunk')
+        self.assertEqual(self.repo.get_fs().cat(filename), 'old chunk')
+
+
+class RepositoryFormat6SmallFileKeyCacheTests(RepositoryFormat6Tests):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        fs = obnamlib.LocalFS(self.tempdir)
+        self.hooks = obnamlib.HookManager()
+        obnamlib.RepositoryFormat6.setup_hooks(self.hooks)
+        self.repo = obnamlib.RepositoryFormat6(
+            hooks=self.hooks, file_key_cache_size=1)
+        self.repo.set_fs(fs)
+
+    def test_remembers_file_keys_dropped_from_cache(self):
+        gen_id = self.create_generation()
+        for filename in ['/foo', '/bar']:
+            self.repo.add_file(gen_id, filename)
+        self.repo.set_file_key(gen_id, '/foo', obnamlib.REPO_FILE_SIZE, 1)
+        self.repo.set_file_key(gen_id, '/bar', obnamlib.REPO_FILE_SIZE, 2)
+        self.assertEqual(
+            self.repo.get_file_key(gen_id, '/foo', obnamlib.REPO_FILE_SIZE),
+            1)
+        self.assertEqual(
+            self.repo.get_file_key(gen_id, '/bar', obnamlib.REPO_FILE_SIZE),
+            2)
@@ -273,6 +273,15 @@ class SimpleClient(SimpleToplevel):
     #       ]
     #   }
 
+    # File key names, obnamlib.Metadata fields, and default values,
+    # for setting or getting all file keys at once with a Metadata
+    # object.
+    _metadata_key_names = [
+        (obnamlib.repo_key_name(key),
+         field,
+         0 if key in obnamlib.REPO_FILE_INTEGER_KEYS else '')
+        for key, field in obnamlib.REPO_FILE_METADATA_FIELDS]
+
     def __init__(self, client_name):
         SimpleToplevel.__init__(self)
         self.set_dirname(client_name)
@@ -463,6 +472,39 @@ class SimpleClient(SimpleToplevel):
         key_name = obnamlib.repo_key_name(key)
         files[filename]['keys'][key_name] = value
 
+    def set_files_metadata(self, gen_number, filenames_and_metadata):
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        files = generation['files']
+        for filename, metadata in filenames_and_metadata:
+            if filename not in files:
+                files[filename] = {
+                    'keys': {},
+                    'chunks': [],
+                }
+            keys = files[filename]['keys']
+            for key_name, field, default in self._metadata_key_names:
+                keys[key_name] = getattr(metadata, field)
+
+    def get_file_metadata(self, gen_number, filename):
+        self._require_file_exists(gen_number, filename)
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        return self._make_metadata(generation['files'][filename])
+
+    def _make_metadata(self, file_dict):
+        keys = file_dict['keys']
+        metadata = obnamlib.Metadata()
+        for key_name, field, default in self._metadata_key_names:
+            setattr(metadata, field, keys.get(key_name) or default)
+        return metadata
+
+    def get_directory_metadata(self, gen_number, dirname):
+        self._require_file_exists(gen_number, dirname)
+        generation = self._lookup_generation_by_gen_number(gen_number)
+        return [
+            (x, self._make_metadata(file_dict))
+            for x, file_dict in generation['files'].iteritems()
+            if self._is_direct_child_of(x, dirname)]
+
     def get_file_chunk_ids(self, gen_number, filename):
         self._require_file_exists(gen_number, filename)
         generation = self._lookup_generation_by_gen_number(gen_number)
@@ -479,11 +521,10 @@ class SimpleClient(SimpleToplevel):
         generation['files'][filename]['chunks'] = []
 
     def get_generation_chunk_ids(self, gen_number):
-        chunk_ids = set()
+        chunk_ids = obnamlib.ChunkIdSet()
         generation = self._lookup_generation_by_gen_number(gen_number)
         for filename in generation['files']:
-            file_chunk_ids = generation['files'][filename]['chunks']
-            chunk_ids = chunk_ids.union(set(file_chunk_ids))
+            chunk_ids.update(generation['files'][filename]['chunks'])
         return list(chunk_ids)
 
     def get_file_children(self, gen_number, filename):
@@ -575,6 +616,20 @@ class SimpleChunkStore(object):
                 tracing.trace('new chunk_id=%s', chunk_id)
                 return chunk_id
 
+    def put_chunk_contents(self, contents):
+        self._fs.create_and_init_toplevel(self._dirname)
+        chunk_ids = [self._random_chunk_id() for content in contents]
+        existing = self._fs.write_files(
+            (self._chunk_filename(chunk_id), content)
+            for chunk_id, content in zip(chunk_ids, contents))
+        if existing: # pragma: no cover
+            existing = set(existing)
+            for i, chunk_id in enumerate(chunk_ids):
+                if self._chunk_filename(chunk_id) in existing:
+                    chunk_ids[i] = self.put_chunk_content(contents[i])
+        tracing.trace('new chunk_ids=%s', chunk_ids)
+        return chunk_ids
+
     def get_chunk_content(self, chunk_id):
         filename = self._chunk_filename(chunk_id)
         if not self._fs.exists(filename):
@@ -595,6 +650,14 @@ class SimpleChunkStore(object):
                 filename=filename)
         self._fs.remove(filename)
 
+    def remove_chunks(self, chunk_ids):
+        chunk_ids = list(chunk_ids)
+        missing = set(self._fs.remove_files(
+            self._chunk_filename(chunk_id) for chunk_id in chunk_ids))
+        return [
+            chunk_id for chunk_id in chunk_ids
+            if self._chunk_filename(chunk_id) in missing]
+
     def get_chunk_ids(self):
         if not self._fs.exists(self._dirname):
             return []
@@ -629,11 +692,13 @@ class SimpleChunkIndexes(SimpleToplevel):
     def __init__(self):
         SimpleToplevel.__init__(self)
         self.set_dirname('chunk-indexes')
+        self._by_token = None
 
     def lock(self):
         self._require_not_locked()
         self._lock.unchecked_lock()
         self._data.clear()
+        self._by_token = None
 
     def _require_not_locked(self):
         if self._lock.got_lock:
@@ -642,6 +707,7 @@ class SimpleChunkIndexes(SimpleToplevel):
     def unlock(self):
         self._require_lock()
         self._data.clear()
+        self._by_token = None
         self._lock.unchecked_unlock()
 
     def _require_lock(self):
@@ -656,6 +722,7 @@ class SimpleChunkIndexes(SimpleToplevel):
     def force_lock(self):
         self._lock.force()
         self._data.clear()
+        self._by_token = None
 
     def prepare_chunk_for_indexes(self, chunk_content):
         return hashlib.sha512(chunk_content).hexdigest()
@@ -668,21 +735,27 @@ class SimpleChunkIndexes(SimpleToplevel):
             'sha512': token,
             'client-id': client_id,
         })
+        if self._by_token is not None:
+            self._by_token.setdefault(token, []).append(chunk_id)
 
     def _prepare_data(self):
         if 'index' not in self._data:
             self._data['index'] = []
 
-    def find_chunk_ids_by_content(self, chunk_content):
-        if 'index' in self._data:
-            token = self.prepare_chunk_for_indexes(chunk_content)
-            result = [
-                record['chunk-id']
-                for record in self._data['index']
-                if record['sha512'] == token]
-        else:
-            result = []
+    def _get_by_token(self):
+        # Map of token to chunk ids, so that lookups don't need to go
+        # through every record. It is dropped whenever records are
+        # removed, and built again when needed.
+        if self._by_token is None:
+            self._by_token = {}
+            for record in self._data.get('index', []):
+                self._by_token.setdefault(record['sha512'], []).append(
+                    record['chunk-id'])
+        return self._by_token
 
+    def find_chunk_ids_by_content(self, chunk_content):
+        token = self.prepare_chunk_for_indexes(chunk_content)
+        result = list(self._get_by_token().get(token, []))
         if not result:
             raise obnamlib.RepositoryChunkContentNotInIndexes()
         return result
@@ -691,6 +764,7 @@ class SimpleChunkIndexes(SimpleToplevel):
         self._require_lock()
         self._prepare_data()
 
+        self._by_token = None
         self._data['index'] = self._filter_out(
             self._data['index'],
             lambda x:
@@ -703,6 +777,7 @@ class SimpleChunkIndexes(SimpleToplevel):
         self._require_lock()
         self._prepare_data()
 
+        self._by_token = None
         self._data['index'] = self._filter_out(
             self._data['index'],
             lambda x: x['chunk-id'] == chunk_id)
@@ -725,6 +800,7 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
         self._fs = None
         self._hooks = kwargs['hooks']
         self._lock_timeout = kwargs.get('lock_timeout', 0)
+        self._filter_workers = kwargs.get('filter_workers', 0)
 
         self._client_list = SimpleClientList()
         self._chunk_store = SimpleChunkStore()
@@ -738,7 +814,8 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
         return self._fs.fs
 
     def set_fs(self, fs):
-        self._fs = obnamlib.RepositoryFS(self, fs, self._hooks)
+        self._fs = obnamlib.RepositoryFS(
+            self, fs, self._hooks, filter_workers=self._filter_workers)
         self._lockmgr = obnamlib.LockManager(self._fs, self._lock_timeout, '')
 
         self._client_list.set_fs(self._fs)
@@ -765,6 +842,9 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
     def get_shared_directories(self):
         return ['client-list', 'chunk-store', 'chunk-indexes']
 
+    def get_chunk_directories(self):
+        return ['chunk-store']
+
     #
     # Client list methods.
     #
@@ -939,6 +1019,23 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
         return client.set_file_key(
             generation_id.gen_number, filename, key, value)
 
+    def set_file_metadata(self, generation_id, filename, metadata):
+        self.set_files_metadata(generation_id, [(filename, metadata)])
+
+    def set_files_metadata(self, generation_id, filenames_and_metadata):
+        client = self._lookup_client_by_generation(generation_id)
+        client.set_files_metadata(
+            generation_id.gen_number, filenames_and_metadata)
+
+    def get_file_metadata(self, generation_id, filename):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.get_file_metadata(generation_id.gen_number, filename)
+
+    def get_directory_metadata(self, generation_id, dirname):
+        client = self._lookup_client_by_generation(generation_id)
+        return client.get_directory_metadata(
+            generation_id.gen_number, dirname)
+
     def get_allowed_file_keys(self):
         return [obnamlib.REPO_FILE_TEST_KEY,
                 obnamlib.REPO_FILE_MODE,
@@ -983,6 +1080,14 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
     def put_chunk_content(self, content):
         return self._chunk_store.put_chunk_content(content)
 
+    def put_chunk_contents(self, contents):
+        return self._chunk_store.put_chunk_contents(contents)
+
+    def get_chunk_contents(self, chunk_ids, read_ahead=1, num_workers=0):
+        pipeline = obnamlib.OrderedPipeline(
+            self._chunk_store.get_chunk_content, num_workers, read_ahead)
+        return pipeline.run(chunk_ids)
+
     def get_chunk_content(self, chunk_id):
         return self._chunk_store.get_chunk_content(chunk_id)
 
@@ -992,9 +1097,18 @@ class RepositoryFormatSimple(obnamlib.RepositoryInterface):
     def remove_chunk(self, chunk_id):
         return self._chunk_store.remove_chunk(chunk_id)
 
+    def remove_chunks(self, chunk_ids):
+        return self._chunk_store.remove_chunks(chunk_ids)
+
     def get_chunk_ids(self):
         return self._chunk_store.get_chunk_ids()
 
+    def repack_chunks(self, min_live_ratio):
+        self._chunk_indexes._require_lock()
+
+    def remove_pending_chunks(self, grace_period):
+        self._chunk_indexes._require_lock()
+
     #
     # Chunk indexes methods.
     #
@@ -0,0 +1,155 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+
+class LocalMetadataCache(object):
+
+    '''A local cache of file metadata in the latest backup generation.
+
+    When backing up, Obnam needs to know if a file has changed since
+    the previous generation, and that requires looking up the file's
+    metadata in the repository. That can be slow, especially over a
+    network. This cache stores the relevant metadata of every file in
+    the latest generation in a local file, so that unchanged files
+    can be skipped without asking the repository.
+
+    The cache is only used if it was saved for the same repository,
+    client, and generation as the one that is now the latest one.
+    Otherwise it is ignored, and the repository is used instead.
+
+    A new cache is built while the backup runs, and it replaces the
+    old one when save is called, after the new generation has been
+    committed.
+
+    '''
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._new_filename = filename + '.new'
+        self._old = None
+        self._new = None
+
+    def open(self, repository, client_name, generation):
+        '''Open the cache for a given latest generation.
+
+        The generation is given as a generation spec string.
+
+        '''
+
+        self._identity = (repository, client_name)
+        self._old = self._open_old(repository, client_name, generation)
+
+        if os.path.exists(self._new_filename):
+            os.remove(self._new_filename)
+        self._new = sqlite3.connect(self._new_filename)
+        self._new.execute(
+            'CREATE TABLE identity '
+            '(repository BLOB, client_name BLOB, generation BLOB)')
+        self._new.execute(
+            'CREATE TABLE files (pathname BLOB PRIMARY KEY, value TEXT)')
+
+    def _open_old(self, repository, client_name, generation):
+        if not os.path.exists(self._filename):
+            return None
+        try:
+            conn = sqlite3.connect(self._filename)
+            row = conn.execute(
+                'SELECT repository, client_name, generation '
+                'FROM identity').fetchone()
+        except sqlite3.Error as e:
+            logging.warning(
+                'Ignoring broken metadata cache %s: %s', self._filename, e)
+            return None
+        wanted = (repository, client_name, generation)
+        if row is None or tuple(str(x) for x in row) != wanted:
+            logging.info(
+                'Ignoring metadata cache %s: it is for another generation',
+                self._filename)
+            conn.close()
+            return None
+        return conn
+
+    def _value(self, metadata):
+        fields = (
+            metadata.st_dev,
+            metadata.st_ino,
+            metadata.st_mtime_sec,
+            metadata.st_mtime_nsec,
+            metadata.st_mode,
+            metadata.st_nlink,
+            metadata.st_size,
+            metadata.st_uid,
+            metadata.st_gid,
+            # None and '' both mean there are no extended attributes.
+            hashlib.md5(metadata.xattr or '').hexdigest(),
+        )
+        return ' '.join(str(x) for x in fields)
+
+    def file_is_unchanged(self, pathname, metadata):
+        '''Is the file known to be unchanged since the latest generation?
+
+        If the cache does not know, the answer is False.
+
+        '''
+
+        if self._old is None:
+            return False
+        row = self._old.execute(
+            'SELECT value FROM files WHERE pathname = ?',
+            (sqlite3.Binary(pathname),)).fetchone()
+        return row is not None and str(row[0]) == self._value(metadata)
+
+    def remember_file(self, pathname, metadata):
+        '''Remember a file that is in the new generation.'''
+        self._new.execute(
+            'INSERT OR REPLACE INTO files (pathname, value) VALUES (?, ?)',
+            (sqlite3.Binary(pathname), self._value(metadata)))
+
+    def save(self, generation):
+        '''Replace the old cache with the new one.
+
+        The generation spec is for the new generation, which must
+        have been committed to the repository already.
+
+        '''
+
+        repository, client_name = self._identity
+        self._new.execute(
+            'INSERT INTO identity VALUES (?, ?, ?)',
+            (sqlite3.Binary(repository),
+             sqlite3.Binary(client_name),
+             sqlite3.Binary(generation)))
+        self._new.commit()
+        self._new.close()
+        self._new = None
+        self.close()
+        os.rename(self._new_filename, self._filename)
+
+    def close(self):
+        '''Close the cache, dropping the new one if it was not saved.'''
+        if self._old is not None:
+            self._old.close()
+            self._old = None
+        if self._new is not None:
+            self._new.close()
+            self._new = None
+            if os.path.exists(self._new_filename):
+                os.remove(self._new_filename)
@@ -0,0 +1,91 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class LocalMetadataCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache')
+        self.metadata = obnamlib.Metadata(
+            st_dev=1, st_ino=2, st_mtime_sec=3, st_mtime_nsec=4,
+            st_mode=0100644, st_nlink=1, st_size=5, st_uid=6, st_gid=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self, generation):
+        cache = obnamlib.LocalMetadataCache(self.filename)
+        cache.open('repo', 'client', generation)
+        return cache
+
+    def save_one_file(self):
+        cache = self.new_cache('1')
+        cache.remember_file('/foo', self.metadata)
+        cache.save('2')
+
+    def test_knows_nothing_initially(self):
+        cache = self.new_cache('1')
+        self.assertFalse(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_knows_unchanged_file_after_saving(self):
+        self.save_one_file()
+        cache = self.new_cache('2')
+        self.assertTrue(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_reports_changed_file_as_changed(self):
+        self.save_one_file()
+        cache = self.new_cache('2')
+        self.metadata.st_mtime_nsec += 1
+        self.assertFalse(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_reports_changed_xattrs_as_changed(self):
+        self.save_one_file()
+        cache = self.new_cache('2')
+        self.metadata.xattr = 'blob'
+        self.assertFalse(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_ignores_cache_for_other_generation(self):
+        self.save_one_file()
+        cache = self.new_cache('3')
+        self.assertFalse(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_keeps_old_cache_when_new_one_is_not_saved(self):
+        self.save_one_file()
+        cache = self.new_cache('2')
+        cache.close()
+        cache = self.new_cache('2')
+        self.assertTrue(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
+
+    def test_ignores_broken_cache_file(self):
+        with open(self.filename, 'w') as f:
+            f.write('this is not a cache')
+        cache = self.new_cache('1')
+        self.assertFalse(cache.file_is_unchanged('/foo', self.metadata))
+        cache.close()
@@ -0,0 +1,140 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import Queue
+import sys
+import threading
+
+
+class OrderedPipeline(object):
+
+    '''Process a sequence of items in stages, returning them in order.
+
+    The items are produced by iterating over a sequence in a reader
+    thread. A pool of worker threads calls a function on each item,
+    and the caller gets the results from the run method in the same
+    order as the reader produced the items. The caller is thus the
+    last stage of the pipeline, and anything done with the results
+    happens in the caller's thread.
+
+    At most queue_size items are in flight at any one time, so the
+    reader never gets too far ahead of the caller, and memory use
+    stays bounded.
+
+    If the reader or a worker raises an exception, it is re-raised
+    by run when the caller gets to the item where it happened.
+
+    With zero workers, no threads are used, and everything happens
+    in the caller's thread.
+
+    '''
+
+    # How often, in seconds, blocked threads check if they should quit.
+    poll_interval = 0.1
+
+    def __init__(self, func, num_workers, queue_size):
+        self._func = func
+        self._num_workers = num_workers
+        self._queue_size = max(1, queue_size)
+
+    def run(self, items):
+        if self._num_workers <= 0:
+            return self._run_serially(items)
+        else:
+            return self._run_in_threads(items)
+
+    def _run_serially(self, items):
+        for item in items:
+            yield self._func(item)
+
+    def _run_in_threads(self, items):
+        stopping = threading.Event()
+        tickets = Queue.Queue(self._queue_size)
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def get_ticket():
+            while not stopping.is_set():
+                try:
+                    tickets.put(None, timeout=self.poll_interval)
+                except Queue.Full:
+                    pass
+                else:
+                    return True
+            return False
+
+        def reader():
+            seqno = 0
+            try:
+                try:
+                    for item in items:
+                        if not get_ticket():
+                            return
+                        todo.put((seqno, item))
+                        seqno += 1
+                except BaseException:
+                    done.put((seqno, 'error', sys.exc_info()))
+                else:
+                    done.put((seqno, 'end', None))
+            finally:
+                for i in range(self._num_workers):
+                    todo.put(None)
+
+        def worker():
+            while True:
+                job = todo.get()
+                if job is None:
+                    break
+                seqno, item = job
+                if stopping.is_set():
+                    continue
+                try:
+                    result = self._func(item)
+                except BaseException:
+                    done.put((seqno, 'error', sys.exc_info()))
+                else:
+                    done.put((seqno, 'result', result))
+
+        threads = [threading.Thread(target=reader)]
+        threads += [threading.Thread(target=worker)
+                    for i in range(self._num_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            pending = {}
+            next_seqno = 0
+            while True:
+                while next_seqno not in pending:
+                    try:
+                        seqno, kind, value = done.get(
+                            timeout=self.poll_interval)
+                    except Queue.Empty:
+                        continue
+                    pending[seqno] = (kind, value)
+                kind, value = pending.pop(next_seqno)
+                next_seqno += 1
+                if kind == 'end':
+                    break
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                tickets.get_nowait()
+                yield value
+        finally:
+            stopping.set()
+            for thread in threads:
+                thread.join()
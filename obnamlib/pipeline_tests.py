@@ -0,0 +1,100 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import time
+import unittest
+
+import obnamlib
+
+
+class OrderedPipelineTests(unittest.TestCase):
+
+    def double(self, item):
+        return item * 2
+
+    def test_returns_nothing_for_no_items(self):
+        pipeline = obnamlib.OrderedPipeline(self.double, 4, 2)
+        self.assertEqual(list(pipeline.run([])), [])
+
+    def test_returns_results_in_order_without_workers(self):
+        pipeline = obnamlib.OrderedPipeline(self.double, 0, 2)
+        self.assertEqual(list(pipeline.run(range(10))), range(0, 20, 2))
+
+    def test_returns_results_in_order_with_workers(self):
+        def slow_double(item):
+            time.sleep(random.random() * 0.01)
+            return item * 2
+        pipeline = obnamlib.OrderedPipeline(slow_double, 4, 3)
+        self.assertEqual(list(pipeline.run(range(50))), range(0, 100, 2))
+
+    def test_reads_items_in_order_in_one_thread(self):
+        def items():
+            for i in range(20):
+                yield i
+        pipeline = obnamlib.OrderedPipeline(self.double, 4, 3)
+        self.assertEqual(list(pipeline.run(items())), range(0, 40, 2))
+
+    def test_does_not_read_too_far_ahead(self):
+        read = []
+        def items():
+            for i in range(100):
+                read.append(i)
+                yield i
+        pipeline = obnamlib.OrderedPipeline(self.double, 2, 5)
+        results = pipeline.run(items())
+        results.next()
+        time.sleep(0.1)
+        self.assertTrue(len(read) <= 7)
+        results.close()
+
+    def test_raises_worker_exception_in_order(self):
+        def func(item):
+            if item == 5:
+                raise ZeroDivisionError()
+            return item
+        got = []
+        pipeline = obnamlib.OrderedPipeline(func, 4, 3)
+        try:
+            for result in pipeline.run(range(10)):
+                got.append(result)
+        except ZeroDivisionError:
+            pass
+        else:
+            self.fail('exception not raised')
+        self.assertEqual(got, range(5))
+
+    def test_raises_reader_exception_in_order(self):
+        def items():
+            for i in range(3):
+                yield i
+            raise ZeroDivisionError()
+        got = []
+        pipeline = obnamlib.OrderedPipeline(self.double, 4, 3)
+        try:
+            for result in pipeline.run(items()):
+                got.append(result)
+        except ZeroDivisionError:
+            pass
+        else:
+            self.fail('exception not raised')
+        self.assertEqual(got, [0, 2, 4])
+
+    def test_stops_cleanly_when_caller_stops_early(self):
+        pipeline = obnamlib.OrderedPipeline(self.double, 4, 3)
+        results = pipeline.run(xrange(10**9))
+        self.assertEqual(results.next(), 0)
+        results.close()
@@ -273,6 +273,52 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             default=obnamlib.DEFAULT_CHUNKIDS_PER_GROUP,
             group=perf_group)
 
+        self.app.settings.integer(
+            ['backup-workers'],
+            'use NUM threads for computing checksums of file '
+            'contents while backing up, while another thread '
+            'reads the files and the main thread uploads; '
+            'use 0 to do everything in the main thread',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_BACKUP_WORKERS,
+            group=perf_group)
+
+        self.app.settings.integer(
+            ['backup-queue-size'],
+            'allow at most NUM chunks of file data to be read '
+            'ahead of the upload during backups',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_BACKUP_QUEUE_SIZE,
+            group=perf_group)
+
+        self.app.settings.integer(
+            ['upload-batch-size'],
+            'upload new chunks of file data in batches of NUM '
+            'chunks during backups',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_UPLOAD_BATCH_SIZE,
+            group=perf_group)
+
+        self.app.settings.integer(
+            ['scan-threads'],
+            'list directories in NUM threads in parallel, ahead of '
+            'the backup, when looking for files to back up; this '
+            'helps when file metadata is slow to access, such as on '
+            'network filesystems; use 0 to list directories one '
+            'at a time',
+            metavar='NUM',
+            default=obnamlib.DEFAULT_SCAN_THREADS,
+            group=perf_group)
+
+        self.app.settings.string(
+            ['metadata-cache'],
+            'keep a local cache of file metadata in the latest '
+            'generation in FILE, to find unchanged files without '
+            'looking them up in the repository; use a separate '
+            'file for each repository and client',
+            metavar='FILE',
+            group=perf_group)
+
         # Development related settings.
 
         devel_group = obnamlib.option_group['devel']
@@ -304,6 +350,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.backup_roots(roots)
             if not self.pretend:
                 self.finish_generation()
+                self.save_metadata_cache()
                 if self.should_remove_checkpoints():
                     self.remove_checkpoints()
             self.finish_backup(args)
@@ -311,6 +358,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             logging.debug('Handling exception %s' % str(e))
             logging.debug(traceback.format_exc())
             self.unlock_when_error()
+            self.close_metadata_cache()
             raise
 
         if self.progress.errors:
@@ -342,6 +390,35 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.repo,
             self.app.settings['checkpoint'])
 
+        self.metadata_cache = self.open_metadata_cache()
+
+    def open_metadata_cache(self):
+        filename = self.app.settings['metadata-cache']
+        if not filename:
+            return None
+
+        self.progress.what('opening local metadata cache')
+        gens = self.repo.get_client_generation_ids(self.client_name)
+        if gens:
+            latest = self.repo.make_generation_spec(gens[-1])
+        else:
+            latest = ''
+        cache = obnamlib.LocalMetadataCache(filename)
+        cache.open(self.app.settings['repository'], self.client_name, latest)
+        return cache
+
+    def save_metadata_cache(self):
+        if self.metadata_cache is not None:
+            self.progress.what('saving local metadata cache')
+            self.metadata_cache.save(
+                self.repo.make_generation_spec(self.new_generation))
+            self.metadata_cache = None
+
+    def close_metadata_cache(self):
+        if self.metadata_cache is not None:
+            self.metadata_cache.close()
+            self.metadata_cache = None
+
     def configure_progress_reporting(self):
         self.progress = BackupProgress(self.app.ts)
 
@@ -403,6 +480,9 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         
         self.progress.what(prefix + 'committing client')
         self.repo.commit_client(self.client_name)
+
+        self.progress.what(prefix + 'removing unused chunks')
+        self.remove_pending_chunks()
         
         self.progress.what(prefix + 'committing shared B-trees')
         self.repo.commit_chunk_indexes()
@@ -425,10 +505,23 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         self.progress.what(prefix + ': committing client')
         self.repo.commit_client(self.client_name)
 
+        self.progress.what(prefix + ': removing unused chunks')
+        self.remove_pending_chunks()
+
         self.progress.what(prefix + ': commiting shared B-trees')
         self.repo.commit_chunk_indexes()
 
+    def remove_pending_chunks(self):
+        # Chunks that forget, or removing checkpoints, left unused are
+        # only marked for removal. Remove the ones whose grace period
+        # is over, while we hold the chunk indexes lock anyway, so that
+        # running backups frees space even if forget is run rarely.
+        self.repo.remove_pending_chunks(
+            self.app.settings['forget-grace-period'])
+
     def finish_backup(self, args):
+        self.close_metadata_cache()
+
         self.progress.what('closing connection to repository')
         self.repo.close()
 
@@ -571,6 +664,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             assert metadata.md5 is None
             metadata.md5 = self.backup_file_contents(pathname, metadata)
             self.backup_metadata(pathname, metadata)
+            self.remember_file(pathname, metadata)
 
     def open_fs(self, root):
         def func(rootdir):
@@ -674,7 +768,9 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         '''
 
-        for pathname, st in self.fs.scan_tree(root, ok=self.can_be_backed_up):
+        scanner = obnamlib.TreeScanner(
+            self.fs, self.app.settings['scan-threads'])
+        for pathname, st in scanner.scan_tree(root, ok=self.can_be_backed_up):
             tracing.trace('considering %s' % pathname)
             try:
                 metadata = obnamlib.read_metadata(self.fs, pathname, st=st)
@@ -682,6 +778,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                 if self.needs_backup(pathname, metadata):
                     yield pathname, metadata
                 else:
+                    self.remember_file(pathname, metadata)
                     self.progress.update_progress_with_scanned(
                         metadata.st_size)
             except GeneratorExit:
@@ -693,6 +790,8 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                 msg = 'Cannot back up %s: %s' % (pathname, str(e))
                 self.progress.error(msg, e)
 
+        scanner.log_stats()
+
     def can_be_backed_up(self, pathname, st):
         if self.just_one_file:
             return pathname == self.just_one_file
@@ -719,10 +818,20 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             tracing.trace('%s is directory, so needs backup' % pathname)
             return True
 
+        if (self.metadata_cache is not None and
+            self.metadata_cache.file_is_unchanged(pathname, current)):
+            tracing.trace('%s is unchanged according to cache' % pathname)
+            return False
+
         gen = self.get_current_generation()
         tracing.trace('gen=%s' % repr(gen))
         return self.metadata_has_changed(gen, pathname, current)
 
+    def remember_file(self, pathname, metadata):
+        '''Remember a non-directory that is in the new generation.'''
+        if self.metadata_cache is not None and not self.pretend:
+            self.metadata_cache.remember_file(pathname, metadata)
+
     def get_current_generation(self):
         '''Return the current generation.
 
@@ -779,51 +888,10 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         return False
 
     def get_metadata_from_generation(self, gen, pathname):
-        return obnamlib.Metadata(
-            st_mtime_sec=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_MTIME_SEC),
-            st_mtime_nsec=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_MTIME_NSEC),
-            st_mode=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_MODE),
-            st_nlink=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_NLINK),
-            st_size=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_SIZE),
-            st_uid=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_UID),
-            st_gid=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_GID),
-            xattr=self.repo.get_file_key(
-                gen, pathname, obnamlib.REPO_FILE_XATTR_BLOB))
+        return self.repo.get_file_metadata(gen, pathname)
 
     def add_file_to_generation(self, filename, metadata):
-        self.repo.add_file(self.new_generation, filename)
-
-        things = [
-            ('st_mtime_sec', obnamlib.REPO_FILE_MTIME_SEC),
-            ('st_mtime_nsec', obnamlib.REPO_FILE_MTIME_NSEC),
-            ('st_atime_sec', obnamlib.REPO_FILE_ATIME_SEC),
-            ('st_atime_nsec', obnamlib.REPO_FILE_ATIME_NSEC),
-            ('st_mode', obnamlib.REPO_FILE_MODE),
-            ('st_nlink', obnamlib.REPO_FILE_NLINK),
-            ('st_size', obnamlib.REPO_FILE_SIZE),
-            ('st_uid', obnamlib.REPO_FILE_UID),
-            ('st_gid', obnamlib.REPO_FILE_GID),
-            ('st_blocks', obnamlib.REPO_FILE_BLOCKS),
-            ('st_dev', obnamlib.REPO_FILE_DEV),
-            ('st_ino', obnamlib.REPO_FILE_INO),
-            ('username', obnamlib.REPO_FILE_USERNAME),
-            ('groupname', obnamlib.REPO_FILE_GROUPNAME),
-            ('target', obnamlib.REPO_FILE_SYMLINK_TARGET),
-            ('xattr', obnamlib.REPO_FILE_XATTR_BLOB),
-            ('md5', obnamlib.REPO_FILE_MD5),
-            ]
-
-        for field, key in things:
-            self.repo.set_file_key(
-                self.new_generation, filename, key, 
-                getattr(metadata, field))
+        self.repo.set_file_metadata(self.new_generation, filename, metadata)
 
     def backup_parents(self, root):
         '''Back up parents of root, non-recursively.'''
@@ -832,6 +900,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         dummy_metadata = obnamlib.Metadata(st_mode=0777 | stat.S_IFDIR)
 
+        parents = []
         while True:
             parent = os.path.dirname(root)
             try:
@@ -842,13 +911,15 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                         (root, e.errno or 0, e.strerror))
                 logging.warning('Using fake metadata instead for %s' % root)
                 metadata = dummy_metadata
-            if not self.pretend:
-                self.add_file_to_generation(root, metadata)
+            parents.append((root, metadata))
 
             if root == parent:
                 break
             root = parent
 
+        if not self.pretend:
+            self.repo.set_files_metadata(self.new_generation, parents)
+
     def backup_metadata(self, pathname, metadata):
         '''Back up metadata for a filesystem object'''
 
@@ -881,29 +952,48 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         summer = hashlib.md5()
 
-        chunk_size = int(self.app.settings['chunk-size'])
-        while True:
-            tracing.trace('reading some data')
-            self.progress.update_progress()
-            data = f.read(chunk_size)
-            if not data:
-                tracing.trace('end of data')
-                break
-            tracing.trace('got %d bytes of data' % len(data))
-            self.progress.update_progress_with_scanned(len(data))
-            summer.update(data)
-            if not self.pretend:
-                chunk_id = self.backup_file_chunk(data)
+        def read_chunks():
+            # This is run in the pipeline's reader thread. The file
+            # checksum needs the data in order, so it is computed here.
+            for data in self.open_chunker(f):
+                summer.update(data)
+                yield data
+
+        def prepare_chunk(data):
+            # This is run in a pipeline worker thread, so it must not
+            # touch any repository state.
+            return data, self.repo.prepare_chunk_for_indexes(data)
+
+        pipeline = obnamlib.OrderedPipeline(
+            prepare_chunk,
+            self.app.settings['backup-workers'],
+            self.app.settings['backup-queue-size'])
+
+        batch_size = max(1, self.app.settings['upload-batch-size'])
+        batch = []
+
+        def upload_batch():
+            chunk_ids = self.backup_file_chunks(batch)
+            for chunk_id in chunk_ids:
                 self.repo.append_file_chunk_id(
                     self.new_generation, filename, chunk_id)
-            else:
-                self.progress.update_progress_with_upload(len(data))
+            del batch[:]
 
-            if not self.pretend:
-                if self.checkpoint_manager.time_for_checkpoint():
-                    logging.debug('making checkpoint in the middle of a file')
-                    self.make_checkpoint()
-                    self.progress.what(filename)
+            if self.checkpoint_manager.time_for_checkpoint():
+                logging.debug('making checkpoint in the middle of a file')
+                self.make_checkpoint()
+                self.progress.what(filename)
+
+        for data, token in pipeline.run(read_chunks()):
+            self.progress.update_progress()
+            tracing.trace('got %d bytes of data' % len(data))
+            self.progress.update_progress_with_scanned(len(data))
+            batch.append((data, token))
+            if len(batch) >= batch_size:
+                upload_batch()
+        if batch:
+            upload_batch()
+        tracing.trace('end of data')
 
         tracing.trace('closing file')
         f.close()
@@ -912,8 +1002,79 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         tracing.trace('done backing up file contents')
         return summer.digest()
 
-    def backup_file_chunk(self, data):
-        '''Back up a chunk of data by putting it into the repository.'''
+    def open_chunker(self, f):
+        '''Return an iterator over the chunks of data in a file.'''
+        chunk_size = int(self.app.settings['chunk-size'])
+        if self.app.settings['chunking'] == 'rolling':
+            return obnamlib.ContentDefinedChunker(
+                f,
+                int(self.app.settings['chunk-min-size']),
+                chunk_size,
+                int(self.app.settings['chunk-max-size']))
+        else:
+            return obnamlib.FixedSizeChunker(f, chunk_size)
+
+    def backup_file_chunk(self, data, token=None):
+        '''Back up a chunk of data by putting it into the repository.
+
+        If the caller has already computed the chunk's token for the
+        chunk indexes, it can be given to avoid computing it again.
+
+        '''
+
+        return self.backup_file_chunks([(data, token)])[0]
+
+    def backup_file_chunks(self, chunks):
+        '''Back up a batch of chunks of data.
+
+        The chunks are given as a list of (data, token) pairs, where
+        the token may be None. Chunks that need to be uploaded are
+        put into the repository together, with one call to
+        put_chunk_contents. Return the list of chunk ids.
+
+        '''
+
+        mode = self.app.settings['deduplicate']
+        chunk_ids = [None] * len(chunks)
+        new_datas = []
+        new_tokens = []
+        positions = []
+
+        for i, (data, token) in enumerate(chunks):
+            if token is None:
+                token = self.repo.prepare_chunk_for_indexes(data)
+            chunk_id = self._find_existing_chunk(mode, data, token)
+            if chunk_id is not None:
+                chunk_ids[i] = chunk_id
+                continue
+
+            # A chunk may be repeated within the batch. It has not been
+            # uploaded yet, so find_chunk_ids_by_content can't find it.
+            for j in range(len(new_datas)):
+                if self._is_same_chunk(
+                        mode, data, token, new_datas[j], new_tokens[j]):
+                    positions[j].append(i)
+                    break
+            else:
+                new_datas.append(data)
+                new_tokens.append(token)
+                positions.append([i])
+
+        for data in new_datas:
+            self.progress.update_progress_with_upload(len(data))
+        new_chunk_ids = self.repo.put_chunk_contents(new_datas)
+
+        for chunk_id, token, where in zip(new_chunk_ids, new_tokens, positions):
+            if mode != 'never':
+                self.chunkid_token_map.add(chunk_id, token)
+            for i in where:
+                chunk_ids[i] = chunk_id
+
+        return chunk_ids
+
+    def _find_existing_chunk(self, mode, data, token):
+        # Return the id of a chunk in the repository, or one uploaded
+        # earlier during this backup, with the same content, or None.
 
         def find():
             # We ignore lookup errors here intentionally. We're reading
@@ -932,43 +1093,38 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         def get(chunkid):
             return self.repo.get_chunk_content(chunkid)
 
-        def put():
-            self.progress.update_progress_with_upload(len(data))
-            return self.repo.put_chunk_content(data)
-
         def share(chunkid):
             self.chunkid_token_map.add(chunkid, token)
 
-        token = self.repo.prepare_chunk_for_indexes(data)
-
-        mode = self.app.settings['deduplicate']
         if mode == 'never':
-            return put()
+            return None
         elif mode == 'verify':
             for chunkid in find():
                 data2 = get(chunkid)
                 if data == data2:
                     share(chunkid)
                     return chunkid
-            else:
-                chunkid = put()
-                share(chunkid)
-                return chunkid
+            return None
         elif mode == 'fatalist':
             existing = find()
             if existing:
                 chunkid = existing[0]
-            else:
-                chunkid = put()
-            share(chunkid)
-            return chunkid
+                share(chunkid)
+                return chunkid
+            return None
         else:
             if not hasattr(self, 'bad_deduplicate_reported'):
                 logging.error('unknown --deduplicate setting value')
                 self.bad_deduplicate_reported = True
-            chunkid = put()
-            share(chunkid)
-            return chunkid
+            return None
+
+    def _is_same_chunk(self, mode, data1, token1, data2, token2):
+        if mode == 'verify':
+            return data1 == data2
+        elif mode == 'fatalist':
+            return token1 == token2
+        else:
+            return False
 
     def backup_dir_contents(self, root, no_delete_paths=None):
         '''Back up the list of files in a directory.
@@ -17,45 +17,265 @@
 import logging
 import zlib
 
+try:
+    import zstandard
+except ImportError: # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError: # pragma: no cover
+    lz4 = None
+
 import obnamlib
 
-class DeflateCompressionFilter(object):
+
+class CompressionModuleNotFoundError(obnamlib.ObnamError):
+
+    msg = ('Failed to load Python module "{module}", which is needed for '
+           '{method} compression')
+
+
+class CompressionFilter(object):
+
+    '''Base class for compression filters.
+
+    Subclasses set the tag, and define compress and decompress. Data
+    is only compressed if the settings say this compression method
+    is to be used for the kind of data being written. All data with
+    the filter's tag can be decompressed, regardless of settings.
+
+    '''
+
+    # The name of the compression method in settings.
+    method = None
 
     def __init__(self, app):
-        self.tag = "deflate"
         self.app = app
-        self.warned = False
 
     def filter_read(self, data, repo, toplevel):
-        return zlib.decompress(data)
+        return self.decompress(data)
 
     def filter_write(self, data, repo, toplevel):
-        how = self.app.settings['compress-with']
-        if how == 'deflate':
-            data = zlib.compress(data)
-        elif how == 'gzip':
-            if not self.warned:
-                self.app.ts.notify("--compress-with=gzip is deprecated.  " +
-                                   "Use --compress-with=deflate instead")
-                self.warned = True
-            data = zlib.compress(data)
+        method, level = get_compression_settings(self.app, repo, toplevel)
+        if method != self.method:
+            return data
+
+        probe_size = self.app.settings['compress-probe-size']
+        if probe_size > 0 and not looks_compressible(data, probe_size):
+            return data
+
+        compressed = self.compress(data, level)
+
+        # If data doesn't compress well, store it as is. It then gets
+        # no tag, so reading it doesn't cost anything either.
+        threshold = self.app.settings['compress-threshold']
+        if len(compressed) * 100 >= len(data) * threshold:
+            return data
+        return compressed
+
+    def compress(self, data, level):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class DeflateCompressionFilter(CompressionFilter):
+
+    tag = 'deflate'
+    method = 'deflate'
+
+    def compress(self, data, level):
+        return zlib.compress(data, level or zlib.Z_DEFAULT_COMPRESSION)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressionFilter(CompressionFilter):
+
+    tag = 'zstd'
+    method = 'zstd'
+
+    def _require_module(self):
+        if zstandard is None:
+            raise CompressionModuleNotFoundError(
+                module='zstandard', method=self.method)
+
+    def compress(self, data, level):
+        # Compressor objects may not be shared between threads, and
+        # filters may be run in several threads, so we make a new one
+        # each time.
+        self._require_module()
+        compressor = zstandard.ZstdCompressor(level=level or 3)
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        self._require_module()
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4CompressionFilter(CompressionFilter):
+
+    tag = 'lz4'
+    method = 'lz4'
+
+    def _require_module(self):
+        if lz4 is None:
+            raise CompressionModuleNotFoundError(
+                module='lz4', method=self.method)
 
-        return data
+    def compress(self, data, level):
+        self._require_module()
+        return lz4.frame.compress(data, compression_level=level)
+
+    def decompress(self, data):
+        self._require_module()
+        return lz4.frame.decompress(data)
+
+
+# Data whose probe sample doesn't compress to less than this percent
+# of its size is not compressed at all. This is lower than what
+# --compress-threshold would normally be set to, since the probe uses
+# a fast, weak compression level and small samples.
+PROBE_THRESHOLD = 90
+
+
+def looks_compressible(data, probe_size):
+    '''Guess cheaply whether compressing data is worthwhile.
+
+    A sample of about probe_size bytes, taken from the beginning,
+    middle, and end of data, is compressed with the fastest deflate
+    level. Data that is already compressed or encrypted (JPEG, video,
+    gzip, etc) does not get smaller, and then we skip compressing
+    the whole thing. Small data is always considered compressible,
+    since probing it would cost about as much as compressing it.
+
+    '''
+
+    if len(data) <= 2 * probe_size:
+        return True
+
+    part = probe_size / 3
+    middle = len(data) / 2
+    sample = data[:part] + data[middle:middle+part] + data[-part:]
+    compressed = zlib.compress(sample, 1)
+    return len(compressed) * 100 < len(sample) * PROBE_THRESHOLD
+
+
+def get_compression_settings(app, repo, toplevel):
+    '''Return compression method and level for data in a toplevel.
+
+    Chunk data and the rest of the repository (B-tree nodes and other
+    metadata) have separate settings, which default to the common
+    --compress-with and --compress-level settings. A level of zero
+    means the compression method's own default level.
+
+    '''
+
+    method = app.settings['compress-with']
+    level = app.settings['compress-level']
+
+    if repo is not None and toplevel in repo.get_chunk_directories():
+        prefix = 'compress-chunks'
+    else:
+        prefix = 'compress-metadata'
+    if app.settings[prefix + '-with'] != 'default':
+        method = app.settings[prefix + '-with']
+    if app.settings[prefix + '-level'] != 0:
+        level = app.settings[prefix + '-level']
+
+    if method == 'gzip':
+        warn_about_gzip(app)
+        method = 'deflate'
+    return method, level
+
+
+def warn_about_gzip(app):
+    if not getattr(app, 'warned_about_gzip', False):
+        app.ts.notify("--compress-with=gzip is deprecated.  " +
+                      "Use --compress-with=deflate instead")
+        app.warned_about_gzip = True
 
 
 class CompressionPlugin(obnamlib.ObnamPlugin):
 
     def enable(self):
+        compression_group = obnamlib.option_group['compression'] = \
+            'Compression'
+
+        methods = ['none', 'deflate', 'gzip', 'zstd', 'lz4']
+
         self.app.settings.choice(
             ['compress-with'],
-            ['none', 'deflate', 'gzip'],
+            methods,
             'use PROGRAM to compress repository with '
-            '(one of none, deflate)',
-            metavar='PROGRAM')
+            '(one of none, deflate, zstd, lz4)',
+            metavar='PROGRAM',
+            group=compression_group)
+
+        self.app.settings.integer(
+            ['compress-level'],
+            'compression level (0 means the default level '
+            'for the compression program)',
+            metavar='LEVEL',
+            group=compression_group)
+
+        self.app.settings.choice(
+            ['compress-chunks-with'],
+            ['default'] + methods,
+            'use PROGRAM to compress file data '
+            '(default means the same as --compress-with)',
+            metavar='PROGRAM',
+            group=compression_group)
+
+        self.app.settings.integer(
+            ['compress-chunks-level'],
+            'compression level for file data '
+            '(0 means the same as --compress-level)',
+            metavar='LEVEL',
+            group=compression_group)
+
+        self.app.settings.choice(
+            ['compress-metadata-with'],
+            ['default'] + methods,
+            'use PROGRAM to compress B-tree nodes and other metadata '
+            '(default means the same as --compress-with)',
+            metavar='PROGRAM',
+            group=compression_group)
+
+        self.app.settings.integer(
+            ['compress-metadata-level'],
+            'compression level for B-tree nodes and other metadata '
+            '(0 means the same as --compress-level)',
+            metavar='LEVEL',
+            group=compression_group)
+
+        self.app.settings.integer(
+            ['compress-threshold'],
+            'store data uncompressed if compression does not make it '
+            'smaller than PERCENT percent of its original size',
+            metavar='PERCENT',
+            default=obnamlib.DEFAULT_COMPRESS_THRESHOLD,
+            group=compression_group)
+
+        self.app.settings.bytesize(
+            ['compress-probe-size'],
+            'before compressing data, compress a sample of SIZE bytes '
+            'to see if the data compresses at all; skip compression if '
+            'it does not (0 means always compress)',
+            metavar='SIZE',
+            default=obnamlib.DEFAULT_COMPRESS_PROBE_SIZE,
+            group=compression_group)
 
         hooks = [
             ('repository-data', DeflateCompressionFilter(self.app),
              obnamlib.Hook.EARLY_PRIORITY),
+            ('repository-data', ZstdCompressionFilter(self.app),
+             obnamlib.Hook.EARLY_PRIORITY),
+            ('repository-data', Lz4CompressionFilter(self.app),
+             obnamlib.Hook.EARLY_PRIORITY),
         ]
         for name, callback, prio in hooks:
             self.app.hooks.add_callback(name, callback, prio)
@@ -20,6 +20,32 @@ import os
 import obnamlib
 
 
+class AeadEncryptionFilter(object):
+
+    '''Encrypt repository data in-process, with AES-GCM.
+
+    This uses the same per-toplevel symmetric keys as the gpg based
+    encryption, but doesn't start a gpg process for each chunk and
+    B-tree node. Data encrypted with gpg can still be read, since it
+    has a different filter tag.
+
+    '''
+
+    def __init__(self, plugin):
+        self.tag = "aead1"
+        self.plugin = plugin
+
+    def filter_read(self, encrypted, repo, toplevel):
+        symmetric_key = self.plugin.get_symmetric_key(repo, toplevel)
+        return obnamlib.decrypt_symmetric_aead(encrypted, symmetric_key)
+
+    def filter_write(self, cleartext, repo, toplevel):
+        if not self.plugin.keyid or self.plugin.cipher != 'aead':
+            return cleartext
+        symmetric_key = self.plugin.get_symmetric_key(repo, toplevel)
+        return obnamlib.encrypt_symmetric_aead(cleartext, symmetric_key)
+
+
 class EncryptionPlugin(obnamlib.ObnamPlugin):
 
     def enable(self):
@@ -49,6 +75,16 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
             'size of symmetric key, in bits',
             metavar='BITS',
             group=encryption_group)
+        self.app.settings.choice(
+            ['symmetric-cipher'],
+            ['gpg', 'aead', 'auto'],
+            'use CIPHER to encrypt new data in the backup repository '
+            '(one of gpg, aead, auto; aead is AES-GCM done in-process, '
+            'which older versions of Obnam can\'t read, auto means '
+            'aead if the Python cryptography module is installed, '
+            'otherwise gpg)',
+            metavar='CIPHER',
+            group=encryption_group)
 
         self.tag = "encrypt1"
 
@@ -57,6 +93,8 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
              obnamlib.Hook.DEFAULT_PRIORITY),
             ('repository-data', self,
              obnamlib.Hook.LATE_PRIORITY),
+            ('repository-data', AeadEncryptionFilter(self),
+             obnamlib.Hook.LATE_PRIORITY),
             ('repository-add-client', self.add_client,
              obnamlib.Hook.DEFAULT_PRIORITY),
         ]
@@ -90,6 +128,15 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
             self._pubkey = obnamlib.get_public_key(self.keyid)
         return self._pubkey
 
+    @property
+    def cipher(self):
+        cipher = self.app.settings['symmetric-cipher']
+        if cipher == 'auto':
+            if obnamlib.aead_is_available():
+                return 'aead'
+            return 'gpg'
+        return cipher
+
     @property
     def devrandom(self):
         if self.app.settings['weak-random']:
@@ -131,8 +178,11 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
         return obnamlib.decrypt_symmetric(encrypted, symmetric_key)
 
     def filter_write(self, cleartext, repo, toplevel):
-        if not self.keyid:
+        if not self.keyid or self.cipher != 'gpg':
             return cleartext
+        return self._encrypt_with_gpg(cleartext, repo, toplevel)
+
+    def _encrypt_with_gpg(self, cleartext, repo, toplevel):
         symmetric_key = self.get_symmetric_key(repo, toplevel)
         return obnamlib.encrypt_symmetric(cleartext, symmetric_key)
 
@@ -151,7 +201,9 @@ class EncryptionPlugin(obnamlib.ObnamPlugin):
 
     def write_keyring(self, repo, toplevel, keyring):
         encoded = str(keyring)
-        encrypted = self.filter_write(encoded, repo, toplevel)
+        # The userkeys file is always encrypted with gpg, and
+        # read_keyring reads it without going through the filters.
+        encrypted = self._encrypt_with_gpg(encoded, repo, toplevel)
         pathname = os.path.join(toplevel, 'userkeys')
         self._overwrite_file(repo, pathname, encrypted)
 
@@ -30,6 +30,24 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
             ['keep'],
             'policy for what generations to keep '
             'when forgetting')
+        self.app.settings.integer(
+            ['repack-threshold'],
+            'after forgetting, rewrite chunk pack files where less '
+            'than PERCENT percent of the data is still in use '
+            '(0 means never)',
+            metavar='PERCENT',
+            default=obnamlib.DEFAULT_REPACK_THRESHOLD,
+            group=obnamlib.option_group['perf'])
+        self.app.settings.integer(
+            ['forget-grace-period'],
+            'remove chunks that forgetting leaves unused only when '
+            'forget or backup is run again at least SECONDS seconds '
+            'later, so that backups running meanwhile can still use '
+            'them; this should be longer than any backup runs between '
+            'checkpoints (0 means remove them right away, but lock out '
+            'all other clients while forgetting)',
+            metavar='SECONDS',
+            default=obnamlib.DEFAULT_FORGET_GRACE_PERIOD)
 
     def forget(self, args):
         '''Forget (remove) specified backup generations.'''
@@ -42,44 +60,39 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
 
         self.repo = self.app.get_repository_object()
 
-        # We lock everything. This is to avoid a race condition
-        # between different clients doing backup and forget at the
-        # same time. If we only lock the client we care about, plus
-        # the chunk indexes, the following scenario is possible:
+        # A backup by another client may be running at the same time.
+        # It reads the chunk indexes without a lock, and may decide to
+        # use a chunk that this forget is about to find unused. The
+        # backup will put the chunk back into the chunk indexes when it
+        # commits, but by then we may already have removed it.
         #
-        #       1. Client A locks itself, plus chunk indexes, and
-        #          starts running forget, but slowly.
-        #       2. Client B locks itself, and starts running a backup.
-        #          It merrily uses chunks that A thinks are only used
-        #          but A itself, since B hasn't updated the chunk
-        #          indexes, and can't do that before A is done.
-        #       3. Client A finishes doing forget, and removes a number
-        #          of chunks, because nobody else was marked as using
-        #          them. However, some of these chunks are now being
-        #          used by B.
-        #       4. A commits its changes.
-        #       5. B gains lock to chunk indexes, and commits its changes.
+        # To avoid this, the repository doesn't remove chunks when
+        # generations are removed, but marks them for removal later,
+        # and un-marks them when a backup puts them back into the
+        # chunk indexes. Here we remove chunks that were marked at
+        # least a grace period ago. As long as no backup runs longer
+        # than that between commits, nobody can be using them anymore.
+        # We only lock our own client, and the chunk indexes only
+        # while committing, so backups can run meanwhile.
         #
-        # At this point, the chunk indexes indicate that B uses some chunks,
-        # but A already removed the chunks.
-        #
-        # By locking all clients during a forget, we prevent this race
-        # condition: nobody else can be running a backup while anyone is
-        # running a forget. We also lock the client list to prevent a new
-        # client from being added.
-        #
-        # This is not a great solution, as it means that during a
-        # forget (which currently can be quite slow) nobody can do a
-        # backup. However, correctness trumps speed.
+        # With a grace period of zero, chunks are removed right away,
+        # and we lock all clients, so that nobody else can be running
+        # a backup while we run forget. We also lock the client list
+        # to prevent a new client from being added.
 
-        self.repo.lock_client_list()
-        client_names = self.repo.get_client_names()
-        for some_client_name in client_names:
-            self.repo.lock_client(some_client_name)
-        self.repo.lock_chunk_indexes()
+        client_name = self.app.settings['client-name']
+        grace_period = self.app.settings['forget-grace-period']
+        if grace_period > 0:
+            client_names = [client_name]
+            self.repo.lock_client(client_name)
+        else:
+            self.repo.lock_client_list()
+            client_names = self.repo.get_client_names()
+            for some_client_name in client_names:
+                self.repo.lock_client(some_client_name)
+            self.repo.lock_chunk_indexes()
 
         self.app.dump_memory_profile('at beginning')
-        client_name = self.app.settings['client-name']
         if args:
             self.app.ts['gens'] = args
             for genspec in args:
@@ -120,12 +133,18 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
                     self.repo.make_generation_spec(genid))
 
         # Commit or unlock everything.
-        self.repo.unlock_client_list()
+        if grace_period > 0:
+            self.repo.lock_chunk_indexes()
+        else:
+            self.repo.unlock_client_list()
         for some_client_name in client_names:
             if some_client_name == client_name:
                 self.repo.commit_client(some_client_name)
             else:
                 self.repo.unlock_client(some_client_name)
+        if not self.app.settings['pretend']:
+            self.repo.remove_pending_chunks(grace_period)
+        self.repack()
         self.repo.commit_chunk_indexes()
         self.app.dump_memory_profile('after committing')
 
@@ -139,3 +158,8 @@ class ForgetPlugin(obnamlib.ObnamPlugin):
                 self.repo.make_generation_spec(genid))
         else:
             self.repo.remove_generation(genid)
+
+    def repack(self):
+        threshold = self.app.settings['repack-threshold']
+        if threshold > 0 and not self.app.settings['pretend']:
+            self.repo.repack_chunks(threshold / 100.0)
@@ -309,7 +309,7 @@ class FsckPlugin(obnamlib.ObnamPlugin):
         self.repo.lock_chunk_indexes()
 
         self.errors = 0
-        self.chunkids_seen = set()
+        self.chunkids_seen = obnamlib.ChunkIdSet()
         self.work_items = []
         self.add_item(CheckRepository(), append=True)
 
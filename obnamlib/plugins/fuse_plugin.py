@@ -154,8 +154,10 @@ class ObnamFuseFile(object):
         # the chunk size was fixed, except for the last chunk for any
         # file.
 
-        chunkids = self.fuse_fs.obnam.repo.get_file_chunk_ids(gen, repopath)
-        output = []
+        repo = self.fuse_fs.obnam.repo
+        settings = self.fuse_fs.obnam.app.settings
+        chunkids = repo.get_file_chunk_ids(gen, repopath)
+        wanted = []
         output_length = 0
         chunk_pos_in_file = 0
         size_cache = self.fuse_fs.obnam.chunk_sizes
@@ -166,23 +168,36 @@ class ObnamFuseFile(object):
                 # in case it can be skipped completely.
                 contents = None
             else:
-                contents = self.fuse_fs.obnam.repo.get_chunk_content(chunkid)
+                contents = repo.get_chunk_content(chunkid)
                 size_cache[chunkid] = len(contents)
             size = size_cache[chunkid]
 
             if chunk_pos_in_file + size > offset + output_length:
                 start = offset + output_length - chunk_pos_in_file
                 n = min(length - output_length, size - start)
-                if contents is None:
-                    contents = self.fuse_fs.obnam.repo.get_chunk_content(
-                        chunkid)
-                output.append(contents[start : start+n])
+                wanted.append((chunkid, contents, start, n))
                 output_length += n
                 assert output_length <= length
                 if output_length == length:
                     break
             chunk_pos_in_file += size
 
+        # Fetch the chunks we still need all at once, so that they can
+        # be fetched in parallel.
+        missing = [chunkid for chunkid, contents, start, n in wanted
+                   if contents is None]
+        fetched = dict(zip(
+            missing,
+            repo.get_chunk_contents(
+                missing,
+                read_ahead=settings['read-ahead'],
+                num_workers=settings['read-workers'])))
+
+        output = []
+        for chunkid, contents, start, n in wanted:
+            if contents is None:
+                contents = fetched[chunkid]
+            output.append(contents[start : start+n])
         return ''.join(output)
 
     def release(self, flags):
@@ -282,8 +297,8 @@ class ObnamFuse(fuse.Fuse):
     def get_metadata_in_generation(self, path):
         tracing.trace('path=%r', path)
 
-        metadata = self.construct_metadata_object(
-            self.obnam.repo, *self.get_gen_path(path))
+        metadata = self.obnam.repo.get_file_metadata(
+            *self.get_gen_path(path))
 
         # FUSE does not allow negative timestamps, truncate to zero
         if metadata.st_atime_sec < 0:
@@ -293,34 +308,6 @@ class ObnamFuse(fuse.Fuse):
 
         return metadata
 
-    def construct_metadata_object(self, repo, gen, filename):
-        allowed = set(repo.get_allowed_file_keys())
-        def K(key):
-            if key in allowed:
-                return repo.get_file_key(gen, filename, key)
-            else:
-                return None
-
-        return obnamlib.Metadata(
-            st_atime_sec=K(obnamlib.REPO_FILE_ATIME_SEC),
-            st_atime_nsec=K(obnamlib.REPO_FILE_ATIME_NSEC),
-            st_mtime_sec=K(obnamlib.REPO_FILE_MTIME_SEC),
-            st_mtime_nsec=K(obnamlib.REPO_FILE_MTIME_NSEC),
-            st_blocks=K(obnamlib.REPO_FILE_BLOCKS),
-            st_dev=K(obnamlib.REPO_FILE_DEV),
-            st_gid=K(obnamlib.REPO_FILE_GID),
-            st_ino=K(obnamlib.REPO_FILE_INO),
-            st_mode=K(obnamlib.REPO_FILE_MODE),
-            st_nlink=K(obnamlib.REPO_FILE_NLINK),
-            st_size=K(obnamlib.REPO_FILE_SIZE),
-            st_uid=K(obnamlib.REPO_FILE_UID),
-            username=K(obnamlib.REPO_FILE_USERNAME),
-            groupname=K(obnamlib.REPO_FILE_GROUPNAME),
-            target=K(obnamlib.REPO_FILE_SYMLINK_TARGET),
-            xattr=K(obnamlib.REPO_FILE_XATTR_BLOB),
-            md5=K(obnamlib.REPO_FILE_MD5),
-            )
-
     def get_stat_in_generation(self, path):
         tracing.trace('path=%r', path)
         metadata = self.get_metadata_in_generation(path)
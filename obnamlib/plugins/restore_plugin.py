@@ -15,6 +15,7 @@
 
 
 import hashlib
+import itertools
 import logging
 import os
 import stat
@@ -182,47 +183,18 @@ class RestorePlugin(obnamlib.ObnamPlugin):
             raise RestoreErrors()
 
     def restore_something(self, gen, root):
-        for pathname in self.repo.walk_generation(gen, root):
+        for pathname, metadata in self.repo.walk_generation_metadata(
+                gen, root):
             self.file_count += 1
             self.app.ts['current'] = pathname
-            self.restore_safely(gen, pathname)
+            self.restore_safely(gen, pathname, metadata)
 
-    def construct_metadata_object(self, gen, filename):
-        allowed = set(self.repo.get_allowed_file_keys())
-        def K(key):
-            if key in allowed:
-                return self.repo.get_file_key(gen, filename, key)
-            else:
-                return None
-
-        return obnamlib.Metadata(
-            st_atime_sec=K(obnamlib.REPO_FILE_ATIME_SEC),
-            st_atime_nsec=K(obnamlib.REPO_FILE_ATIME_NSEC),
-            st_mtime_sec=K(obnamlib.REPO_FILE_MTIME_SEC),
-            st_mtime_nsec=K(obnamlib.REPO_FILE_MTIME_NSEC),
-            st_blocks=K(obnamlib.REPO_FILE_BLOCKS),
-            st_dev=K(obnamlib.REPO_FILE_DEV),
-            st_gid=K(obnamlib.REPO_FILE_GID),
-            st_ino=K(obnamlib.REPO_FILE_INO),
-            st_mode=K(obnamlib.REPO_FILE_MODE),
-            st_nlink=K(obnamlib.REPO_FILE_NLINK),
-            st_size=K(obnamlib.REPO_FILE_SIZE),
-            st_uid=K(obnamlib.REPO_FILE_UID),
-            username=K(obnamlib.REPO_FILE_USERNAME),
-            groupname=K(obnamlib.REPO_FILE_GROUPNAME),
-            target=K(obnamlib.REPO_FILE_SYMLINK_TARGET),
-            xattr=K(obnamlib.REPO_FILE_XATTR_BLOB),
-            md5=K(obnamlib.REPO_FILE_MD5),
-            )
-
-    def restore_safely(self, gen, pathname):
+    def restore_safely(self, gen, pathname, metadata):
         try:
             dirname = os.path.dirname(pathname)
             if self.write_ok and not self.fs.exists('./' + dirname):
                 self.fs.makedirs('./' + dirname)
 
-            metadata = self.construct_metadata_object(gen, pathname)
-
             set_metadata = True
             if metadata.isdir():
                 self.restore_dir(gen, pathname, metadata)
@@ -315,8 +287,11 @@ class RestorePlugin(obnamlib.ObnamPlugin):
     def restore_chunks(self, f, chunkids, checksummer):
         zeroes = ''
         hole_at_end = False
-        for chunkid in chunkids:
-            data = self.repo.get_chunk_content(chunkid)
+        contents = self.repo.get_chunk_contents(
+            chunkids,
+            read_ahead=self.app.settings['read-ahead'],
+            num_workers=self.app.settings['read-workers'])
+        for chunkid, data in itertools.izip(chunkids, contents):
             self.verify_chunk_checksum(data, chunkid)
             checksummer.update(data)
             self.downloaded_bytes += len(data)
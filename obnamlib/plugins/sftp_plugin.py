@@ -15,6 +15,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
+import contextlib
 import errno
 import hashlib
 import logging
@@ -24,6 +26,7 @@ import random
 import socket
 import stat
 import subprocess
+import threading
 import time
 import urlparse
 import getpass
@@ -144,6 +147,23 @@ class SSHChannelAdapter(object):
                 pass
 
 
+class PipelinedResponses(object):
+
+    '''Collect responses to pipelined SFTP requests.
+
+    paramiko gives responses to requests sent with _async_request to
+    the object given with the request, unless the response is being
+    waited for. This object keeps them until they're asked for.
+
+    '''
+
+    def __init__(self):
+        self.received = {}
+
+    def _async_response(self, t, msg, num):
+        self.received[num] = (t, msg)
+
+
 class SftpFS(obnamlib.VirtualFileSystem):
 
     '''A VFS implementation for SFTP.
@@ -156,19 +176,129 @@ class SftpFS(obnamlib.VirtualFileSystem):
     # for sftp transfers. I don't know why the size matters.
     chunk_size = 32 * 1024
 
+    # The number of requests to send before waiting for the response
+    # to the first one, when pipelining. This hides the latency of the
+    # network, as long as the server keeps up.
+    max_pipelined = 64
+
     def __init__(self, baseurl, create=False, settings=None):
         obnamlib.VirtualFileSystem.__init__(self, baseurl)
+        self._local = threading.local()
+        self._owner_thread = threading.current_thread()
+        self._stats_lock = threading.Lock()
+        self._setup_pool()
         self.sftp = None
         self.settings = settings
         self._roundtrips = 0
         self._initial_dir = None
+        self._known_dirs = set()
+        self._open_sets_mode = None
+        self._has_posix_rename = True
         self.reinit(baseurl, create=create)
         # Backwards compatibility with old, deprecated option:
         if settings and settings['strict-ssh-host-keys']:
             settings["ssh-host-keys-check"] = "yes"
 
+    # Besides the main SFTP session, there is a pool of other sessions
+    # to the same server, up to --sftp-connections in all. A thread
+    # takes a session from the pool for an operation, such as reading
+    # a file, and while it has one, self.sftp is that session in that
+    # thread. Thus different threads can read and write files at the
+    # same time, and wait for the network in parallel. Other operations
+    # use the main session.
+    #
+    # A paramiko session can't be used by several threads at once, so
+    # threads other than the one that created this object always use
+    # a session from the pool. If --sftp-connections is 1, they share
+    # one extra session, one at a time.
+
+    def _get_sftp(self):
+        return getattr(self._local, 'sftp', None) or self._sftp
+
+    def _set_sftp(self, sftp):
+        self._sftp = sftp
+
+    sftp = property(_get_sftp, _set_sftp)
+
+    def _setup_pool(self):
+        self._pool_cond = threading.Condition()
+        self._idle_sessions = []
+        self._num_pooled = 0
+
+    def _max_pooled(self):
+        if self.settings:
+            return self.settings['sftp-connections'] - 1
+        return 0
+
+    def _open_session(self):
+        if self.transport:
+            sftp = paramiko.SFTPClient.from_transport(self.transport)
+        else:
+            sftp = self._open_openssh_session()
+            if sftp is None: # pragma: no cover
+                raise OSError(
+                    errno.ENOENT, 'Could not run ssh', self.host)
+        sftp.chdir(self._sftp.getcwd())
+        return sftp
+
+    def _get_session(self):
+        pool_size = max(1, self._max_pooled())
+        with self._pool_cond:
+            while (not self._idle_sessions and
+                   self._num_pooled >= pool_size):
+                self._pool_cond.wait()
+            if self._idle_sessions:
+                return self._idle_sessions.pop()
+            self._num_pooled += 1
+
+        try:
+            return self._open_session()
+        except BaseException:
+            with self._pool_cond:
+                self._num_pooled -= 1
+                self._pool_cond.notify()
+            raise
+
+    def _put_session(self, sftp):
+        with self._pool_cond:
+            self._idle_sessions.append(sftp)
+            self._pool_cond.notify()
+
+    def _close_pool(self):
+        with self._pool_cond:
+            for sftp in self._idle_sessions:
+                sftp.close()
+            self._setup_pool()
+
+    @contextlib.contextmanager
+    def _pooled_session(self):
+        '''Use a session from the pool in this thread, if there is one.'''
+        if getattr(self._local, 'sftp', None):
+            yield
+            return
+        if (self._max_pooled() <= 0 and
+                threading.current_thread() is self._owner_thread):
+            yield
+            return
+        sftp = self._get_session()
+        self._local.sftp = sftp
+        try:
+            yield
+        finally:
+            self._local.sftp = None
+            self._put_session(sftp)
+
+    def _count_bytes_read(self, count):
+        with self._stats_lock:
+            self.bytes_read += count
+
+    def _count_bytes_written(self, count):
+        with self._stats_lock:
+            self.bytes_written += count
+
     def _delay(self):
-        self._roundtrips += 1
+        with self._stats_lock:
+            self._roundtrips += 1
         if self.settings:
             ms = self.settings['sftp-delay']
             if ms > 0:
@@ -205,6 +335,14 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self.chdir(self.path)
 
     def _connect_openssh(self):
+        sftp = self._open_openssh_session()
+        if sftp is None:
+            return False
+        self.transport = None
+        self.sftp = sftp
+        return True
+
+    def _open_openssh_session(self):
         executable = 'ssh'
         args = ['-oForwardX11=no', '-oForwardAgent=no',
                 '-oClearAllForwardings=yes', '-oProtocol=2',
@@ -237,11 +375,9 @@ class SftpFS(obnamlib.VirtualFileSystem):
                                     stdout=subprocess.PIPE,
                                     close_fds=True)
         except OSError:
-            return False
+            return None
 
-        self.transport = None
-        self.sftp = paramiko.SFTPClient(SSHChannelAdapter(proc))
-        return True
+        return paramiko.SFTPClient(SSHChannelAdapter(proc))
 
     def _connect_paramiko(self):
         remote = (self.host, self.port or 22)
@@ -324,6 +460,7 @@ class SftpFS(obnamlib.VirtualFileSystem):
 
     def close(self):
         logging.debug('SftpFS.close called')
+        self._close_pool()
         self.sftp.close()
         self.sftp = None
         if self.transport:
@@ -372,6 +509,9 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self._delay()
 
         if self.sftp:
+            # The pooled sessions are in the old directory.
+            self._close_pool()
+            self._known_dirs.clear()
             if create:
                 self._create_root_if_missing()
             logging.debug('chdir to %s' % path)
@@ -389,6 +529,7 @@ class SftpFS(obnamlib.VirtualFileSystem):
     def chdir(self, pathname):
         self._delay()
         self.sftp.chdir(pathname)
+        self._known_dirs.clear()
 
     @ioerror_to_oserror
     def listdir(self, pathname):
@@ -493,24 +634,195 @@ class SftpFS(obnamlib.VirtualFileSystem):
     def mkdir(self, pathname, mode=obnamlib.NEW_DIR_MODE):
         self._delay()
         self.sftp.mkdir(pathname, mode)
+        self._known_dirs.add(pathname)
 
     @ioerror_to_oserror
     def makedirs(self, pathname):
         parent = os.path.dirname(pathname)
-        if parent and parent != pathname and not self.exists(parent):
+        if (parent and parent != pathname and
+                parent not in self._known_dirs and not self.exists(parent)):
             self.makedirs(parent)
         self.mkdir(pathname, obnamlib.NEW_DIR_MODE)
 
+    # Directories that are known to exist, because they were created,
+    # or a file was written into them, are remembered, so that writing
+    # files doesn't need to check for them, or try to create them,
+    # over and over again. The pathnames are relative to the current
+    # directory, so they're forgotten when it changes.
+
+    def _ensure_dir(self, pathname):
+        '''Create a directory and its parents, unless they exist.'''
+        if not pathname or pathname in self._known_dirs:
+            return
+        parent = os.path.dirname(pathname)
+        if parent != pathname:
+            self._ensure_dir(parent)
+        try:
+            self.mkdir(pathname, obnamlib.NEW_DIR_MODE)
+        except OSError:
+            # The directory may exist already, or another thread may
+            # have created it at the same time.
+            if not self.isdir(pathname):
+                raise
+            self._known_dirs.add(pathname)
+
     @ioerror_to_oserror
     def rmdir(self, pathname):
         self._delay()
         self.sftp.rmdir(pathname)
+        self._known_dirs.clear()
 
     @ioerror_to_oserror
     def remove(self, pathname):
         self._delay()
         self.sftp.remove(pathname)
 
+    def remove_files(self, pathnames):
+        requests = (
+            (pathname, paramiko.sftp.CMD_REMOVE,
+             [self.sftp._adjust_cwd(pathname)])
+            for pathname in pathnames)
+        missing = []
+        for pathname, error in self._pipeline(requests):
+            if error is not None:
+                if error.errno != errno.ENOENT:
+                    raise error
+                missing.append(pathname)
+        return missing
+
+    def _pipeline(self, requests):
+        '''Send SFTP requests without waiting for each response.
+
+        requests is an iterable of (pathname, command, args) triples.
+        Generate a (pathname, error) pair for each, in the same order,
+        with error being None if the request succeeded, or an OSError.
+
+        paramiko only supports waiting for each response before
+        sending the next request, except for reading files, so this
+        uses its internal request methods.
+
+        '''
+
+        responses = PipelinedResponses()
+        in_flight = []
+        for i, (pathname, t, args) in enumerate(requests):
+            if i % self.max_pipelined == 0:
+                self._delay()
+            num = self.sftp._async_request(responses, t, *args)
+            in_flight.append((num, pathname))
+            if len(in_flight) >= self.max_pipelined:
+                num, pathname = in_flight.pop(0)
+                yield pathname, self._wait_for_response(
+                    responses, num, pathname)
+        for num, pathname in in_flight:
+            yield pathname, self._wait_for_response(responses, num, pathname)
+
+    def _wait_for_response(self, responses, num, pathname):
+        try:
+            self._get_response(responses, num)
+        except IOError, e:
+            return OSError(e.errno, e.strerror or str(e), pathname)
+        return None
+
+    def _get_response(self, responses, num):
+        '''Return response to a pipelined request, raise error status.'''
+        if num in responses.received:
+            t, msg = responses.received.pop(num)
+            if t == paramiko.sftp.CMD_STATUS:
+                self.sftp._convert_status(msg)
+            return t, msg
+        return self.sftp._read_response(num)
+
+    def scan_files(self, dirname, ok=None, log=logging.error):
+        pending = [dirname]
+        for pathname, result in self._list_dirs(pending):
+            if isinstance(result, OSError):
+                log('listdir failed: %s: %s' % (pathname, result.strerror))
+                continue
+            for attrs in result:
+                name = os.path.join(pathname, self._to_string(attrs.filename))
+                if attrs.st_mode and stat.S_ISDIR(attrs.st_mode):
+                    if ok is None or ok(name):
+                        pending.append(name)
+                else:
+                    yield name
+
+    def _list_dirs(self, pending):
+        '''List directories, many at a time.
+
+        pending is a list of directories to list, and the caller may
+        add more to it while this runs. Generate a (dirname, result)
+        pair for each directory, where result is a list of
+        paramiko.SFTPAttributes, or an OSError.
+
+        This is like paramiko's listdir_attr, except that it has
+        requests for up to max_pipelined directories in flight at
+        once, so that listing a tree with many directories doesn't
+        take several round trips per directory, one after another.
+
+        '''
+
+        responses = PipelinedResponses()
+        # Each item in in_flight is a request number, the directory,
+        # its handle, if it has been opened, and the entries so far.
+        in_flight = collections.deque()
+        sent = 0
+
+        def send(t, *args):
+            if sent % self.max_pipelined == 0:
+                self._delay()
+            return self.sftp._async_request(responses, t, *args)
+
+        def close(handle):
+            # The response is ignored.
+            self.sftp._async_request(
+                type(None), paramiko.sftp.CMD_CLOSE, handle)
+
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.max_pipelined:
+                    dirname = pending.pop()
+                    num = send(
+                        paramiko.sftp.CMD_OPENDIR,
+                        self.sftp._adjust_cwd(dirname))
+                    sent += 1
+                    in_flight.append((num, dirname, None, []))
+
+                num, dirname, handle, entries = in_flight.popleft()
+                try:
+                    t, msg = self._get_response(responses, num)
+                except EOFError:
+                    close(handle)
+                    yield dirname, entries
+                    continue
+                except IOError, e:
+                    if handle is not None:
+                        close(handle)
+                    yield dirname, OSError(
+                        e.errno, e.strerror or str(e), dirname)
+                    continue
+
+                if t == paramiko.sftp.CMD_HANDLE:
+                    handle = msg.get_binary()
+                elif t == paramiko.sftp.CMD_NAME:
+                    for i in range(msg.get_int()):
+                        filename = msg.get_text()
+                        longname = msg.get_text()
+                        attrs = paramiko.SFTPAttributes._from_msg(
+                            msg, filename, longname)
+                        if filename not in ('.', '..'):
+                            entries.append(attrs)
+                else:
+                    raise paramiko.SFTPError('Expected handle or name')
+                num = send(paramiko.sftp.CMD_READDIR, handle)
+                sent += 1
+                in_flight.append((num, dirname, handle, entries))
+        finally:
+            # If the caller stops early, close what we've opened.
+            for num, dirname, handle, entries in in_flight:
+                if handle is not None:
+                    close(handle)
+
     def _remove_if_exists(self, pathname):
         '''Like remove, but OK if file does not exist.'''
         try:
@@ -522,13 +834,29 @@ class SftpFS(obnamlib.VirtualFileSystem):
     @ioerror_to_oserror
     def rename(self, old, new):
         self._delay()
+        if self._has_posix_rename:
+            # The OpenSSH extension replaces an existing file, like
+            # rename(2), in one round trip. Plain SFTP rename fails if
+            # the new name exists, so the file has to be removed first.
+            try:
+                self.sftp._request(
+                    paramiko.sftp.CMD_EXTENDED, 'posix-rename@openssh.com',
+                    self.sftp._adjust_cwd(old), self.sftp._adjust_cwd(new))
+                return
+            except IOError, e:
+                # paramiko leaves errno unset for unsupported
+                # operations. Other errors are reported by the plain
+                # rename below.
+                if e.errno is None:
+                    self._has_posix_rename = False
         self._remove_if_exists(new)
         self.sftp.rename(old, new)
 
     @ioerror_to_oserror
     def lstat(self, pathname):
-        self._delay()
-        st = self.sftp.lstat(pathname)
+        with self._pooled_session():
+            self._delay()
+            st = self.sftp.lstat(pathname)
         self._fix_stat(pathname, st)
         return st
 
@@ -583,22 +911,76 @@ class SftpFS(obnamlib.VirtualFileSystem):
         return self.sftp.file(pathname, mode, bufsize=bufsize)
 
     def cat(self, pathname):
-        self._delay()
-        f = self.open(pathname, 'rb')
-        f.prefetch()
-        chunks = []
-        while True:
-            chunk = f.read(self.chunk_size)
-            if not chunk:
-                break
-            chunks.append(chunk)
-            self.bytes_read += len(chunk)
-        f.close()
+        with self._pooled_session():
+            self._delay()
+            f = self.open(pathname, 'rb')
+            f.prefetch()
+            chunks = []
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                self._count_bytes_read(len(chunk))
+            f.close()
         return ''.join(chunks)
 
+    @ioerror_to_oserror
+    def cat_range(self, pathname, offset, length):
+        with self._pooled_session():
+            f = self.open(pathname, 'rb')
+            try:
+                f.seek(offset)
+                data = f.read(length)
+            finally:
+                f.close()
+        self._count_bytes_read(len(data))
+        return data
+
+    def _create(self, pathname, mode, bufsize=-1):
+        '''Create a new file with the given permissions, return handle.
+
+        paramiko.SFTPClient doesn't allow setting the mode on
+        creation, so this sends the open request itself. Servers
+        are allowed to ignore the mode, so the first created file is
+        checked, and if the server ignores the mode, it is set
+        separately for every file. That leaves a short window where
+        the file is possible to open.
+
+        '''
+
+        self._delay()
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_mode = mode
+        flags = (paramiko.sftp.SFTP_FLAG_WRITE |
+                 paramiko.sftp.SFTP_FLAG_CREATE |
+                 paramiko.sftp.SFTP_FLAG_EXCL)
+        t, msg = self.sftp._request(
+            paramiko.sftp.CMD_OPEN, self.sftp._adjust_cwd(pathname),
+            flags, attrs)
+        if t != paramiko.sftp.CMD_HANDLE:
+            raise paramiko.SFTPError('Expected handle')
+        f = paramiko.SFTPFile(self.sftp, msg.get_binary(), 'wb', bufsize)
+
+        if self._open_sets_mode is None:
+            self._delay()
+            st = f.stat()
+            self._open_sets_mode = stat.S_IMODE(st.st_mode) == mode
+            if not self._open_sets_mode:
+                logging.debug(
+                    'SFTP server ignores mode when creating files')
+        if not self._open_sets_mode:
+            self.chmod_not_symlink(pathname, mode)
+        return f
+
     @ioerror_to_oserror
     def write_file(self, pathname, contents):
+        with self._pooled_session():
+            self._write_file(pathname, contents)
+
+    def _write_file(self, pathname, contents):
         mode = 'wbx'
+        dirname = os.path.dirname(pathname)
         try:
             f = self.open(pathname, mode)
         except (IOError, OSError), e:
@@ -610,19 +992,49 @@ class SftpFS(obnamlib.VirtualFileSystem):
             # and EACCES.
             if e.errno != errno.ENOENT and e.errno != errno.EACCES:
                 raise
-            dirname = os.path.dirname(pathname)
-            self.makedirs(dirname)
+            # The directory may have been removed behind our back.
+            self._known_dirs.discard(dirname)
+            self._ensure_dir(dirname)
             f = self.open(pathname, mode)
 
         self._write_helper(f, contents)
         f.close()
+        if dirname:
+            self._known_dirs.add(dirname)
+
+    def write_files(self, pathnames_and_contents):
+        # With a pool of sessions, the files are written in parallel,
+        # one per pooled session, in threads.
+        num_workers = self._max_pooled()
+        if num_workers <= 0:
+            return obnamlib.VirtualFileSystem.write_files(
+                self, pathnames_and_contents)
+
+        def write(pair):
+            pathname, contents = pair
+            with self._pooled_session():
+                try:
+                    self.write_file(pathname, contents)
+                except OSError as e:
+                    # SFTP sets errno to None if the file exists already.
+                    if e.errno not in (errno.EEXIST, None):
+                        raise
+                    return pathname
+            return None
+
+        pipeline = obnamlib.OrderedPipeline(
+            write, num_workers, 2 * num_workers)
+        return [
+            pathname
+            for pathname in pipeline.run(pathnames_and_contents)
+            if pathname is not None]
 
     def _tempfile(self, dirname):
         '''Create a new file with a random name, return handle and name.'''
 
         if dirname:
             try:
-                self.makedirs(dirname)
+                self._ensure_dir(dirname)
             except OSError:
                 # We ignore the error, on the assumption that it was due
                 # to the directory already existing. If it didn't exist
@@ -648,11 +1060,8 @@ class SftpFS(obnamlib.VirtualFileSystem):
             basename = 'tmp.%x' % i
             pathname = os.path.join(dirname, basename)
             try:
-                f = self.open(pathname, 'wbx', bufsize=self.chunk_size)
-                # paramiko.SFTPClient doesn't allow setting the mode
-                # on creation, so we set it separately. This leaves a
-                # short window where the file is possible to open.
-                self.chmod_not_symlink(pathname, obnamlib.NEW_FILE_MODE)
+                f = self._create(
+                    pathname, obnamlib.NEW_FILE_MODE, bufsize=self.chunk_size)
             except (IOError, OSError) as e:
                 if try_number == max_tries - 1:
                     raise
@@ -669,10 +1078,13 @@ class SftpFS(obnamlib.VirtualFileSystem):
         self.rename(tempname, pathname)
 
     def _write_helper(self, f, contents):
+        # Don't wait for the server to acknowledge each write. Errors
+        # are reported when the file is closed.
+        f.set_pipelined(True)
         for pos in range(0, len(contents), self.chunk_size):
             chunk = contents[pos:pos + self.chunk_size]
             f.write(chunk)
-            self.bytes_written += len(chunk)
+            self._count_bytes_written(len(chunk))
 
 
 class SftpPlugin(obnamlib.ObnamPlugin):
@@ -726,6 +1138,16 @@ class SftpPlugin(obnamlib.ObnamPlugin):
             metavar='EXECUTABLE',
             group=ssh_group)
 
+        self.app.settings.integer(
+            ['sftp-connections'],
+            'use up to N SFTP sessions to the server at once, so that '
+            'chunks can be read and written in parallel; this helps '
+            'when the network has a high latency (with openssh, each '
+            'session is a separate ssh connection)',
+            metavar='N',
+            default=obnamlib.DEFAULT_SFTP_CONNECTIONS,
+            group=ssh_group)
+
         self.app.settings.boolean(
             ['pure-paramiko'],
             'do not use openssh even if available, '
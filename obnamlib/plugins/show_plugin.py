@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import re
 import stat
 import sys
@@ -201,7 +202,8 @@ class ShowPlugin(obnamlib.ObnamPlugin):
                 (self.repo.make_generation_spec(gen_id), started, ended))
             for filename in args:
                 filename = self.remove_trailing_slashes(filename)
-                self.show_objects(cb, gen_id, filename)
+                metadata = self.repo.get_file_metadata(gen_id, filename)
+                self.show_objects(cb, gen_id, filename, metadata)
 
         self.repo.close()
 
@@ -218,17 +220,18 @@ class ShowPlugin(obnamlib.ObnamPlugin):
             gen_id, filename, obnamlib.REPO_FILE_MODE)
         return stat.S_ISDIR(mode)
 
-    def show_objects(self, cb, gen_id, dirname):
-        cb(gen_id, dirname)
+    def show_objects(self, cb, gen_id, dirname, metadata):
+        cb(gen_id, dirname, metadata)
         subdirs = []
-        for filename in sorted(self.repo.get_file_children(gen_id, dirname)):
-            if self.isdir(gen_id, filename):
-                subdirs.append(filename)
+        children = self.repo.get_directory_metadata(gen_id, dirname)
+        for filename, child_metadata in sorted(children):
+            if child_metadata.isdir():
+                subdirs.append((filename, child_metadata))
             else:
-                cb(gen_id, filename)
+                cb(gen_id, filename, child_metadata)
 
-        for subdir in subdirs:
-            self.show_objects(cb, gen_id, subdir)
+        for subdir, subdir_metadata in subdirs:
+            self.show_objects(cb, gen_id, subdir, subdir_metadata)
 
     def ls(self, args):
         '''List contents of a generation.'''
@@ -237,8 +240,8 @@ class ShowPlugin(obnamlib.ObnamPlugin):
     def show_hdr_ls(self, comment):
             self.app.output.write(comment)
 
-    def show_item_ls(self, gen_id, filename):
-        fields = self.fields(gen_id, filename)
+    def show_item_ls(self, gen_id, filename, metadata):
+        fields = self.fields(filename, metadata)
         widths = [
             1, # mode
             5, # nlink
@@ -271,13 +274,10 @@ class ShowPlugin(obnamlib.ObnamPlugin):
 
 ''' % comment)
 
-    def show_item_kdirstat(self, gen_id, filename):
-        mode = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_MODE)
-        size = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_SIZE)
-        mtime_sec = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_MTIME_SEC)
+    def show_item_kdirstat(self, gen_id, filename, metadata):
+        mode = metadata.st_mode
+        size = metadata.st_size
+        mtime_sec = metadata.st_mtime_sec
 
         if   stat.S_ISREG(mode):  mode_str = "F\t"
         elif stat.S_ISDIR(mode):  mode_str = "D "
@@ -308,49 +308,71 @@ class ShowPlugin(obnamlib.ObnamPlugin):
 
         if self.app.settings['verbose']:
             sys.stdout.write('%s ' % change_char)
-            self.show_item_ls(gen_id, fullname)
+            self.show_item_ls(
+                gen_id, fullname,
+                self.repo.get_file_metadata(gen_id, fullname))
         else:
             self.app.output.write('%s %s\n' % (change_char, fullname))
 
-    def show_diff_for_common_file(self, gen_id1, gen_id2, fullname, subdirs):
-        changed = False
+    def file_changed(self, gen_id1, gen_id2, fullname):
+        '''Has a file that is in both generations changed?
+
+        Directories have changed only if they have become something
+        else. Other files have changed if their MD5 checksum has.
+
+        '''
+
         if self.isdir(gen_id1, fullname) != self.isdir(gen_id2, fullname):
-            changed = True
+            return True
         elif self.isdir(gen_id2, fullname):
-            subdirs.append(fullname)
+            return False
         else:
-            # Files are both present and neither is a directory.
-            # Compare md5
             def get_md5(gen_id):
                 return self.repo.get_file_key(
                     gen_id, fullname, obnamlib.REPO_FILE_MD5)
-            md5_1 = get_md5(gen_id1)
-            md5_2 = get_md5(gen_id2)
-            if md5_1 != md5_2:
-                changed = True
-        if changed:
-            self.show_diff_for_file(gen_id2, fullname, '*')
-
-    def show_diff(self, gen_id1, gen_id2, dirname):
-        # This set contains the files from the old/src generation
-        set1 = self.repo.get_file_children(gen_id1, dirname)
-        subdirs = []
-        # These are the new/dst generation files
-        for filename in sorted(self.repo.get_file_children(gen_id2, dirname)):
-            if filename in set1:
-                # Its in both generations
-                set1.remove(filename)
-                self.show_diff_for_common_file(
-                    gen_id1, gen_id2, filename, subdirs)
-            else:
-                # Its only in set2 - the file/dir got added
-                self.show_diff_for_file(gen_id2, filename, '+')
-        for filename in sorted(set1):
-            # This was only in gen1 - it got removed
-            self.show_diff_for_file(gen_id1, filename, '-')
-
-        for subdir in subdirs:
-            self.show_diff(gen_id1, gen_id2, subdir)
+            return get_md5(gen_id1) != get_md5(gen_id2)
+
+    def show_diff(self, gen_id1, gen_id2):
+        # The repository only looks at the parts of the generations
+        # that differ, and tells us about every file there. Group the
+        # changes by directory, leaving out anything inside a directory
+        # that was added, removed, or replaced by something else. The
+        # pathnames come sorted, so a directory comes before its
+        # contents.
+        changes = {}
+        subdirs = {}
+        hidden = set()
+        for filename, change_char in self.repo.diff_generations(
+                gen_id1, gen_id2):
+            parent = os.path.dirname(filename)
+            if parent == filename:
+                continue
+            if parent in hidden:
+                hidden.add(filename)
+                continue
+            if (change_char == '*' and
+                not self.file_changed(gen_id1, gen_id2, filename)):
+                continue
+            hidden.add(filename)
+            changes.setdefault(parent, []).append((filename, change_char))
+            while parent != '/':
+                subdirs.setdefault(os.path.dirname(parent), set()).add(parent)
+                parent = os.path.dirname(parent)
+
+        self.show_diff_in_dir(gen_id1, gen_id2, '/', changes, subdirs)
+
+    def show_diff_in_dir(self, gen_id1, gen_id2, dirname, changes, subdirs):
+        entries = sorted(changes.get(dirname, []))
+        # Added and changed files first, then removed ones.
+        for filename, change_char in entries:
+            if change_char != '-':
+                self.show_diff_for_file(gen_id2, filename, change_char)
+        for filename, change_char in entries:
+            if change_char == '-':
+                self.show_diff_for_file(gen_id1, filename, change_char)
+
+        for subdir in sorted(subdirs.get(dirname, [])):
+            self.show_diff_in_dir(gen_id1, gen_id2, subdir, changes, subdirs)
 
     def diff(self, args):
         '''Show difference between two generations.'''
@@ -376,24 +398,17 @@ class ShowPlugin(obnamlib.ObnamPlugin):
             gen_id2 = self.repo.interpret_generation_spec(
                 client_name, args[1])
 
-        self.show_diff(gen_id1, gen_id2, '/')
+        self.show_diff(gen_id1, gen_id2)
         self.repo.close()
 
-    def fields(self, gen_id, filename):
-        mode = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_MODE)
-        mtime_sec = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_MTIME_SEC)
-        target = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_SYMLINK_TARGET)
-        nlink = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_NLINK)
-        username = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_USERNAME)
-        groupname = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_GROUPNAME)
-        size = self.repo.get_file_key(
-            gen_id, filename, obnamlib.REPO_FILE_SIZE)
+    def fields(self, filename, metadata):
+        mode = metadata.st_mode
+        mtime_sec = metadata.st_mtime_sec
+        target = metadata.target
+        nlink = metadata.st_nlink
+        username = metadata.username
+        groupname = metadata.groupname
+        size = metadata.st_size
 
         perms = ['?'] + ['-'] * 9
         tab = [
@@ -17,7 +17,6 @@
 import logging
 import os
 import random
-import stat
 import sys
 import urlparse
 
@@ -99,16 +98,14 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             self.app.ts['total_bytes'] = \
                 self.repo.get_generation_key(
                 gen_id, obnamlib.REPO_GENERATION_TOTAL_DATA)
-            for filename in self.walk(gen_id, args):
+            for filename, metadata in self.walk(gen_id, args):
                 self.app.ts['filename'] = filename
                 try:
-                    self.verify_metadata(gen_id, filename)
+                    self.verify_metadata(gen_id, filename, metadata)
                 except Fail, e:
                     self.log_fail(e)
                 else:
-                    mode = self.repo.get_file_key(
-                        gen_id, filename, obnamlib.REPO_FILE_MODE)
-                    if stat.S_ISREG(mode):
+                    if metadata.isfile():
                         try:
                             self.verify_regular_file(gen_id, filename)
                         except Fail, e:
@@ -120,21 +117,19 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             self.app.ts.notify('finding all files to choose randomly')
 
             filenames = []
-            for filename in self.walk(gen_id, args):
-                mode = self.repo.get_file_key(
-                    gen_id, filename, obnamlib.REPO_FILE_MODE)
-                if stat.S_ISREG(mode):
-                    filenames.append(filename)
+            for filename, metadata in self.walk(gen_id, args):
+                if metadata.isfile():
+                    filenames.append((filename, metadata))
 
             chosen = []
             for i in range(min(num_randomly, len(filenames))):
-                filename = random.choice(filenames)
-                filenames.remove(filename)
-                chosen.append(filename)
-            for filename in chosen:
+                pair = random.choice(filenames)
+                filenames.remove(pair)
+                chosen.append(pair)
+            for filename, metadata in chosen:
                 self.app.ts['filename'] = filename
                 try:
-                    self.verify_metadata(gen_id, filename)
+                    self.verify_metadata(gen_id, filename, metadata)
                     self.verify_regular_file(gen_id, filename)
                 except Fail, e:
                     self.log_fail(e)
@@ -157,7 +152,7 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
             self.app.ts.notify(msg)
         self.failed = True
 
-    def verify_metadata(self, gen_id, filename):
+    def verify_metadata(self, gen_id, filename, metadata):
         try:
             live_data = obnamlib.read_metadata(self.fs, filename)
         except OSError, e:
@@ -166,7 +161,7 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
                 reason='missing or inaccessible: %s' % e.strerror)
 
         def X(key, field_name):
-            v1 = self.repo.get_file_key(gen_id, filename, key)
+            v1 = getattr(metadata, field_name)
             v2 = getattr(live_data, field_name)
             # obnamlib.Metadata stores some fields as None, but
             # RepositoryInterface returns 0 or '' instead. Convert
@@ -205,8 +200,11 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
         f.close()
 
     def verify_chunks(self, f, chunkids):
-        for chunkid in chunkids:
-            backed_up = self.repo.get_chunk_content(chunkid)
+        contents = self.repo.get_chunk_contents(
+            chunkids,
+            read_ahead=self.app.settings['read-ahead'],
+            num_workers=self.app.settings['read-workers'])
+        for backed_up in contents:
             live_data = f.read(len(backed_up))
             self.app.ts['done_bytes'] += len(backed_up)
             if backed_up != live_data:
@@ -216,12 +214,13 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
     def walk(self, gen_id, args):
         '''Iterate over each pathname specified by arguments.
 
-        This is a generator.
+        This is a generator. Each return value is a (pathname,
+        metadata) pair.
 
         '''
 
         for arg in args:
             scheme, netloc, path, query, fragment = urlparse.urlsplit(arg)
             arg = os.path.normpath(path)
-            for x in self.repo.walk_generation(gen_id, arg):
+            for x in self.repo.walk_generation_metadata(gen_id, arg):
                 yield x
@@ -307,7 +307,7 @@ class DummyClient(object):
             if not self._is_filekey(key):
                 continue
             x, y, candidate = key
-            if candidate == filename:
+            if y != gen_id or candidate == filename:
                 continue
             if not candidate.startswith(prefix): # pragma: no cover
                 continue
@@ -428,6 +428,15 @@ class ChunkStore(object):
                 filename='(no chunk files in this format')
         del self.chunks[chunk_id]
 
+    def remove_chunks(self, chunk_ids):
+        missing = []
+        for chunk_id in chunk_ids:
+            if chunk_id in self.chunks:
+                del self.chunks[chunk_id]
+            else:
+                missing.append(chunk_id)
+        return missing
+
     def get_chunk_ids(self):
         return self.chunks.keys()
 
@@ -510,6 +519,9 @@ class RepositoryFormatDummy(obnamlib.RepositoryInterface):
     def get_shared_directories(self):
         return []
 
+    def get_chunk_directories(self):
+        return []
+
     def get_client_names(self):
         return self._client_list.names()
 
@@ -691,6 +703,15 @@ class RepositoryFormatDummy(obnamlib.RepositoryInterface):
     def put_chunk_content(self, content):
         return self._chunk_store.put_chunk_content(content)
 
+    def put_chunk_contents(self, contents):
+        return [self._chunk_store.put_chunk_content(x) for x in contents]
+
+    def get_chunk_contents(self, chunk_ids, read_ahead=1, num_workers=0):
+        # Everything is in memory, so there's nothing to gain from
+        # reading ahead.
+        for chunk_id in chunk_ids:
+            yield self._chunk_store.get_chunk_content(chunk_id)
+
     def get_chunk_content(self, chunk_id):
         return self._chunk_store.get_chunk_content(chunk_id)
 
@@ -700,9 +721,18 @@ class RepositoryFormatDummy(obnamlib.RepositoryInterface):
     def remove_chunk(self, chunk_id):
         self._chunk_store.remove_chunk(chunk_id)
 
+    def remove_chunks(self, chunk_ids):
+        return self._chunk_store.remove_chunks(chunk_ids)
+
     def get_chunk_ids(self):
         return self._chunk_store.get_chunk_ids()
 
+    def repack_chunks(self, min_live_ratio):
+        self._chunk_indexes._require_lock()
+
+    def remove_pending_chunks(self, grace_period):
+        self._chunk_indexes._require_lock()
+
     def lock_chunk_indexes(self):
         self._chunk_indexes.lock()
 
@@ -16,10 +16,20 @@
 # =*= License: GPL-3+ =*=
 
 
+import errno
 import os
+import sys
+import threading
 
 import tracing
 
+import obnamlib
+
+
+class UploadError(obnamlib.ObnamError):
+
+    msg = 'Could not write {filename} to the repository: {error}'
+
 
 class RepositoryFS(object):
 
@@ -37,10 +47,26 @@ class RepositoryFS(object):
 
     '''
 
-    def __init__(self, repo, fs, hooks):
+    def __init__(self, repo, fs, hooks, filter_workers=0,
+                 upload_buffer_size=0):
         self.repo = repo
         self.fs = fs
         self.hooks = hooks
+        self.filter_workers = filter_workers
+        self.upload_buffer_size = upload_buffer_size
+
+        # Files queued for writing in the background. Queued files
+        # are kept in a dict until they've been written, so that they
+        # can be read back. Those not yet taken by the uploader
+        # thread are also listed in _waiting. The first error from
+        # the uploader is kept in _upload_error, as sys.exc_info()
+        # for the exception, and the filename.
+        self._queue_cond = threading.Condition()
+        self._queued = {}
+        self._waiting = []
+        self._queued_bytes = 0
+        self._uploading = False
+        self._upload_error = None
 
     def __getattr__(self, name):
         return getattr(self.fs, name)
@@ -53,6 +79,12 @@ class RepositoryFS(object):
             raise ToplevelIsFileError(filename=filename)
 
     def cat(self, filename, runfilters=True):
+        with self._queue_cond:
+            data = self._queued.get(filename)
+        if data is not None and runfilters:
+            return data
+        if data is not None: # pragma: no cover
+            self.flush_queue()
         data = self.fs.cat(filename)
         if not runfilters: # pragma: no cover
             return data
@@ -60,6 +92,44 @@ class RepositoryFS(object):
         return self.hooks.filter_read('repository-data', data,
                                       repo=self.repo, toplevel=toplevel)
 
+    def cat_range(self, filename, offset, length, runfilters=True):
+        data = self.fs.cat_range(filename, offset, length)
+        if not runfilters:
+            return data
+        toplevel = self._get_toplevel(filename)
+        return self.hooks.filter_read('repository-data', data,
+                                      repo=self.repo, toplevel=toplevel)
+
+    def filter_for_write(self, filename, data):
+        '''Return data as write_file would write it into filename.
+
+        This allows the caller to store filtered data as part of a
+        larger file, and read it back later with cat_range.
+
+        '''
+
+        toplevel = self._get_toplevel(filename)
+        return self.hooks.filter_write('repository-data', data,
+                                       repo=self.repo, toplevel=toplevel)
+
+    def exists(self, filename):
+        return self._is_queued([filename]) or self.fs.exists(filename)
+
+    def _is_queued(self, filenames):
+        with self._queue_cond:
+            return any(x in self._queued for x in filenames)
+
+    def remove(self, filename):
+        if self._is_queued([filename]):
+            self.flush_queue()
+        self.fs.remove(filename)
+
+    def remove_files(self, filenames):
+        filenames = list(filenames)
+        if self._is_queued(filenames):
+            self.flush_queue()
+        return self.fs.remove_files(filenames)
+
     def lock(self, filename, data):
         self.fs.lock(filename, data)
 
@@ -77,9 +147,118 @@ class RepositoryFS(object):
                                            repo=self.repo, toplevel=toplevel)
         self.fs.write_file(filename, data)
 
+    def write_files(self, filenames_and_data, runfilters=True):
+        # The filters for a batch of files are run in filter_workers
+        # threads in parallel. Filters that compress or encrypt spend
+        # most of their time in C code or in a gpg process, so this
+        # uses several CPUs.
+
+        def run_filters(pair):
+            filename, data = pair
+            return filename, self.filter_for_write(filename, data)
+
+        if runfilters:
+            pipeline = obnamlib.OrderedPipeline(
+                run_filters, self.filter_workers, 2 * self.filter_workers)
+            pairs = list(pipeline.run(filenames_and_data))
+        else:
+            pairs = list(filenames_and_data)
+        return self.fs.write_files(pairs)
+
     def overwrite_file(self, filename, data, runfilters=True):
         toplevel = self._get_toplevel(filename)
         if runfilters:
             data = self.hooks.filter_write('repository-data', data,
                                            repo=self.repo, toplevel=toplevel)
         self.fs.overwrite_file(filename, data)
+
+    def queue_file(self, filename, data):
+        '''Write a new file in the background.
+
+        This is like write_file, but the file is written later, in a
+        background thread, so that the caller can go on producing
+        more data meanwhile. Files are queued until upload_buffer_size
+        bytes of data are waiting, after which this waits for there
+        to be room. If upload_buffer_size is 0, the file is written
+        right away.
+
+        Until a queued file has been written, cat and exists find it
+        as if it had been. If writing fails, including because the
+        file exists already, the rest of the queue is dropped, and
+        UploadError is raised by the next call to queue_file or
+        flush_queue.
+
+        '''
+
+        if self.upload_buffer_size <= 0:
+            self.write_file(filename, data)
+            return
+
+        with self._queue_cond:
+            self._raise_upload_error()
+            while (self._queued and
+                   self._queued_bytes + len(data) > self.upload_buffer_size):
+                self._queue_cond.wait()
+                self._raise_upload_error()
+            self._queued[filename] = data
+            self._queued_bytes += len(data)
+            self._waiting.append(filename)
+            if not self._uploading:
+                self._uploading = True
+                uploader = threading.Thread(target=self._upload)
+                uploader.daemon = True
+                uploader.start()
+
+    def flush_queue(self):
+        '''Wait until all queued files are written.
+
+        Raise UploadError if writing any of them failed.
+
+        '''
+
+        with self._queue_cond:
+            while self._uploading:
+                self._queue_cond.wait()
+            self._raise_upload_error()
+
+    def _raise_upload_error(self):
+        # The caller must hold self._queue_cond.
+        if self._upload_error is not None:
+            (exc_type, exc_value, exc_tb), filename = self._upload_error
+            self._upload_error = None
+            raise UploadError, \
+                UploadError(filename=filename, error=str(exc_value)), \
+                exc_tb
+
+    def _upload(self):
+        # This runs in the uploader thread, until the queue is empty.
+        # It writes everything that is waiting as one batch, so that
+        # write_files can filter and write the files in parallel.
+        while True:
+            with self._queue_cond:
+                if not self._waiting:
+                    self._uploading = False
+                    self._queue_cond.notify_all()
+                    return
+                filenames = self._waiting
+                self._waiting = []
+                pairs = [(x, self._queued[x]) for x in filenames]
+
+            error = None
+            try:
+                existing = self.write_files(pairs)
+                if existing:
+                    raise OSError(
+                        errno.EEXIST, os.strerror(errno.EEXIST), existing[0])
+            except Exception as e:
+                filename = getattr(e, 'filename', None) or filenames[0]
+                error = (sys.exc_info(), filename)
+
+            with self._queue_cond:
+                if error is not None and self._upload_error is None:
+                    self._upload_error = error
+                    filenames += self._waiting
+                    self._waiting = []
+                for filename in filenames:
+                    self._queued_bytes -= len(self._queued.pop(filename))
+                self._queue_cond.notify_all()
@@ -0,0 +1,117 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import threading
+import unittest
+import zlib
+
+import obnamlib
+
+
+class DeflateFilter(object):
+
+    tag = 'deflate'
+
+    def filter_read(self, data, repo, toplevel):
+        return zlib.decompress(data)
+
+    def filter_write(self, data, repo, toplevel):
+        return zlib.compress(data)
+
+
+class BlockingFS(obnamlib.LocalFS):
+
+    '''A LocalFS whose writes wait until they're allowed to go on.'''
+
+    def __init__(self, *args, **kwargs):
+        obnamlib.LocalFS.__init__(self, *args, **kwargs)
+        self.go = threading.Event()
+        self.go.set()
+
+    def write_file(self, pathname, contents):
+        self.go.wait()
+        obnamlib.LocalFS.write_file(self, pathname, contents)
+
+
+class RepositoryFSQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.hooks = obnamlib.HookManager()
+        self.hooks.new_filter('repository-data')
+        self.hooks.add_callback('repository-data', DeflateFilter())
+        self.realfs = BlockingFS(self.tempdir)
+        self.fs = obnamlib.RepositoryFS(
+            None, self.realfs, self.hooks, upload_buffer_size=10)
+
+    def tearDown(self):
+        self.realfs.go.set()
+        shutil.rmtree(self.tempdir)
+
+    def test_writes_right_away_without_buffer(self):
+        self.fs.upload_buffer_size = 0
+        self.fs.queue_file('foo/bar', 'data')
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+        self.assertTrue(self.realfs.exists('foo/bar'))
+
+    def test_writes_queued_file_filtered(self):
+        self.fs.queue_file('foo/bar', 'data')
+        self.fs.flush_queue()
+        self.assertNotEqual(self.realfs.cat('foo/bar'), 'data')
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+
+    def test_finds_queued_file_before_it_is_written(self):
+        self.realfs.go.clear()
+        self.fs.queue_file('foo/bar', 'data')
+        self.assertTrue(self.fs.exists('foo/bar'))
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+        self.assertFalse(self.realfs.exists('foo/bar'))
+        self.realfs.go.set()
+        self.fs.flush_queue()
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+
+    def test_keeps_queue_within_buffer_size(self):
+        self.realfs.go.clear()
+        self.fs.queue_file('foo/1', 'x' * 6)
+        queued = []
+
+        def queue_more():
+            for filename in ['foo/2', 'foo/3']:
+                self.fs.queue_file(filename, 'y' * 6)
+                queued.append(filename)
+
+        producer = threading.Thread(target=queue_more)
+        producer.start()
+        producer.join(0.1)
+        self.assertEqual(queued, [])
+        self.realfs.go.set()
+        producer.join()
+        self.fs.flush_queue()
+        self.assertEqual(queued, ['foo/2', 'foo/3'])
+        self.assertEqual(self.fs.cat('foo/3'), 'y' * 6)
+
+    def test_raises_error_at_flush(self):
+        self.realfs.write_file('foo/bar', 'existing')
+        self.fs.queue_file('foo/bar', 'data')
+        self.assertRaises(obnamlib.UploadError, self.fs.flush_queue)
+        self.fs.flush_queue()
+
+    def test_removing_queued_file_waits_for_it(self):
+        self.fs.queue_file('foo/bar', 'data')
+        self.fs.remove('foo/bar')
+        self.assertFalse(self.fs.exists('foo/bar'))
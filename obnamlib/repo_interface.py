@@ -82,6 +82,30 @@ REPO_GENERATION_INTEGER_KEYS = _filter_integer_keys('REPO_GENERATION_')
 REPO_FILE_INTEGER_KEYS = _filter_integer_keys('REPO_FILE_')
 
 
+# Mapping between file keys and obnamlib.Metadata field names, for
+# all the file keys that have a corresponding Metadata field.
+
+REPO_FILE_METADATA_FIELDS = [
+    (REPO_FILE_MTIME_SEC, 'st_mtime_sec'),
+    (REPO_FILE_MTIME_NSEC, 'st_mtime_nsec'),
+    (REPO_FILE_ATIME_SEC, 'st_atime_sec'),
+    (REPO_FILE_ATIME_NSEC, 'st_atime_nsec'),
+    (REPO_FILE_MODE, 'st_mode'),
+    (REPO_FILE_NLINK, 'st_nlink'),
+    (REPO_FILE_SIZE, 'st_size'),
+    (REPO_FILE_UID, 'st_uid'),
+    (REPO_FILE_GID, 'st_gid'),
+    (REPO_FILE_BLOCKS, 'st_blocks'),
+    (REPO_FILE_DEV, 'st_dev'),
+    (REPO_FILE_INO, 'st_ino'),
+    (REPO_FILE_USERNAME, 'username'),
+    (REPO_FILE_GROUPNAME, 'groupname'),
+    (REPO_FILE_SYMLINK_TARGET, 'target'),
+    (REPO_FILE_XATTR_BLOB, 'xattr'),
+    (REPO_FILE_MD5, 'md5'),
+]
+
+
 def repo_key_name(key_value):
     for key_name in _integer_keys + _string_keys:
         if globals()[key_name] == key_value:
@@ -359,6 +383,15 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def get_chunk_directories(self):
+        '''Return list of directories where chunk data is stored.
+
+        This is a subset of the shared directories. It is useful for
+        plugins that treat file data differently from other data.
+
+        '''
+        raise NotImplementedError()
+
     # Client list.
 
     def get_client_names(self):
@@ -624,6 +657,73 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def set_file_metadata(self, generation_id, filename, metadata):
+        '''Add a file, and set all its file keys from an obnamlib.Metadata.
+
+        This is the same as calling add_file, and then set_file_key
+        for every file key in REPO_FILE_METADATA_FIELDS, but formats
+        can do it with much less work per file.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation.
+
+        '''
+
+        self.add_file(generation_id, filename)
+        for key, field in REPO_FILE_METADATA_FIELDS:
+            value = getattr(metadata, field)
+            if value is None:
+                value = 0 if key in REPO_FILE_INTEGER_KEYS else ''
+            self.set_file_key(generation_id, filename, key, value)
+
+    def set_files_metadata(self, generation_id, filenames_and_metadata):
+        '''Call set_file_metadata for each (filename, metadata) pair.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation.
+
+        '''
+
+        for filename, metadata in filenames_and_metadata:
+            self.set_file_metadata(generation_id, filename, metadata)
+
+    def get_file_metadata(self, generation_id, filename):
+        '''Return an obnamlib.Metadata object with a file's file keys.
+
+        Each field in REPO_FILE_METADATA_FIELDS is set to the value
+        get_file_key would return for its file key. Fields whose file
+        key the format does not allow are None.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation.
+
+        '''
+
+        allowed = set(self.get_allowed_file_keys())
+        metadata = obnamlib.Metadata()
+        for key, field in REPO_FILE_METADATA_FIELDS:
+            if key in allowed:
+                value = self.get_file_key(generation_id, filename, key)
+                setattr(metadata, field, value)
+        return metadata
+
+    def get_directory_metadata(self, generation_id, dirname):
+        '''Return metadata for every file in a directory.
+
+        This returns a list of (pathname, metadata) pairs, one for each
+        file get_file_children would return, with metadata as returned
+        by get_file_metadata. Formats can do this with much less work
+        than getting each file's metadata separately.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation.
+
+        '''
+
+        return [
+            (pathname, self.get_file_metadata(generation_id, pathname))
+            for pathname in self.get_file_children(generation_id, dirname)]
+
     def get_file_chunk_ids(self, generation_id, filename):
         '''Get the list of chunk ids for a file.'''
         raise NotImplementedError()
@@ -674,6 +774,75 @@ class RepositoryInterface(object):
                     yield x
         yield arg
 
+    def walk_generation_metadata(self, gen_id, dirname): # pragma: no cover
+        '''Like walk_generation, but return (pathname, metadata) pairs.
+
+        The metadata is as returned by get_file_metadata. The metadata
+        of all the files in a directory is fetched at once, using
+        get_directory_metadata.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation.
+
+        '''
+
+        metadata = self.get_file_metadata(gen_id, dirname)
+        return self._walk_generation_metadata(gen_id, dirname, metadata)
+
+    def _walk_generation_metadata(
+        self, gen_id, pathname, metadata): # pragma: no cover
+
+        if metadata.isdir():
+            kids = self.get_directory_metadata(gen_id, pathname)
+            for kidpath, kidmetadata in kids:
+                for x in self._walk_generation_metadata(
+                        gen_id, kidpath, kidmetadata):
+                    yield x
+        yield os.path.normpath(pathname), metadata
+
+    def diff_generations(self, gen_id1, gen_id2):
+        '''Find the files that differ between two generations.
+
+        This is a generator. Each value is a (pathname, change) pair,
+        where change is '+' for a file that is only in gen_id2, '-'
+        for a file that is only in gen_id1, and '*' for a file that is
+        in both, but with different file keys or chunk ids. Pairs are
+        returned in sorted order of pathname.
+
+        Sub-classes do not need to define this method; the base
+        class provides a generic implementation, which looks at every
+        file in both generations.
+
+        '''
+
+        files1 = self._get_generation_contents(gen_id1)
+        files2 = self._get_generation_contents(gen_id2)
+        for pathname in sorted(set(files1).union(files2)):
+            if pathname not in files2:
+                yield pathname, '-'
+            elif pathname not in files1:
+                yield pathname, '+'
+            elif files1[pathname] != files2[pathname]:
+                yield pathname, '*'
+
+    def _get_generation_contents(self, gen_id):
+        # Map each pathname in a generation to its file keys and chunk ids.
+        contents = {}
+        try:
+            for pathname, metadata in self.walk_generation_metadata(
+                    gen_id, '/'):
+                contents[pathname] = self._get_file_contents(
+                    gen_id, pathname, metadata)
+        except obnamlib.RepositoryFileDoesNotExistInGeneration:
+            pass
+        return contents
+
+    def _get_file_contents(self, gen_id, pathname, metadata):
+        keys = tuple(
+            getattr(metadata, field)
+            for key, field in REPO_FILE_METADATA_FIELDS)
+        return keys, self.get_file_chunk_ids(gen_id, pathname)
+
     # Chunks.
 
     def put_chunk_content(self, data):
@@ -684,10 +853,31 @@ class RepositoryInterface(object):
         '''
         raise NotImplementedError()
 
+    def put_chunk_contents(self, datas):
+        '''Add many new chunks into the repository.
+
+        This is like calling put_chunk_content for each chunk, but
+        lets the implementation write them more efficiently. Return
+        the list of chunk identifiers, in the same order as the data.
+
+        '''
+        raise NotImplementedError()
+
     def get_chunk_content(self, chunk_id):
         '''Return the contents of a chunk, given its id.'''
         raise NotImplementedError()
 
+    def get_chunk_contents(self, chunk_ids, read_ahead=1, num_workers=0):
+        '''Generate the contents of many chunks, in order.
+
+        This is like calling get_chunk_content for each chunk id, but
+        lets the implementation fetch up to read_ahead chunks ahead of
+        the caller, in num_workers threads. With zero workers,
+        everything happens in the caller's thread.
+
+        '''
+        raise NotImplementedError()
+
     def has_chunk(self, chunk_id):
         '''Does a chunk (still) exist in the repository?'''
         raise NotImplementedError()
@@ -696,10 +886,46 @@ class RepositoryInterface(object):
         '''Remove chunk from repository, but not chunk indexes.'''
         raise NotImplementedError()
 
+    def remove_chunks(self, chunk_ids):
+        '''Remove many chunks from repository, but not chunk indexes.
+
+        This is like calling remove_chunk for each chunk, but lets the
+        implementation remove them more efficiently. Chunks that don't
+        exist are skipped, and their ids are returned as a list.
+
+        '''
+        raise NotImplementedError()
+
     def get_chunk_ids(self):
         '''Generate all chunk ids in repository.'''
         raise NotImplementedError()
 
+    def repack_chunks(self, min_live_ratio):
+        '''Reclaim space left behind by removed chunks.
+
+        Repository formats that store several chunks in one file
+        rewrite files where less than min_live_ratio of the data is
+        still in use. Chunk ids do not change. Formats that store each
+        chunk in its own file do nothing. The chunk indexes must be
+        locked.
+
+        '''
+        raise NotImplementedError()
+
+    def remove_pending_chunks(self, grace_period):
+        '''Remove chunks that removing generations left unused.
+
+        Repository formats may leave the chunks that removing a
+        generation leaves unused in the repository for a while, so
+        that backups running at the same time can start using them
+        again. This removes such chunks that were left at least
+        grace_period seconds ago, and haven't been used again since.
+        Formats that remove chunks right away do nothing. The chunk
+        indexes must be locked.
+
+        '''
+        raise NotImplementedError()
+
     def lock_chunk_indexes(self):
         '''Locks chunk indexes for updates.'''
         raise NotImplementedError()
@@ -843,6 +1069,11 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
     def test_returns_list_of_shared_directories(self):
         self.assertTrue(type(self.repo.get_shared_directories()), list)
 
+    def test_chunk_directories_are_shared_directories(self):
+        shared = self.repo.get_shared_directories()
+        for dirname in self.repo.get_chunk_directories():
+            self.assertTrue(dirname in shared)
+
     # Tests for the client list.
 
     def test_has_not_got_client_list_lock_initially(self):
@@ -1624,6 +1855,55 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
             self.repo.set_file_key,
             gen_id, '/foo/bar', obnamlib.REPO_FILE_TEST_KEY, 'yoyo')
 
+    def test_sets_file_metadata(self):
+        gen_id = self.create_generation()
+        metadata = obnamlib.Metadata(
+            st_mode=0100644, st_mtime_sec=123, username='user', md5='abc')
+        self.repo.set_file_metadata(gen_id, '/foo/bar', metadata)
+        self.assertTrue(self.repo.file_exists(gen_id, '/foo/bar'))
+        get = lambda key: self.repo.get_file_key(gen_id, '/foo/bar', key)
+        self.assertEqual(get(obnamlib.REPO_FILE_MODE), 0100644)
+        self.assertEqual(get(obnamlib.REPO_FILE_MTIME_SEC), 123)
+        self.assertEqual(get(obnamlib.REPO_FILE_USERNAME), 'user')
+        self.assertEqual(get(obnamlib.REPO_FILE_MD5), 'abc')
+        self.assertEqual(get(obnamlib.REPO_FILE_SIZE), 0)
+        self.assertEqual(get(obnamlib.REPO_FILE_GROUPNAME), '')
+
+    def test_setting_file_metadata_replaces_file_keys(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo/bar')
+        self.repo.set_file_key(
+            gen_id, '/foo/bar', obnamlib.REPO_FILE_SIZE, 42)
+        self.repo.set_file_metadata(
+            gen_id, '/foo/bar', obnamlib.Metadata(st_mtime_sec=123))
+        get = lambda key: self.repo.get_file_key(gen_id, '/foo/bar', key)
+        self.assertEqual(get(obnamlib.REPO_FILE_MTIME_SEC), 123)
+        self.assertEqual(get(obnamlib.REPO_FILE_SIZE), 0)
+
+    def test_sets_metadata_for_many_files(self):
+        gen_id = self.create_generation()
+        self.repo.set_files_metadata(
+            gen_id,
+            [('/foo', obnamlib.Metadata(st_size=1)),
+             ('/foo/bar', obnamlib.Metadata(st_size=2))])
+        self.assertEqual(
+            self.repo.get_file_key(gen_id, '/foo', obnamlib.REPO_FILE_SIZE),
+            1)
+        self.assertEqual(
+            self.repo.get_file_key(
+                gen_id, '/foo/bar', obnamlib.REPO_FILE_SIZE),
+            2)
+
+    def test_committing_remembers_file_metadata(self):
+        gen_id = self.create_generation()
+        self.repo.set_file_metadata(
+            gen_id, '/foo/bar', obnamlib.Metadata(st_mtime_sec=123))
+        self.repo.commit_client('fooclient')
+        self.assertEqual(
+            self.repo.get_file_key(
+                gen_id, '/foo/bar', obnamlib.REPO_FILE_MTIME_SEC),
+            123)
+
     # FIXME: These tests fails due to ClientMetadataTree brokenness, it seems.
     # They're disabled, for now. The bug is not exposed by existing code,
     # only by the new interface's tests.
@@ -1836,6 +2116,89 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
             self.repo.get_file_children(gen_id, '/'),
             ['/foo'])
 
+    def test_gets_file_metadata(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo/bar')
+        self.repo.set_file_key(
+            gen_id, '/foo/bar', obnamlib.REPO_FILE_MTIME_SEC, 123)
+        self.repo.set_file_key(
+            gen_id, '/foo/bar', obnamlib.REPO_FILE_USERNAME, 'user')
+        metadata = self.repo.get_file_metadata(gen_id, '/foo/bar')
+        self.assertEqual(metadata.st_mtime_sec, 123)
+        self.assertEqual(metadata.username, 'user')
+        self.assertEqual(metadata.st_size, 0)
+        self.assertEqual(metadata.md5, '')
+
+    def test_get_file_metadata_fails_for_nonexistent_file(self):
+        gen_id = self.create_generation()
+        self.assertRaises(
+            obnamlib.RepositoryFileDoesNotExistInGeneration,
+            self.repo.get_file_metadata, gen_id, '/foo/bar')
+
+    def test_get_file_metadata_fails_for_nonexistent_generation(self):
+        gen_id = self.create_generation()
+        self.repo.remove_generation(gen_id)
+        self.assertRaises(
+            obnamlib.RepositoryGenerationDoesNotExist,
+            self.repo.get_file_metadata, gen_id, '/foo/bar')
+
+    def test_gets_directory_metadata(self):
+        gen_id = self.create_generation()
+        self.repo.set_files_metadata(
+            gen_id,
+            [('/', obnamlib.Metadata(st_mode=stat.S_IFDIR | 0755)),
+             ('/foo', obnamlib.Metadata(st_size=1)),
+             ('/bar', obnamlib.Metadata(st_size=2)),
+             ('/bar/foobar', obnamlib.Metadata(st_size=3))])
+        result = self.repo.get_directory_metadata(gen_id, '/')
+        self.assertEqual(
+            sorted((pathname, metadata.st_size)
+                   for pathname, metadata in result),
+            [('/bar', 2), ('/foo', 1)])
+
+    def test_gets_empty_directory_metadata_for_new_file(self):
+        gen_id = self.create_generation()
+        self.repo.add_file(gen_id, '/foo/bar')
+        self.assertEqual(
+            self.repo.get_directory_metadata(gen_id, '/foo/bar'), [])
+
+    def create_two_generations_for_diff(self):
+        gen_id1 = self.create_generation()
+        self.repo.set_files_metadata(
+            gen_id1,
+            [('/', obnamlib.Metadata(st_mode=stat.S_IFDIR | 0755)),
+             ('/same', obnamlib.Metadata(st_size=1)),
+             ('/changed', obnamlib.Metadata(st_size=1)),
+             ('/removed', obnamlib.Metadata(st_size=1))])
+        self.repo.commit_client('fooclient')
+
+        self.repo.lock_client('fooclient')
+        gen_id2 = self.repo.create_generation('fooclient')
+        self.repo.set_files_metadata(
+            gen_id2,
+            [('/changed', obnamlib.Metadata(st_size=2)),
+             ('/added', obnamlib.Metadata(st_size=1))])
+        self.repo.remove_file(gen_id2, '/removed')
+        self.repo.commit_client('fooclient')
+        return gen_id1, gen_id2
+
+    def test_diffs_generations(self):
+        gen_id1, gen_id2 = self.create_two_generations_for_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id1, gen_id2)),
+            [('/added', '+'), ('/changed', '*'), ('/removed', '-')])
+
+    def test_diffs_generations_in_reverse(self):
+        gen_id1, gen_id2 = self.create_two_generations_for_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id2, gen_id1)),
+            [('/added', '-'), ('/changed', '*'), ('/removed', '+')])
+
+    def test_diff_of_generation_with_itself_is_empty(self):
+        gen_id1, gen_id2 = self.create_two_generations_for_diff()
+        self.assertEqual(
+            list(self.repo.diff_generations(gen_id2, gen_id2)), [])
+
     # Chunk and chunk indexes.
 
     def test_puts_chunk_into_repository(self):
@@ -1843,6 +2206,38 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
         self.assertTrue(self.repo.has_chunk(chunk_id))
         self.assertEqual(self.repo.get_chunk_content(chunk_id), 'foochunk')
 
+    def test_puts_many_chunks_into_repository(self):
+        chunk_ids = self.repo.put_chunk_contents(['foo', 'bar', 'foo'])
+        self.assertEqual(len(set(chunk_ids)), 3)
+        self.assertEqual(
+            [self.repo.get_chunk_content(x) for x in chunk_ids],
+            ['foo', 'bar', 'foo'])
+
+    def test_puts_no_chunks_into_repository(self):
+        self.assertEqual(self.repo.put_chunk_contents([]), [])
+
+    def test_gets_many_chunks_in_order(self):
+        datas = ['chunk %d' % i for i in range(10)]
+        chunk_ids = self.repo.put_chunk_contents(datas)
+        self.assertEqual(
+            list(self.repo.get_chunk_contents(chunk_ids + chunk_ids[:1])),
+            datas + datas[:1])
+
+    def test_gets_many_chunks_in_order_using_threads(self):
+        datas = ['chunk %d' % i for i in range(10)]
+        chunk_ids = self.repo.put_chunk_contents(datas)
+        contents = self.repo.get_chunk_contents(
+            chunk_ids, read_ahead=4, num_workers=2)
+        self.assertEqual(list(contents), datas)
+
+    def test_getting_many_chunks_fails_for_nonexistent_chunk(self):
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo.remove_chunk(chunk_id)
+        contents = self.repo.get_chunk_contents(
+            [chunk_id], read_ahead=4, num_workers=2)
+        self.assertRaises(
+            obnamlib.RepositoryChunkDoesNotExist, list, contents)
+
     def test_removes_chunk(self):
         chunk_id = self.repo.put_chunk_content('foochunk')
         self.repo.remove_chunk(chunk_id)
@@ -1858,6 +2253,19 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
             obnamlib.RepositoryChunkDoesNotExist,
             self.repo.remove_chunk, chunk_id)
 
+    def test_removes_many_chunks(self):
+        chunk_ids = self.repo.put_chunk_contents(['foo', 'bar', 'foobar'])
+        self.assertEqual(self.repo.remove_chunks(chunk_ids[:2]), [])
+        self.assertFalse(self.repo.has_chunk(chunk_ids[0]))
+        self.assertFalse(self.repo.has_chunk(chunk_ids[1]))
+        self.assertTrue(self.repo.has_chunk(chunk_ids[2]))
+
+    def test_removing_many_chunks_returns_nonexistent_ones(self):
+        chunk_ids = self.repo.put_chunk_contents(['foo', 'bar'])
+        self.repo.remove_chunk(chunk_ids[0])
+        self.assertEqual(self.repo.remove_chunks(chunk_ids), chunk_ids[:1])
+        self.assertFalse(self.repo.has_chunk(chunk_ids[1]))
+
     def test_get_chunk_ids_returns_nothing_initially(self):
         self.assertEqual(list(self.repo.get_chunk_ids()), [])
 
@@ -2001,6 +2409,19 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
         self.repo.force_chunk_indexes_lock()
         self.assertEqual(self.repo.lock_chunk_indexes(), None)
 
+    def test_forcing_chunk_index_lock_forgets_uncommitted_chunks(self):
+        self.setup_client()
+        chunk_id = self.repo.put_chunk_content('foochunk')
+        self.repo.lock_chunk_indexes()
+        token = self.repo.prepare_chunk_for_indexes('foochunk')
+        self.repo.put_chunk_into_indexes(chunk_id, token, 'fooclient')
+        self.assertEqual(
+            self.repo.find_chunk_ids_by_content('foochunk'), [chunk_id])
+        self.repo.force_chunk_indexes_lock()
+        self.assertRaises(
+            obnamlib.RepositoryChunkContentNotInIndexes,
+            self.repo.find_chunk_ids_by_content, 'foochunk')
+
     def test_validate_chunk_content_returns_True_or_None(self):
         self.setup_client()
         chunk_id = self.repo.put_chunk_content('foochunk')
@@ -2022,6 +2443,31 @@ class RepositoryInterfaceTests(unittest.TestCase): # pragma: no cover
         ret = self.repo.validate_chunk_content(chunk_id)
         self.assertTrue(ret is False or ret is None)
 
+    def test_repacking_chunks_keeps_remaining_chunks(self):
+        chunk_ids = [
+            self.repo.put_chunk_content('chunk-%d' % i * 100)
+            for i in range(10)]
+        for chunk_id in chunk_ids[:8]:
+            self.repo.remove_chunk(chunk_id)
+        self.repo.lock_chunk_indexes()
+        self.repo.repack_chunks(0.5)
+        self.repo.commit_chunk_indexes()
+        self.assertEqual(set(self.repo.get_chunk_ids()), set(chunk_ids[8:]))
+        for i, chunk_id in enumerate(chunk_ids[8:]):
+            self.assertEqual(
+                self.repo.get_chunk_content(chunk_id),
+                'chunk-%d' % (i + 8) * 100)
+
+    def test_repacking_chunks_without_locking_indexes_fails(self):
+        self.assertRaises(
+            obnamlib.RepositoryChunkIndexesNotLocked,
+            self.repo.repack_chunks, 0.5)
+
+    def test_removing_pending_chunks_without_locking_indexes_fails(self):
+        self.assertRaises(
+            obnamlib.RepositoryChunkIndexesNotLocked,
+            self.repo.remove_pending_chunks, 0)
+
     # Fsck.
 
     def test_returns_fsck_work_item(self):
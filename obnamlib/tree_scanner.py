@@ -0,0 +1,245 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import heapq
+import logging
+import os
+import Queue
+import stat
+import sys
+import threading
+import time
+
+
+class DirectoryListing(object):
+
+    '''The result of listing a directory, which may not be ready yet.
+
+    A listing is run exactly once, either by a worker thread, or by
+    the thread that needs the result, whichever gets to it first.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.duration = None
+        self._claim = threading.Lock()
+        self._done = threading.Event()
+        self._pairs = None
+        self._exc_info = None
+
+    def claim(self):
+        '''Claim the right to run the listing; return True if we got it.'''
+        return self._claim.acquire(False)
+
+    def run(self, fs):
+        started = time.time()
+        try:
+            self._pairs = fs.listdir2(self.dirname)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        self.duration = time.time() - started
+        self._done.set()
+
+    def get(self, fs):
+        '''Return the listing, waiting for it, or running it if need be.'''
+        if self.claim():
+            self.run(fs)
+        while not self._done.is_set():
+            self._done.wait(0.1)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._pairs
+
+
+class TreeScanner(object):
+
+    '''Scan a directory tree, listing directories in parallel.
+
+    This returns the same things, in the same order, as the scan_tree
+    method of a VirtualFileSystem: every file comes after the contents
+    of the directories before it in the directory, and every directory
+    comes after all its contents.
+
+    The caller's thread does the actual traversal, and calls the ``ok``
+    function, but directories that are going to be needed soon are
+    listed ahead of time in a pool of ``num_threads`` worker threads.
+    At most ``window`` listings per directory level are done ahead of
+    time. To know which directories those are, ``ok`` is called on a
+    directory's entries up to ``window`` subdirectories ahead of the
+    one being scanned, rather than just before they are reached. With
+    zero threads, everything happens in the caller's thread, in the
+    same order as with scan_tree, including the calls to ``ok``.
+
+    The time taken to list each directory is recorded, and log_stats
+    logs a summary, per device and for the slowest directories.
+
+    The VFS's listdir2 method must be safe to call from several
+    threads at once, if threads are used.
+
+    '''
+
+    # How many of the slowest directories log_stats should log.
+    num_slowest = 10
+
+    def __init__(self, fs, num_threads=0, window=None):
+        self._fs = fs
+        self._num_threads = num_threads
+        self._window = window or max(1, 2 * num_threads)
+        self._todo = Queue.Queue()
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self.dir_count = 0
+        self.total_time = 0.0
+        self._per_device = {}
+        self._slowest = []
+
+    def scan_tree(self, dirname, ok=None, log=logging.error,
+                  error_handler=None):
+        '''Scan a tree for files.
+
+        The arguments are as for VirtualFileSystem.scan_tree.
+
+        '''
+
+        error_handler = error_handler or (lambda name, e: None)
+        self._start_threads()
+        try:
+            listing = self._submit(dirname)
+            for t in self._scan(listing, None, ok, log, error_handler):
+                yield t
+        finally:
+            self._stop_threads()
+
+    def _start_threads(self):
+        self._stopping.clear()
+        for i in range(self._num_threads):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop_threads(self):
+        self._stopping.set()
+        for thread in self._threads:
+            self._todo.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            listing = self._todo.get()
+            if listing is None:
+                break
+            if not self._stopping.is_set() and listing.claim():
+                listing.run(self._fs)
+
+    def _submit(self, dirname):
+        listing = DirectoryListing(dirname)
+        if self._threads:
+            self._todo.put(listing)
+        return listing
+
+    def _scan(self, listing, dirst, ok, log, error_handler):
+        dirname = listing.dirname
+        try:
+            pairs = listing.get(self._fs)
+        except OSError, e:
+            log('listdir failed: %s: %s' % (e.filename, e.strerror))
+            error_handler(dirname, e)
+            pairs = []
+
+        # Entries are checked with ok only when they're needed, so
+        # that without threads, ok is called in the same order as by
+        # scan_tree: an entry after a subdirectory is checked only after
+        # the subdirectory has been scanned.
+        files = []
+
+        def accepted_subdirs():
+            for name, st in pairs:
+                pathname = os.path.join(dirname, name)
+                if isinstance(st, BaseException):
+                    error_handler(pathname, st)
+                elif ok is None or ok(pathname, st):
+                    if stat.S_ISDIR(st.st_mode):
+                        yield pathname, st
+                    else:
+                        files.append((pathname, st))
+
+        subdirs = accepted_subdirs()
+        pending = collections.deque()
+        ahead = self._window if self._threads else 0
+
+        def fill():
+            while len(pending) <= ahead:
+                try:
+                    pathname, st = subdirs.next()
+                except StopIteration:
+                    break
+                pending.append((self._submit(pathname), st))
+
+        fill()
+        while pending:
+            sublisting, st = pending.popleft()
+            for t in self._scan(sublisting, st, ok, log, error_handler):
+                yield t
+            fill()
+
+        for pathname, st in files:
+            yield pathname, st
+
+        if dirst is None:
+            try:
+                dirst = self._fs.lstat(dirname)
+            except OSError, e:
+                log('lstat for dir failed: %s: %s' % (e.filename, e.strerror))
+                self._record(listing, None)
+                return
+
+        self._record(listing, dirst.st_dev)
+        yield dirname, dirst
+
+    def _record(self, listing, device):
+        duration = listing.duration or 0.0
+        self.dir_count += 1
+        self.total_time += duration
+
+        count, total = self._per_device.get(device, (0, 0.0))
+        self._per_device[device] = (count + 1, total + duration)
+
+        item = (duration, listing.dirname)
+        if len(self._slowest) < self.num_slowest:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    def log_stats(self):
+        logging.info(
+            'Directory scanning statistics:')
+        logging.info(
+            '* directories listed: %d, in %.3f s',
+            self.dir_count, self.total_time)
+        for device in sorted(self._per_device):
+            count, total = self._per_device[device]
+            logging.info(
+                '* device %s: %d directories, %.3f s, %.3f ms per directory',
+                device, count, total, 1000.0 * total / count)
+        for duration, dirname in sorted(self._slowest, reverse=True):
+            logging.info(
+                '* slow directory: %s: %.3f s', dirname, duration)
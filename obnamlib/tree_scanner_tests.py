@@ -0,0 +1,82 @@
+# Copyright (C) 2015  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class TreeScannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.fs = obnamlib.LocalFS(self.basepath)
+        for dirname in ['a', 'a/b', 'a/b/c', 'a/d', 'e', 'f', 'f/g']:
+            self.fs.mkdir(os.path.join(self.basepath, dirname))
+        for filename in ['1', 'a/2', 'a/b/3', 'a/b/c/4', 'e/5', 'f/g/6']:
+            self.fs.write_file(os.path.join(self.basepath, filename), '')
+
+    def tearDown(self):
+        self.fs.close()
+        shutil.rmtree(self.basepath)
+
+    def scan(self, num_threads, **kwargs):
+        scanner = obnamlib.TreeScanner(self.fs, num_threads, window=2)
+        result = scanner.scan_tree(self.basepath, **kwargs)
+        return [pathname for pathname, st in result]
+
+    def test_returns_same_as_scan_tree_without_threads(self):
+        expected = [p for p, st in self.fs.scan_tree(self.basepath)]
+        self.assertEqual(self.scan(0), expected)
+
+    def test_returns_same_as_scan_tree_with_threads(self):
+        expected = [p for p, st in self.fs.scan_tree(self.basepath)]
+        self.assertEqual(self.scan(4), expected)
+
+    def test_filters_away_unwanted(self):
+        def ok(pathname, st):
+            return stat.S_ISDIR(st.st_mode)
+        expected = [p for p, st in self.fs.scan_tree(self.basepath, ok=ok)]
+        self.assertEqual(self.scan(4, ok=ok), expected)
+
+    def test_calls_ok_in_same_order_as_scan_tree_without_threads(self):
+        def checker(calls):
+            def ok(pathname, st):
+                calls.append(pathname)
+                return True
+            return ok
+        expected = []
+        list(self.fs.scan_tree(self.basepath, ok=checker(expected)))
+        calls = []
+        self.scan(0, ok=checker(calls))
+        self.assertEqual(calls, expected)
+
+    def test_returns_only_root_if_listdir_fails(self):
+        def raiser(dirname):
+            raise OSError(123, 'oops', dirname)
+        def logerror(msg):
+            pass
+        self.fs.listdir2 = raiser
+        self.assertEqual(self.scan(4, log=logerror), [self.basepath])
+
+    def test_records_timings_for_every_directory(self):
+        scanner = obnamlib.TreeScanner(self.fs, 2)
+        list(scanner.scan_tree(self.basepath))
+        self.assertEqual(scanner.dir_count, 8)
@@ -15,6 +15,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import errno
 import logging
 import os
 import stat
@@ -172,6 +173,27 @@ class VirtualFileSystem(object):
     def remove(self, pathname):
         '''Remove a file.'''
 
+    def remove_files(self, pathnames):
+        '''Remove many files.
+
+        This is like calling remove for each pathname, but allows
+        implementations to do it faster, for example by pipelining the
+        removals. Files that don't exist are skipped, and their
+        pathnames are returned as a list. Other errors are raised as
+        usual.
+
+        '''
+
+        missing = []
+        for pathname in pathnames:
+            try:
+                self.remove(pathname)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                missing.append(pathname)
+        return missing
+
     def rename(self, old, new):
         '''Rename a file.'''
 
@@ -243,6 +265,22 @@ class VirtualFileSystem(object):
     def cat(self, pathname):
         '''Return the contents of a file.'''
 
+    def cat_range(self, pathname, offset, length):
+        '''Return length bytes of a file, starting at offset.
+
+        If the file is shorter, return as much as there is.
+
+        '''
+
+        f = self.open(pathname, 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(length)
+        finally:
+            f.close()
+        self.bytes_read += len(data)
+        return data
+
     def write_file(self, pathname, contents):
         '''Write a new file.
 
@@ -255,6 +293,28 @@ class VirtualFileSystem(object):
 
         '''
 
+    def write_files(self, pathnames_and_contents):
+        '''Write many new files.
+
+        This is like calling write_file for each (pathname, contents)
+        pair, but allows implementations to do it faster, for example
+        by pipelining the writes. Files that already exist are left
+        alone, and their pathnames are returned as a list. Other
+        errors are raised as usual.
+
+        '''
+
+        existing = []
+        for pathname, contents in pathnames_and_contents:
+            try:
+                self.write_file(pathname, contents)
+            except OSError as e:
+                # SFTP sets errno to None if the file exists already.
+                if e.errno not in (errno.EEXIST, None):
+                    raise
+                existing.append(pathname)
+        return existing
+
     def overwrite_file(self, pathname, contents):
         '''Like write_file, but overwrites existing file.'''
 
@@ -318,6 +378,39 @@ class VirtualFileSystem(object):
 
         yield dirname, dirst
 
+    def scan_files(self, dirname, ok=None, log=logging.error):
+        '''Scan a tree for files, without their stat results.
+
+        Return a generator that returns the pathname of each file,
+        or other non-directory, in the tree, in no particular order.
+        If ``ok`` is not None, it is called with the pathname of each
+        directory, and if it returns False, the directory is skipped.
+
+        This is for when only the names of files are needed, such as
+        when finding all chunks in a repository. Implementations may
+        list many directories at once, and need not stat anything.
+        Errors from listing directories are logged, and the
+        directories skipped.
+
+        '''
+
+        try:
+            pairs = self.listdir2(dirname)
+        except OSError, e:
+            log('listdir failed: %s: %s' % (e.filename, e.strerror))
+            return
+
+        for name, st in pairs:
+            pathname = os.path.join(dirname, name)
+            if isinstance(st, BaseException):
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if ok is None or ok(pathname):
+                    for x in self.scan_files(pathname, ok=ok, log=log):
+                        yield x
+            else:
+                yield pathname
+
 
 class VfsFactory:
 
@@ -559,6 +652,19 @@ class VfsTests(object): # pragma: no cover
     def test_remove_raises_oserror_if_file_does_not_exist(self):
         self.assertRaises(OSError, self.fs.remove, 'foo')
 
+    def test_remove_files_removes_files(self):
+        self.fs.write_files([('foo', ''), ('bar/foo', '')])
+        missing = self.fs.remove_files(['foo', 'bar/foo'])
+        self.assertEqual(missing, [])
+        self.assertFalse(self.fs.exists('foo'))
+        self.assertFalse(self.fs.exists('bar/foo'))
+
+    def test_remove_files_returns_missing_files(self):
+        self.fs.write_file('foo', '')
+        missing = self.fs.remove_files(['bar', 'foo', 'foobar'])
+        self.assertEqual(missing, ['bar', 'foobar'])
+        self.assertFalse(self.fs.exists('foo'))
+
     def test_rename_renames_file(self):
         self.fs.write_file('foo', 'xxx')
         self.fs.rename('foo', 'bar')
@@ -664,6 +770,19 @@ class VfsTests(object): # pragma: no cover
         self.fs.cat('foo')
         self.assertEqual(self.fs.bytes_read, 3)
 
+    def test_cat_range_reads_part_of_file(self):
+        self.fs.write_file('foo', 'foobar')
+        self.assertEqual(self.fs.cat_range('foo', 2, 3), 'oba')
+
+    def test_cat_range_reads_until_end_of_file(self):
+        self.fs.write_file('foo', 'foobar')
+        self.assertEqual(self.fs.cat_range('foo', 3, 100), 'bar')
+
+    def test_cat_range_updates_bytes_read(self):
+        self.fs.write_file('foo', 'foobar')
+        self.fs.cat_range('foo', 2, 3)
+        self.assertEqual(self.fs.bytes_read, 3)
+
     def test_write_fails_if_file_exists_already(self):
         self.fs.write_file('foo', 'bar')
         self.assertRaises(OSError, self.fs.write_file, 'foo', 'foobar')
@@ -680,6 +799,19 @@ class VfsTests(object): # pragma: no cover
             pass
         self.assertEqual(self.fs.cat('foo'), 'bar')
 
+    def test_write_files_writes_all_files(self):
+        existing = self.fs.write_files([('foo', 'bar'), ('bar/foo', 'yo')])
+        self.assertEqual(existing, [])
+        self.assertEqual(self.fs.cat('foo'), 'bar')
+        self.assertEqual(self.fs.cat('bar/foo'), 'yo')
+
+    def test_write_files_returns_existing_files(self):
+        self.fs.write_file('foo', 'bar')
+        existing = self.fs.write_files([('foo', 'foobar'), ('bar', 'yo')])
+        self.assertEqual(existing, ['foo'])
+        self.assertEqual(self.fs.cat('foo'), 'bar')
+        self.assertEqual(self.fs.cat('bar'), 'yo')
+
     def test_overwrite_creates_new_file_ok(self):
         self.fs.overwrite_file('foo', 'bar')
         self.assertEqual(self.fs.cat('foo'), 'bar')
@@ -727,6 +859,35 @@ class VfsTests(object): # pragma: no cover
         pathnames = [pathname for pathname, st in result]
         self.assertEqual(sorted(pathnames), sorted(self.pathnames))
 
+    def set_up_scan_files(self):
+        for filename in ['a', 'foo/b', 'foo/bar/c', 'foobar/d']:
+            self.fs.write_file(os.path.join(self.basepath, filename), '')
+
+    def test_scan_files_returns_only_files(self):
+        self.set_up_scan_files()
+        result = self.fs.scan_files(self.basepath)
+        self.assertEqual(
+            sorted(result),
+            [os.path.join(self.basepath, x)
+             for x in ['a', 'foo/b', 'foo/bar/c', 'foobar/d']])
+
+    def test_scan_files_skips_unwanted_directories(self):
+        def ok(pathname):
+            return os.path.basename(pathname) != 'bar'
+        self.set_up_scan_files()
+        result = self.fs.scan_files(self.basepath, ok=ok)
+        self.assertEqual(
+            sorted(result),
+            [os.path.join(self.basepath, x)
+             for x in ['a', 'foo/b', 'foobar/d']])
+
+    def test_scan_files_returns_nothing_if_listdir_fails(self):
+        def logerror(msg):
+            pass
+        result = self.fs.scan_files(
+            os.path.join(self.basepath, 'missing'), log=logerror)
+        self.assertEqual(list(result), [])
+
     def test_scan_tree_filters_away_unwanted(self):
         def ok(pathname, st):
             return stat.S_ISDIR(st.st_mode)